@@ -4,436 +4,295 @@ import matplotlib.pyplot as pl
 import myokit
 import numpy as np
 from manual_APD import ap_duration
+import model_cache
+import model_registry
+import sim_cache
+import steady_cache
 
-### HF model O'hara 2011 ###
-
-def Ord_HF_Gomez(cell_type = None):
-    m = myokit.load_model('ohara-2011.mmt')
-
-    # Late sodium current- ORd model 180% in HF
-    inal = m.get('inal.INaL')
-    inal.set_rhs(myokit.Multiply(myokit.Number(1.8), inal.rhs()))
-
-    # Time constant of inactivation of the INaL- ORd 180%
-    # phosphorylated or non-phosphorylated?? th vs thp or both
-    th = m.get('inal.th')
-    th.set_rhs(myokit.Multiply(myokit.Number(1.8), th.rhs()))
-    #thp = m.get('inal.thp')
-    #thp.set_rhs(myokit.Multiply(myokit.Number(1.8), thp.rhs()))
-
-    # Transient outward K+ current- ORd 40% in HF
-    ito = m.get('ito.Ito')
-    ito.set_rhs(myokit.Multiply(myokit.Number(0.4), ito.rhs()))
+### HF remodelling table ###
+### -------------------- ###
 
-    # Inward rectifier K+ current- ORd 68% in HF
-    ik1 = m.get('ik1.IK1')
-    ik1.set_rhs(myokit.Multiply(myokit.Number(0.68), ik1.rhs()))
+# Each row: HF model, variable, cell type, factor the variable is multiplied by in HF.
+# Cell type None is used for any cell type without its own row (and when no cell type is given).
+# Variables not listed for a cell type are unchanged
 
-    # Na+/ K+ pump current- ORd 70% in HF
-    inak = m.get('inak.INaK')
-    inak.set_rhs(myokit.Multiply(myokit.Number(0.7), inak.rhs()))
-
-    # Sodium Calcium Exchanger- ORd 175% in HF
-    incx = m.get('inaca.INaCa')
-    # If no cell type passed, +75% for all cell types
-    if cell_type == None:
-        incx.set_rhs(myokit.Multiply(myokit.Number(1.75), incx.rhs()))
-    # Specified to be epicardial cell (1)
-    elif cell_type == 1:
-        incx.set_rhs(myokit.Multiply(myokit.Number(2.0), incx.rhs()))
-    # Endocardial or mid-myocardial (0 or 2)
-    else:
-        incx.set_rhs(myokit.Multiply(myokit.Number(1.6), incx.rhs()))
-
-    # SERCA pump - ORd 50% in HF
-    serc = m.get('serca.Jup') #
-    # No cell type specified, set all cell types the same (-50%)
-    if cell_type == None:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.5), serc.rhs()))
-    # Epicardial
-    elif cell_type == 1:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.75), serc.rhs()))
-    # Mid-myocardial
-    elif cell_type == 2:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.6), serc.rhs()))
-    # Endocardial
-    else:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.45), serc.rhs()))
-
-    # Ileak - ORd 130% in HF
-    leak = m.get('serca.Jleak')
-    leak.set_rhs(myokit.Multiply(myokit.Number(1.3), leak.rhs()))
+# Instead of rewriting equations for every HF model and cell type, the base model gets one
+# scale constant per remodelled variable (scaled_model), all 1 by default, and an HF model is
+# applied to a simulation with set_constant (HF_constants). All HF models and cell types then
+# share one compiled simulation per base model
 
-    # CamKa - ORd 150% in HF
-    camka = m.get('camk.CaMKa')
-    camka.set_rhs(myokit.Multiply(myokit.Number(1.5), camka.rhs()))
-
-    # Jrel- Non-phosphorylated Ca2+ release via Ryr - ORd 80% in HF
-    ryr = m.get('ryr.Jrel')
-    ryr.set_rhs(myokit.Multiply(myokit.Number(0.8), ryr.rhs()))
-    return(m)
-
-def GPB_HF_Gomez(cell_type = None):
-    m = myokit.load_model('grandi-2010_modified.mmt')
-
-    # Original grandi model does not contain late channel. Changes from Tenor et al.
-    # Late Na+ current - fast component where is late in model
-    inal = m.get('inal.GNal') # GNal multiplied by both junc and sl
-    inal.set_rhs(myokit.Multiply(myokit.Number(2.0), inal.rhs()))
-
-    # Transient outward K+ current- GPB 40% in HF
-    ito = m.get('ito.ito')
-    ito.set_rhs(myokit.Multiply(myokit.Number(0.4), ito.rhs()))
-
-    # Inward rectifier K+ current- GPB 68% in HF
-    ik1 = m.get('ik1.I_k1')
-    ik1.set_rhs(myokit.Multiply(myokit.Number(0.68), ik1.rhs()))
-
-    # Na+/ K+ pump current- GPB 90% in HF
-    inak = m.get('inak.I_nak')
-    inak.set_rhs(myokit.Multiply(myokit.Number(0.9), inak.rhs()))
-
-    # Background Na+ current- GPB 0% in HF
-    inab = m.get('inab.GNaB') # Then slow and junc = 0, as both multiplied by GNaB
-    inab.set_rhs(myokit.Multiply(myokit.Number(0.0), inab.rhs()))
-
-    # Background Ca2+ current- GPB 153% in HF
-    icab = m.get('icabk.GCaB') # Slow and junc, both multiplied by GCaB (ask anna/michael)
-    icab.set_rhs(myokit.Multiply(myokit.Number(1.53), icab.rhs()))
-
-    # Sodium/calcium exchanger current- GPB 175% in HF
-    incx = m.get('incx.IbarNCX') # Both slow and junc multiplied
-    if cell_type == None:
-        incx.set_rhs(myokit.Multiply(myokit.Number(1.75), incx.rhs()))
-    # Grandi model no mid-myocardial cells
-    elif cell_type == 0:
-        incx.set_rhs(myokit.Multiply(myokit.Number(1.6), incx.rhs()))
-    elif cell_type == 1:
-        incx.set_rhs(myokit.Multiply(myokit.Number(2.0), incx.rhs()))
-    else:
-        print 'Enter valid cell type for grandi model (Endo: 0, Epi: 1)'
-
-    # Sarco/ endoplasmic reticulum Ca2+ pump current- GPB 50% in HF
-    serca = m.get('caflux.J_serca')
-    if cell_type == None:
-        serca.set_rhs(myokit.Multiply(myokit.Number(0.5), serca.rhs()))
-    elif cell_type == 0:
-        serca.set_rhs(myokit.Multiply(myokit.Number(0.45), serca.rhs()))
-    elif cell_type == 1:
-        serca.set_rhs(myokit.Multiply(myokit.Number(0.75), serca.rhs()))
-    else:
-        print 'Enter valid cell type for grandi model (Endo: 0, Epi: 1)'
-
-
-    # SR Ca2+ leak GPB 300% in HF
-    leak = m.get('caflux.J_SRleak')
-    leak.set_rhs(myokit.Multiply(myokit.Number(3.0), leak.rhs()))
-
-    # EC50. -11% in HF
-    ec50 = m.get('caflux.ec50SR')
-    ec50.set_rhs(myokit.Multiply(myokit.Number(0.89), ec50.rhs()))
-
-    return(m)
-
-## Elshrif (2015) HF model, heterogenous across cell types
-def Ord_HF_Elshrif(cell_type):
-    m = myokit.load_model('ohara-2011.mmt')
-
-    # Fast sodium channel
-    ina = m.get('ina.INa')
-    ina.set_rhs(myokit.Multiply(myokit.Number(0.37), ina.rhs()))
-
-    # Late sodium current
-    inal = m.get('inal.INaL')
-    inal.set_rhs(myokit.Multiply(myokit.Number(1.93), inal.rhs()))
-
-    # No time constant of inactivation change for INal in Elshrif model
-
-    # Transient outward K+ current
-    ito = m.get('ito.Ito')
-    if cell_type == 1:
-        ito.set_rhs(myokit.Multiply(myokit.Number(0.6), ito.rhs()))
-    elif cell_type == 2:
-        ito.set_rhs(myokit.Multiply(myokit.Number(0.62), ito.rhs()))
-    elif cell_type == 0:
-        ito.set_rhs(myokit.Multiply(myokit.Number(0.49), ito.rhs()))
-    else:
-        print 'Enter valid cell_type for Elshrif Ord HF model'
-
-    # Inward rectifier K+ current
-    ik1 = m.get('ik1.IK1')
-    if cell_type == 0 or cell_type == 1:
-        ik1.set_rhs(myokit.Multiply(myokit.Number(0.45), ik1.rhs()))
-    elif cell_type == 2:
-        ik1.set_rhs(myokit.Multiply(myokit.Number(0.47), ik1.rhs()))
-
-    # Na+/ K+ pump current
-    inak = m.get('inak.INaK')
-    # All cell types -40%
-    inak.set_rhs(myokit.Multiply(myokit.Number(0.6), inak.rhs()))
-
-    # Sodium Calcium Exchanger
-    incx = m.get('inaca.INaCa')
-    # All cell types +131%
-    incx.set_rhs(myokit.Multiply(myokit.Number(2.31), incx.rhs()))
-
-    # SERCA pump
-    serc = m.get('serca.Jup')
-    # Epi/ Endo
-    if cell_type == 1 or cell_type == 0:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.59), serc.rhs()))
-    # Mid-myocardial
-    elif cell_type == 2:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.58), serc.rhs()))
-
-    # IKr, rapid delayed rectifier potassium current
-    ikr = m.get('ikr.IKr')
-    # Epi
-    if cell_type == 1:
-        ikr.set_rhs(myokit.Multiply(myokit.Number(0.54), ikr.rhs()))
-    # Endo
-    elif cell_type == 0:
-        ikr.set_rhs(myokit.Multiply(myokit.Number(0.73), ikr.rhs()))
-    # Mid-myocardial cells- no change -> Don't need to multiply by value
-
-    # IKs, slow delayed rectifier potassium current
-    iks = m.get('iks.IKs')
-    # Epi
-    if cell_type == 1:
-        iks.set_rhs(myokit.Multiply(myokit.Number(0.41), iks.rhs()))
-    # Endo
-    elif cell_type == 0:
-        iks.set_rhs(myokit.Multiply(myokit.Number(0.42), iks.rhs()))
-    # Mid-myocardial cells
-    elif cell_type == 2:
-        iks.set_rhs(myokit.Multiply(myokit.Number(0.5), iks.rhs()))
-
-    return(m)
-
-def Ordcipa_HF_Gomez(cell_type = None):
-    m = myokit.load_model('ohara-cipa-v1-2017.mmt')
+HF_remodelling = [
 
+    ## O'hara (2011), Gomez ##
     # Late sodium current- ORd model 180% in HF
-    inal = m.get('inal.INaL')
-    inal.set_rhs(myokit.Multiply(myokit.Number(1.8), inal.rhs()))
-
+    ('Ord_HF_Gomez', 'inal.INaL', None, 1.8),
     # Time constant of inactivation of the INaL- ORd 180%
     # phosphorylated or non-phosphorylated?? th vs thp or both
-    th = m.get('inal.thL')
-    th.set_rhs(myokit.Multiply(myokit.Number(1.8), th.rhs()))
-    #thp = m.get('inal.thp')
-    #thp.set_rhs(myokit.Multiply(myokit.Number(1.8), thp.rhs()))
-
+    ('Ord_HF_Gomez', 'inal.th', None, 1.8),
     # Transient outward K+ current- ORd 40% in HF
-    ito = m.get('ito.Ito')
-    ito.set_rhs(myokit.Multiply(myokit.Number(0.4), ito.rhs()))
-
+    ('Ord_HF_Gomez', 'ito.Ito', None, 0.4),
     # Inward rectifier K+ current- ORd 68% in HF
-    ik1 = m.get('ik1.IK1')
-    ik1.set_rhs(myokit.Multiply(myokit.Number(0.68), ik1.rhs()))
-
+    ('Ord_HF_Gomez', 'ik1.IK1', None, 0.68),
     # Na+/ K+ pump current- ORd 70% in HF
-    inak = m.get('inak.INaK')
-    inak.set_rhs(myokit.Multiply(myokit.Number(0.7), inak.rhs()))
-
-    # Sodium Calcium Exchanger- ORd 175% in HF
-    incx = m.get('inaca.INaCa_i')
-    # If no cell type passed, +75% for all cell types
-    if cell_type == None:
-        incx.set_rhs(myokit.Multiply(myokit.Number(1.75), incx.rhs()))
-    # Specified to be epicardial cell (1)
-    elif cell_type == 1:
-        incx.set_rhs(myokit.Multiply(myokit.Number(2.0), incx.rhs()))
-    # Endocardial or mid-myocardial (0 or 2)
-    else:
-        incx.set_rhs(myokit.Multiply(myokit.Number(1.6), incx.rhs()))
-
-    # SERCA pump - ORd 50% in HF
-    serc = m.get('serca.Jup') #
-    # No cell type specified, set all cell types the same (-50%)
-    if cell_type == None:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.5), serc.rhs()))
-    # Epicardial
-    elif cell_type == 1:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.75), serc.rhs()))
-    # Mid-myocardial
-    elif cell_type == 2:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.6), serc.rhs()))
-    # Endocardial
-    else:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.45), serc.rhs()))
-
+    ('Ord_HF_Gomez', 'inak.INaK', None, 0.7),
+    # Sodium Calcium Exchanger- ORd 175% in HF (no cell type), epi 200%, endo and mid 160%
+    ('Ord_HF_Gomez', 'inaca.INaCa', None, 1.75),
+    ('Ord_HF_Gomez', 'inaca.INaCa', 0, 1.6),
+    ('Ord_HF_Gomez', 'inaca.INaCa', 1, 2.0),
+    ('Ord_HF_Gomez', 'inaca.INaCa', 2, 1.6),
+    # SERCA pump - ORd 50% in HF (no cell type), epi 75%, mid 60%, endo 45%
+    ('Ord_HF_Gomez', 'serca.Jup', None, 0.5),
+    ('Ord_HF_Gomez', 'serca.Jup', 0, 0.45),
+    ('Ord_HF_Gomez', 'serca.Jup', 1, 0.75),
+    ('Ord_HF_Gomez', 'serca.Jup', 2, 0.6),
     # Ileak - ORd 130% in HF
-    leak = m.get('serca.Jleak')
-    leak.set_rhs(myokit.Multiply(myokit.Number(1.3), leak.rhs()))
-
+    ('Ord_HF_Gomez', 'serca.Jleak', None, 1.3),
     # CamKa - ORd 150% in HF
-    camka = m.get('camk.CaMKa')
-    camka.set_rhs(myokit.Multiply(myokit.Number(1.5), camka.rhs()))
-
+    ('Ord_HF_Gomez', 'camk.CaMKa', None, 1.5),
     # Jrel- Non-phosphorylated Ca2+ release via Ryr - ORd 80% in HF
-    ryr = m.get('ryr.Jrel')
-    ryr.set_rhs(myokit.Multiply(myokit.Number(0.8), ryr.rhs()))
-    return(m)
-
-
-## Elshrif (2015) HF model, heterogenous across cell types
-def Ordcipa_HF_Elshrif(cell_type):
-    m = myokit.load_model('ohara-cipa-v1-2017.mmt')
+    ('Ord_HF_Gomez', 'ryr.Jrel', None, 0.8),
 
+    ## O'hara (2011), Elshrif (2015). Heterogenous across cell types ##
     # Fast sodium channel
-    ina = m.get('ina.INa')
-    ina.set_rhs(myokit.Multiply(myokit.Number(0.37), ina.rhs()))
-
-    # Late sodium current
-    inal = m.get('inal.INaL')
-    inal.set_rhs(myokit.Multiply(myokit.Number(1.93), inal.rhs()))
-
-    # No time constant of inactivation change for INal in Elshrif model
-
+    ('Ord_HF_Elshrif', 'ina.INa', None, 0.37),
+    # Late sodium current. No time constant of inactivation change in Elshrif model
+    ('Ord_HF_Elshrif', 'inal.INaL', None, 1.93),
     # Transient outward K+ current
-    ito = m.get('ito.Ito')
-    if cell_type == 1:
-        ito.set_rhs(myokit.Multiply(myokit.Number(0.6), ito.rhs()))
-    elif cell_type == 2:
-        ito.set_rhs(myokit.Multiply(myokit.Number(0.62), ito.rhs()))
-    elif cell_type == 0:
-        ito.set_rhs(myokit.Multiply(myokit.Number(0.49), ito.rhs()))
-    else:
-        print 'Enter valid cell_type for Elshrif Ord HF model'
-
+    ('Ord_HF_Elshrif', 'ito.Ito', 0, 0.49),
+    ('Ord_HF_Elshrif', 'ito.Ito', 1, 0.6),
+    ('Ord_HF_Elshrif', 'ito.Ito', 2, 0.62),
     # Inward rectifier K+ current
-    ik1 = m.get('ik1.IK1')
-    if cell_type == 0 or cell_type == 1:
-        ik1.set_rhs(myokit.Multiply(myokit.Number(0.45), ik1.rhs()))
-    elif cell_type == 2:
-        ik1.set_rhs(myokit.Multiply(myokit.Number(0.47), ik1.rhs()))
-
-    # Na+/ K+ pump current
-    inak = m.get('inak.INaK')
-    # All cell types -40%
-    inak.set_rhs(myokit.Multiply(myokit.Number(0.6), inak.rhs()))
-
-    # Sodium Calcium Exchanger
-    incx = m.get('inaca.INaCa_i')
-    # All cell types +131%
-    incx.set_rhs(myokit.Multiply(myokit.Number(2.31), incx.rhs()))
-
+    ('Ord_HF_Elshrif', 'ik1.IK1', 0, 0.45),
+    ('Ord_HF_Elshrif', 'ik1.IK1', 1, 0.45),
+    ('Ord_HF_Elshrif', 'ik1.IK1', 2, 0.47),
+    # Na+/ K+ pump current. All cell types -40%
+    ('Ord_HF_Elshrif', 'inak.INaK', None, 0.6),
+    # Sodium Calcium Exchanger. All cell types +131%
+    ('Ord_HF_Elshrif', 'inaca.INaCa', None, 2.31),
     # SERCA pump
-    serc = m.get('serca.Jup')
-    # Epi/ Endo
-    if cell_type == 1 or cell_type == 0:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.59), serc.rhs()))
-    # Mid-myocardial
-    elif cell_type == 2:
-        serc.set_rhs(myokit.Multiply(myokit.Number(0.58), serc.rhs()))
-
-    # IKr, rapid delayed rectifier potassium current
-    ikr = m.get('ikr.IKr')
-    # Epi
-    if cell_type == 1:
-        ikr.set_rhs(myokit.Multiply(myokit.Number(0.54), ikr.rhs()))
-    # Endo
-    elif cell_type == 0:
-        ikr.set_rhs(myokit.Multiply(myokit.Number(0.73), ikr.rhs()))
-    # Mid-myocardial cells- no change -> Don't need to multiply by value
-
+    ('Ord_HF_Elshrif', 'serca.Jup', 0, 0.59),
+    ('Ord_HF_Elshrif', 'serca.Jup', 1, 0.59),
+    ('Ord_HF_Elshrif', 'serca.Jup', 2, 0.58),
+    # IKr, rapid delayed rectifier potassium current. Mid-myocardial cells- no change
+    ('Ord_HF_Elshrif', 'ikr.IKr', 0, 0.73),
+    ('Ord_HF_Elshrif', 'ikr.IKr', 1, 0.54),
     # IKs, slow delayed rectifier potassium current
-    iks = m.get('iks.IKs')
-    # Epi
-    if cell_type == 1:
-        iks.set_rhs(myokit.Multiply(myokit.Number(0.41), iks.rhs()))
-    # Endo
-    elif cell_type == 0:
-        iks.set_rhs(myokit.Multiply(myokit.Number(0.42), iks.rhs()))
-    # Mid-myocardial cells
-    elif cell_type == 2:
-        iks.set_rhs(myokit.Multiply(myokit.Number(0.5), iks.rhs()))
-
-    return(m)
-
-def GPB_HF_Moreno(cell_type = None):
-    m = myokit.load_model('grandi-2010_modified.mmt')
-
+    ('Ord_HF_Elshrif', 'iks.IKs', 0, 0.42),
+    ('Ord_HF_Elshrif', 'iks.IKs', 1, 0.41),
+    ('Ord_HF_Elshrif', 'iks.IKs', 2, 0.5),
+
+    ## O'hara CiPA (2017), Gomez. As O'hara (2011) ##
+    ('Ordcipa_HF_Gomez', 'inal.INaL', None, 1.8),
+    ('Ordcipa_HF_Gomez', 'inal.thL', None, 1.8),
+    ('Ordcipa_HF_Gomez', 'ito.Ito', None, 0.4),
+    ('Ordcipa_HF_Gomez', 'ik1.IK1', None, 0.68),
+    ('Ordcipa_HF_Gomez', 'inak.INaK', None, 0.7),
+    ('Ordcipa_HF_Gomez', 'inaca.INaCa_i', None, 1.75),
+    ('Ordcipa_HF_Gomez', 'inaca.INaCa_i', 0, 1.6),
+    ('Ordcipa_HF_Gomez', 'inaca.INaCa_i', 1, 2.0),
+    ('Ordcipa_HF_Gomez', 'inaca.INaCa_i', 2, 1.6),
+    ('Ordcipa_HF_Gomez', 'serca.Jup', None, 0.5),
+    ('Ordcipa_HF_Gomez', 'serca.Jup', 0, 0.45),
+    ('Ordcipa_HF_Gomez', 'serca.Jup', 1, 0.75),
+    ('Ordcipa_HF_Gomez', 'serca.Jup', 2, 0.6),
+    ('Ordcipa_HF_Gomez', 'serca.Jleak', None, 1.3),
+    ('Ordcipa_HF_Gomez', 'camk.CaMKa', None, 1.5),
+    ('Ordcipa_HF_Gomez', 'ryr.Jrel', None, 0.8),
+
+    ## O'hara CiPA (2017), Elshrif (2015). As O'hara (2011) ##
+    ('Ordcipa_HF_Elshrif', 'ina.INa', None, 0.37),
+    ('Ordcipa_HF_Elshrif', 'inal.INaL', None, 1.93),
+    ('Ordcipa_HF_Elshrif', 'ito.Ito', 0, 0.49),
+    ('Ordcipa_HF_Elshrif', 'ito.Ito', 1, 0.6),
+    ('Ordcipa_HF_Elshrif', 'ito.Ito', 2, 0.62),
+    ('Ordcipa_HF_Elshrif', 'ik1.IK1', 0, 0.45),
+    ('Ordcipa_HF_Elshrif', 'ik1.IK1', 1, 0.45),
+    ('Ordcipa_HF_Elshrif', 'ik1.IK1', 2, 0.47),
+    ('Ordcipa_HF_Elshrif', 'inak.INaK', None, 0.6),
+    ('Ordcipa_HF_Elshrif', 'inaca.INaCa_i', None, 2.31),
+    ('Ordcipa_HF_Elshrif', 'serca.Jup', 0, 0.59),
+    ('Ordcipa_HF_Elshrif', 'serca.Jup', 1, 0.59),
+    ('Ordcipa_HF_Elshrif', 'serca.Jup', 2, 0.58),
+    ('Ordcipa_HF_Elshrif', 'ikr.IKr', 0, 0.73),
+    ('Ordcipa_HF_Elshrif', 'ikr.IKr', 1, 0.54),
+    ('Ordcipa_HF_Elshrif', 'iks.IKs', 0, 0.42),
+    ('Ordcipa_HF_Elshrif', 'iks.IKs', 1, 0.41),
+    ('Ordcipa_HF_Elshrif', 'iks.IKs', 2, 0.5),
+
+    ## Grandi (2010) with late sodium channel, Gomez ##
     # Original grandi model does not contain late channel. Changes from Tenor et al.
-    # Late Na+ current. +900%
-    inal = m.get('inal.GNal') # GNal multiplied by both junc and sl
-    inal.set_rhs(myokit.Multiply(myokit.Number(10.0), inal.rhs()))
+    # Late Na+ current - fast component where is late in model. GNal multiplied by both junc and sl
+    ('GPB_HF_Gomez', 'inal.GNal', None, 2.0),
+    # Transient outward K+ current- GPB 40% in HF
+    ('GPB_HF_Gomez', 'ito.ito', None, 0.4),
+    # Inward rectifier K+ current- GPB 68% in HF
+    ('GPB_HF_Gomez', 'ik1.I_k1', None, 0.68),
+    # Na+/ K+ pump current- GPB 90% in HF
+    ('GPB_HF_Gomez', 'inak.I_nak', None, 0.9),
+    # Background Na+ current- GPB 0% in HF. Then slow and junc = 0, as both multiplied by GNaB
+    ('GPB_HF_Gomez', 'inab.GNaB', None, 0.0),
+    # Background Ca2+ current- GPB 153% in HF. Slow and junc, both multiplied by GCaB
+    ('GPB_HF_Gomez', 'icabk.GCaB', None, 1.53),
+    # Sodium/calcium exchanger current- GPB 175% in HF. Grandi model no mid-myocardial cells
+    ('GPB_HF_Gomez', 'incx.IbarNCX', None, 1.75),
+    ('GPB_HF_Gomez', 'incx.IbarNCX', 0, 1.6),
+    ('GPB_HF_Gomez', 'incx.IbarNCX', 1, 2.0),
+    # Sarco/ endoplasmic reticulum Ca2+ pump current- GPB 50% in HF
+    ('GPB_HF_Gomez', 'caflux.J_serca', None, 0.5),
+    ('GPB_HF_Gomez', 'caflux.J_serca', 0, 0.45),
+    ('GPB_HF_Gomez', 'caflux.J_serca', 1, 0.75),
+    # SR Ca2+ leak GPB 300% in HF
+    ('GPB_HF_Gomez', 'caflux.J_SRleak', None, 3.0),
+    # EC50. -11% in HF
+    ('GPB_HF_Gomez', 'caflux.ec50SR', None, 0.89),
 
+    ## Grandi (2010) with late sodium channel, Moreno (2013) ##
+    # Late Na+ current. +900%
+    ('GPB_HF_Moreno', 'inal.GNal', None, 10.0),
     # Transient outward K+ current -36%
-    ito = m.get('ito.ito')
-    ito.set_rhs(myokit.Multiply(myokit.Number(0.64), ito.rhs()))
-
+    ('GPB_HF_Moreno', 'ito.ito', None, 0.64),
     # Inward rectifier K+ current. -25% in HF
-    ik1 = m.get('ik1.I_k1')
-    ik1.set_rhs(myokit.Multiply(myokit.Number(0.75), ik1.rhs()))
-
+    ('GPB_HF_Moreno', 'ik1.I_k1', None, 0.75),
     # Na+/ K+ pump current- Between -42% and -10% in literature. Taken mean:-26%
-    inak = m.get('inak.I_nak')
-    inak.set_rhs(myokit.Multiply(myokit.Number(0.9), inak.rhs()))
-
+    ('GPB_HF_Moreno', 'inak.I_nak', None, 0.9),
     # Background Na+ current +1600% in moreno (2013) from rabbit HF data
-    inab = m.get('inab.GNaB') # Then slow and junc = 0, as both multiplied by GNaB
-    inab.set_rhs(myokit.Multiply(myokit.Number(1.0), inab.rhs()))
-
+    ('GPB_HF_Moreno', 'inab.GNaB', None, 1.0),
     # Sarco/ endoplasmic reticulum Ca2+ pump current: -36% in HF human patients
-    serca = m.get('caflux.J_serca')
-    serca.set_rhs(myokit.Multiply(myokit.Number(0.64), serca.rhs()))
-
+    ('GPB_HF_Moreno', 'caflux.J_serca', None, 0.64),
     # SR Ca2+ leak. +350% from rabbit HF data
-    leak = m.get('caflux.J_SRleak')
-    leak.set_rhs(myokit.Multiply(myokit.Number(4.5), leak.rhs()))
-
-    return(m)
-
-def TT_HF_Lu(cell_type = None):
-    m = myokit.load_model('tentusscher-2006.mmt')
+    ('GPB_HF_Moreno', 'caflux.J_SRleak', None, 4.5),
 
+    ## Ten-Tusscher (2006), Lu ##
     # INa: -40%
-    ina = m.get('ina.INa')
-    ina.set_rhs(myokit.Multiply(myokit.Number(0.6), ina.rhs()))
-
+    ('TT_HF_Lu', 'ina.INa', None, 0.6),
     # Ito: -36% (not -64% like other papers misquote)
-    ito = m.get('ito.ITo')
-    ito.set_rhs(myokit.Multiply(myokit.Number(0.64), ito.rhs()))
-
+    ('TT_HF_Lu', 'ito.ITo', None, 0.64),
     # IK1: -20%
-    ik1 = m.get('ik1.IK1')
-    ik1.set_rhs(myokit.Multiply(myokit.Number(0.8), ik1.rhs()))
-
+    ('TT_HF_Lu', 'ik1.IK1', None, 0.8),
     # INaK: -42%
-    inak = m.get('inak.INaK')
-    inak.set_rhs(myokit.Multiply(myokit.Number(0.58), inak.rhs()))
-
+    ('TT_HF_Lu', 'inak.INaK', None, 0.58),
     # ICab: +53%
-    icab = m.get('icab.ICaB')
-    icab.set_rhs(myokit.Multiply(myokit.Number(1.53), icab.rhs()))
-
+    ('TT_HF_Lu', 'icab.ICaB', None, 1.53),
     # INCX: +65%
-    incx = m.get('inaca.INaCa')
-    incx.set_rhs(myokit.Multiply(myokit.Number(1.65), incx.rhs()))
+    ('TT_HF_Lu', 'inaca.INaCa', None, 1.65),
+    # SR calcium pump current : -45%
+    ('TT_HF_Lu', 'calcium.i_up', None, 0.55),
+    # ILeak: 0%
+    ('TT_HF_Lu', 'calcium.i_leak', None, 1.0),
+    # Jrel ??: -23%. Not sure this is the right parameter
+    ('TT_HF_Lu', 'calcium.i_rel', None, 0.77),
+    # Iks: -50%
+    ('TT_HF_Lu', 'iks.IKs', None, 0.5),
+]
+
+# Base model each HF model is applied to, by label (first part of the HF model name)
+HF_base_models = {'Ord' : 'ohara-2011', 'Ordcipa' : 'ohara-cipa-v1-2017', 'GPB' : 'grandi-2010_modified', 'TT' : 'tentusscher-2006'}
+
+def HF_base_model(m_str):
+    # e.g. 'Ord_HF_Gomez' -> 'ohara-2011'
+    return(HF_base_models[m_str.split('_HF_')[0]])
+
+def scale_name(var):
+    # Scale constant for a remodelled variable, e.g. inal.INaL -> hf.inal_INaL
+    return('hf.' + var.replace('.', '_'))
+
+def scaled_model(model):
+    # Load a base model, with a scale constant (1 by default) for every variable remodelled by
+    # any of its HF models. Models without HF models are returned as loaded.
+    # Built once per process (model_cache), every call returns a copy
+    return(model_cache.derived_model(model_registry.model_info(model)['file'], 'scaled', lambda m: add_scales(m, model)))
+
+def add_scales(m, model):
+    # Add the scale constants of scaled_model to m, a copy of base model model
+    variables = []
+    for m_str, var, cell_type, factor in HF_remodelling:
+        if HF_base_model(m_str) == model and var not in variables:
+            variables.append(var)
+    if len(variables) == 0:
+        return(m)
+
+    hf = m.add_component('hf')
+    for var in variables:
+        scale = hf.add_variable(scale_name(var).split('.')[1])
+        scale.set_rhs(myokit.Number(1.0))
+        v = m.get(var)
+        v.set_rhs(myokit.Multiply(myokit.Name(scale), v.rhs()))
+    m.validate()
+    return(m)
 
+def HF_constants(m_str, cell_type = None, severity = 1.0):
+    # Values of all scale constants of the base model for HF model m_str and cell type.
+    # The base model name as m_str gives the healthy model (all 1)
+    # severity moves every factor linearly from healthy (0) to the HF factor (1), and past it
+    # above 1. Factors are not allowed below 0
+    model = m_str if m_str in HF_base_models.values() else HF_base_model(m_str)
+    factors = {}
+    specific = {}
+    for name, var, row_cell_type, factor in HF_remodelling:
+        if HF_base_model(name) != model:
+            continue
+        factors.setdefault(scale_name(var), 1.0)
+        if name != m_str:
+            continue
+        # Row for this cell type wins over the row for any cell type
+        if row_cell_type == cell_type:
+            factors[scale_name(var)] = factor
+            specific[var] = True
+        elif row_cell_type == None and not specific.get(var):
+            factors[scale_name(var)] = factor
+    for name in factors:
+        factors[name] = max(0.0, 1.0 + (factors[name] - 1.0)*severity)
+    return(factors)
+
+def set_constants(s, constants):
+    # Set every constant in a dict {name : value} on simulation s
+    for name in sorted(constants):
+        s.set_constant(name, constants[name])
+
+def HF_variant_model(m_str, cell_type = None):
+    # Model with the HF changes written into it, for code that needs a model rather than a
+    # simulation. Each variant is compiled separately, use scaled_model + HF_constants to avoid this
+    m = scaled_model(HF_base_model(m_str))
+    for name, factor in HF_constants(m_str, cell_type).items():
+        m.get(name).set_rhs(myokit.Number(factor))
+    return(m)
 
-    # SR calcium pump current : -45%
-    iup = m.get('calcium.i_up')
-    iup.set_rhs(myokit.Multiply(myokit.Number(0.55), iup.rhs()))
-    ## Can I call this serca?
+### HF model O'hara 2011 ###
 
-    # ILeak: 0%
-    ileak = m.get('calcium.i_leak')
-    ileak.set_rhs(myokit.Multiply(myokit.Number(1.0), ileak.rhs()))
+def Ord_HF_Gomez(cell_type = None):
+    return(HF_variant_model('Ord_HF_Gomez', cell_type))
 
+def GPB_HF_Gomez(cell_type = None):
+    return(HF_variant_model('GPB_HF_Gomez', cell_type))
 
-    #Jrel ??: -23%
-    jrel = m.get('calcium.i_rel') # Not sure this is the right parameter
-    jrel.set_rhs(myokit.Multiply(myokit.Number(0.77), jrel.rhs()))
+## Elshrif (2015) HF model, heterogenous across cell types
+def Ord_HF_Elshrif(cell_type):
+    return(HF_variant_model('Ord_HF_Elshrif', cell_type))
 
+def Ordcipa_HF_Gomez(cell_type = None):
+    return(HF_variant_model('Ordcipa_HF_Gomez', cell_type))
 
-    #Iks: -50%
-    iks = m.get('iks.IKs')
-    iks.set_rhs(myokit.Multiply(myokit.Number(0.5), iks.rhs()))
+## Elshrif (2015) HF model, heterogenous across cell types
+def Ordcipa_HF_Elshrif(cell_type):
+    return(HF_variant_model('Ordcipa_HF_Elshrif', cell_type))
 
-    return(m)
+def GPB_HF_Moreno(cell_type = None):
+    return(HF_variant_model('GPB_HF_Moreno', cell_type))
+
+def TT_HF_Lu(cell_type = None):
+    return(HF_variant_model('TT_HF_Lu', cell_type))
+
+def run_HF(s, m, p, model, cell_type, m_str, duration, pre_pacing, beat = None):
+    # Run simulation s of scaled_model(model) as the healthy model (m_str None) or HF model m_str,
+    # after pre-pacing from the model's initial state. Only constants change between runs.
+    # beat: PCL, to pre-pace to steady state by shooting (pre_pacing is then the maximum)
+    constants = {model_registry.model_info(model)['cell_type_label'] : cell_type}
+    constants.update(HF_constants(m_str if m_str != None else model, cell_type))
+    s.set_default_state(m.state())
+    s.reset()
+    set_constants(s, constants)
+    steady_cache.pre(s, m, p, pre_pacing, constants = constants, HF_model = m_str, beat = beat)
+    return(s.run(duration))
 
 # Main function for testing
 def main():
@@ -450,37 +309,26 @@ def main():
     # Set cell type
     cell_types = {'Endocardial' : 0, 'Epicardial' : 1}
 
+    # One simulation for the healthy and all HF models
+    m = scaled_model('grandi-2010_modified')
+    s = sim_cache.simulation(m,p)
+
     pl.figure()
     for i, cell_type in enumerate(cell_types):
-        m = myokit.load_model('grandi-2010_modified.mmt')
-        s = myokit.Simulation(m,p)
-
-        s.set_constant('type.epi', cell_types[cell_type])
-        s.pre(50*bcl)
-        d = s.run(paces*bcl)
-        start, duration, thresh = ap_duration(d, paces = 1, repolarisation = 90)
+        d = run_HF(s, m, p, 'grandi-2010_modified', cell_types[cell_type], None, paces*bcl, 1000*bcl, beat = bcl)
+        start, duration, thresh = ap_duration(d, repolarisation = 90)
         print 'grandi normal duration {}'.format(cell_type), duration
         pl.subplot(1, 2, cell_types[cell_type] + 1)
         pl.plot(d['engine.time'],d['membrane.V'])
 
-        # Use gomez GPB function to set parameters
-        m = GPB_HF_Gomez(cell_types[cell_type])
-        s = myokit.Simulation(m,p)
-
-        s.set_constant('type.epi', cell_types[cell_type])
-        s.pre(50*bcl)
-        d1 = s.run(paces*bcl)
-        start, duration, thresh = ap_duration(d1, paces = 1, repolarisation = 90)
+        # Gomez GPB parameters
+        d1 = run_HF(s, m, p, 'grandi-2010_modified', cell_types[cell_type], 'GPB_HF_Gomez', paces*bcl, 1000*bcl, beat = bcl)
+        start, duration, thresh = ap_duration(d1, repolarisation = 90)
         print 'grandi gomez hf duration {}'.format(cell_type), duration
         pl.plot(d1['engine.time'],d1['membrane.V'])
 
-        # Use moreno function to set parameters
-        m = GPB_HF_Moreno()
-        s = myokit.Simulation(m,p)
-
-        s.set_constant('type.epi', cell_types[cell_type])
-        s.pre(50*bcl)
-        d1 = s.run(paces*bcl)
+        # Moreno parameters
+        d1 = run_HF(s, m, p, 'grandi-2010_modified', cell_types[cell_type], 'GPB_HF_Moreno', paces*bcl, 1000*bcl, beat = bcl)
         pl.plot(d1['engine.time'],d1['membrane.V'])
 
         pl.legend(['Normal','HF GPB ', 'HF Moreno'] )
@@ -496,24 +344,17 @@ def main():
     # Set cell type
     cell_types = {'Endocardial' : 0, 'Epicardial' : 1,'Mid-myocardial' : 2}
 
+    m = scaled_model('tentusscher-2006')
+    s = sim_cache.simulation(m,p)
+
     pl.figure()
     for i, cell_type in enumerate(cell_types):
-        m = myokit.load_model('tentusscher-2006.mmt')
-        s = myokit.Simulation(m,p)
-
-        s.set_constant('cell.type', cell_types[cell_type])
-        s.pre(50*bcl)
-        d = s.run(paces*bcl)
+        d = run_HF(s, m, p, 'tentusscher-2006', cell_types[cell_type], None, paces*bcl, 1000*bcl, beat = bcl)
         pl.subplot(1, 3, cell_types[cell_type] + 1)
         pl.plot(d['engine.time'],d['membrane.V'])
 
-        # Use gomez GPB function to set parameters
-        m = TT_HF_Lu(cell_types[cell_type])
-        s = myokit.Simulation(m,p)
-
-        s.set_constant('cell.type', cell_types[cell_type])
-        s.pre(50*bcl)
-        d1 = s.run(paces*bcl)
+        # Lu parameters
+        d1 = run_HF(s, m, p, 'tentusscher-2006', cell_types[cell_type], 'TT_HF_Lu', paces*bcl, 1000*bcl, beat = bcl)
         pl.plot(d1['engine.time'],d1['membrane.V'])
 
         pl.legend(['Normal','HF Lu '] )
@@ -528,40 +369,26 @@ def main():
     # Set cell type
     cell_types = {'Endocardial' : 0, 'Epicardial' : 1, 'Mid-myocardial' : 2}
 
+    m = scaled_model('ohara-2011')
+    s = sim_cache.simulation(m,p)
+
     pl.figure()
     for i, cell_type in enumerate(cell_types):
-        m = myokit.load_model('ohara-2011.mmt')
-        s = myokit.Simulation(m,p)
-
-        s.set_constant('cell.mode', cell_types[cell_type])
-        s.pre(50*bcl)
-        d = s.run(paces*bcl)
-        start, duration, thresh = ap_duration(d, paces)
+        d = run_HF(s, m, p, 'ohara-2011', cell_types[cell_type], None, paces*bcl, 1000*bcl, beat = bcl)
+        start, duration, thresh = ap_duration(d)
         pl.subplot(1, 3, cell_types[cell_type] + 1)
         pl.plot(d['engine.time'],d['membrane.V'])
         pl.text(500,0,"Healthy APD- {} ms".format(np.round(duration[0],2)))
 
-
-        # Use gomez function to set parameters
-        m = Ord_HF_Gomez(cell_types[cell_type])
-        s = myokit.Simulation(m,p)
-
-        s.set_constant('cell.mode', cell_types[cell_type])
-        s.pre(50*bcl)
-        d1 = s.run(paces*bcl)
-        start, duration_hf, thresh = ap_duration(d1, paces)
+        # Gomez parameters
+        d1 = run_HF(s, m, p, 'ohara-2011', cell_types[cell_type], 'Ord_HF_Gomez', paces*bcl, 1000*bcl, beat = bcl)
+        start, duration_hf, thresh = ap_duration(d1)
         pl.plot(d1['engine.time'],d1['membrane.V'])
         pl.text(500,-5,"HF Gomez APD- {} ms".format(np.round(duration_hf[0],2)))
 
-
-        # Use Elshrif function to set parameters
-        m = Ord_HF_Elshrif(cell_types[cell_type])
-        s = myokit.Simulation(m,p)
-
-        s.set_constant('cell.mode', cell_types[cell_type])
-        s.pre(50*bcl)
-        d1 = s.run(paces*bcl)
-        start, duration_hf, thresh = ap_duration(d1, paces)
+        # Elshrif parameters
+        d1 = run_HF(s, m, p, 'ohara-2011', cell_types[cell_type], 'Ord_HF_Elshrif', paces*bcl, 1000*bcl, beat = bcl)
+        start, duration_hf, thresh = ap_duration(d1)
         pl.plot(d1['engine.time'],d1['membrane.V'])
         pl.text(500,-10,"HF Elshrif APD- {} ms".format(np.round(duration_hf[0],2)))
 
@@ -580,40 +407,26 @@ def main():
     # Set cell type
     cell_types = {'Endocardial' : 0, 'Epicardial' : 1, 'Mid-myocardial' : 2}
 
+    m = scaled_model('ohara-cipa-v1-2017')
+    s = sim_cache.simulation(m,p)
+
     pl.figure()
     for i, cell_type in enumerate(cell_types):
-        m = myokit.load_model('ohara-cipa-v1-2017.mmt')
-        s = myokit.Simulation(m,p)
-
-        s.set_constant('cell.celltype', cell_types[cell_type])
-        s.pre(50*bcl)
-        d = s.run(paces*bcl)
-        start, duration, thresh = ap_duration(d, paces)
+        d = run_HF(s, m, p, 'ohara-cipa-v1-2017', cell_types[cell_type], None, paces*bcl, 1000*bcl, beat = bcl)
+        start, duration, thresh = ap_duration(d)
         pl.subplot(1, 3, cell_types[cell_type] + 1)
         pl.plot(d['engine.time'],d['membrane.V'])
         pl.text(500,0,"Healthy APD- {} ms".format(np.round(duration[0],2)))
 
-
-        # Use gomez function to set parameters
-        m = Ordcipa_HF_Gomez(cell_types[cell_type])
-        s = myokit.Simulation(m,p)
-
-        s.set_constant('cell.celltype', cell_types[cell_type])
-        s.pre(50*bcl)
-        d1 = s.run(paces*bcl)
-        start, duration_hf, thresh = ap_duration(d1, paces)
+        # Gomez parameters
+        d1 = run_HF(s, m, p, 'ohara-cipa-v1-2017', cell_types[cell_type], 'Ordcipa_HF_Gomez', paces*bcl, 1000*bcl, beat = bcl)
+        start, duration_hf, thresh = ap_duration(d1)
         pl.plot(d1['engine.time'],d1['membrane.V'])
         pl.text(500,-5,"HF Gomez APD- {} ms".format(np.round(duration_hf[0],2)))
 
-
-        # Use Elshrif function to set parameters
-        m = Ordcipa_HF_Elshrif(cell_types[cell_type])
-        s = myokit.Simulation(m,p)
-
-        s.set_constant('cell.celltype', cell_types[cell_type])
-        s.pre(50*bcl)
-        d1 = s.run(paces*bcl)
-        start, duration_hf, thresh = ap_duration(d1, paces)
+        # Elshrif parameters
+        d1 = run_HF(s, m, p, 'ohara-cipa-v1-2017', cell_types[cell_type], 'Ordcipa_HF_Elshrif', paces*bcl, 1000*bcl, beat = bcl)
+        start, duration_hf, thresh = ap_duration(d1)
         pl.plot(d1['engine.time'],d1['membrane.V'])
         pl.text(500,-10,"HF Elshrif APD- {} ms".format(np.round(duration_hf[0],2)))
 
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+import myokit
+import matplotlib.pyplot as pl
+from manual_APD import ap_duration
+from restitution_protocols import s1s2_protocol, adaptive_stages
+import model_registry
+import sim_cache
+import steady_cache
+import multiprocessing
+import numpy as np
+from HF_model import *
+
+## HF severity sweep ##
+## ----------------- ##
+
+# Steady state APDs of an HF model as its remodelling goes from healthy (severity 0) to the full
+# HF model (severity 1) and beyond. Severity only changes the hf scale constants, so every
+# severity runs on the same compiled model: one simulation per severity, no recompiling or
+# reloading. With processes set, severities are spread over a pool of processes
+
+# Simulation and set up of each worker process, set once by init_severity_worker
+severity_worker_setup = {}
+
+def severity_apd(s, m, p, m_str, cell_type, severity, PCL = 1000, pre_pacing = 200, paces = 2, repolarisation = 90, pre_pacing_steady = False):
+
+    # APDs of the final paces beats after pre-pacing, for one severity. Beats whose repolarisation
+    # is not found are nan. paces = 2 or more shows alternans (neighbouring APDs differ)
+    # pre_pacing_steady: pre-pace until the state is steady, with pre_pacing as the most beats
+    model = HF_base_model(m_str)
+    constants = {model_registry.model_info(model)['cell_type_label'] : cell_type}
+    constants.update(HF_constants(m_str, cell_type, severity))
+
+    # Start every severity from the model's initial state
+    s.set_default_state(m.state())
+    s.reset()
+    set_constants(s, constants)
+    steady_cache.pre(s, m, p, pre_pacing*PCL, constants = constants, HF_model = m_str, beat = PCL if pre_pacing_steady else None)
+    d = s.run(paces*PCL, log = ['membrane.V','engine.time'])
+    start, duration, thresh = ap_duration(d, repolarisation = repolarisation)
+
+    apd = np.zeros(paces)*np.nan
+    duration = duration[-paces:]
+    apd[paces - len(duration):] = duration
+    return(apd)
+
+def init_severity_worker(model_code, PCL, args):
+    p = myokit.pacing.blocktrain(PCL, 0.5, offset=0, level=1.0, limit=0)
+    m = myokit.parse_model(model_code)
+    severity_worker_setup['m'] = m
+    severity_worker_setup['p'] = p
+    severity_worker_setup['s'] = sim_cache.simulation(m, p)
+    severity_worker_setup['args'] = args
+
+def severity_worker(severity):
+    m_str, cell_type, PCL, pre_pacing, paces, repolarisation, pre_pacing_steady = severity_worker_setup['args']
+    return(severity_apd(severity_worker_setup['s'], severity_worker_setup['m'], severity_worker_setup['p'], m_str, cell_type, severity, PCL, pre_pacing, paces, repolarisation, pre_pacing_steady))
+
+def severity_sweep(m_str, severities, cell_type = 1, PCL = 1000, pre_pacing = 200, paces = 2, repolarisation = 90, processes = None, pre_pacing_steady = False):
+
+    # m_str: HF model, e.g. 'Ord_HF_Gomez'. Returns severities and an array of APDs,
+    # one row per severity and one column per recorded beat
+    severities = np.asarray(severities, dtype = float)
+    m = scaled_model(HF_base_model(m_str))
+    p = myokit.pacing.blocktrain(PCL, 0.5, offset=0, level=1.0, limit=0)
+    # Compiled here once, workers load the module from the cache
+    s = sim_cache.simulation(m, p)
+    args = (m_str, cell_type, PCL, pre_pacing, paces, repolarisation, pre_pacing_steady)
+
+    if processes == None:
+        apd_list = np.asarray([severity_apd(s, m, p, m_str, cell_type, severity, *args[2:]) for severity in severities])
+    else:
+        pool = multiprocessing.Pool(processes, initializer = init_severity_worker, initargs = (m.code(), PCL, args))
+        try:
+            # map gives the results back in severity order
+            apd_list = np.asarray(pool.map(severity_worker, list(severities)))
+        finally:
+            pool.close()
+            pool.join()
+
+    return(severities, apd_list)
+
+def severity_onsets(m_str, cell_type, severity, pacing_list, time_per_stage = 10000, onset_tolerance = 5, pre_pacing = 200, repolarisation = 90):
+
+    # Alternans and 2:1 block onsets for one severity, from the adaptive dynamic protocol over
+    # pacing_list (longest PCL first), pre-paced at the first PCL
+    model = HF_base_model(m_str)
+    m = scaled_model(model)
+    constants = {model_registry.model_info(model)['cell_type_label'] : cell_type}
+    constants.update(HF_constants(m_str, cell_type, severity))
+    p = myokit.pacing.blocktrain(pacing_list[0], 0.5, offset=0, level=1.0, limit=0)
+    s = sim_cache.simulation(m, p)
+    set_constants(s, constants)
+    steady_cache.pre(s, m, p, pre_pacing*pacing_list[0], constants = constants, HF_model = m_str, beat = pacing_list[0])
+    pcls, stage_responses, stage_durations, onsets, simulated = adaptive_stages(s, pacing_list, time_per_stage, tolerance = onset_tolerance, repolarisation = repolarisation)
+    return(onset_pcls(onsets))
+
+def onset_pcls(onsets):
+    # Longest PCL with alternans and with 2:1 block (as adaptive_stages gives them), nan if none
+    return(np.asarray([onsets[response][0] if response in onsets else np.nan for response in ['Alternans', '2:1 block']], dtype = float))
+
+def severity_restitution(m_str, severities, cell_type = 1, number_S1 = 10, PCL_S1 = 1000, pre_pacing = 200, min_di = 10, max_di = 1000, number_di = 30, max_pcl = 1000, min_pcl = 150, number_stages = 10, time_per_stage = 10000, onset_tolerance = 5, repolarisation = 90, processes = None):
+
+    # Restitution slope and onsets over severities for HF model m_str (e.g. 'Ord_HF_Gomez').
+    # Returns severities, the maximum S1-S2 restitution gradient at each severity and the onset
+    # PCLs, one row per severity with columns alternans and 2:1 block (nan where not found).
+    # processes: S1-S2 DIs run on this many worker processes
+    severities = np.asarray(severities, dtype = float)
+    model = HF_base_model(m_str)
+    HF_model = m_str.split('_HF_')[1]
+    pacing_list = np.logspace(np.log10(min_pcl), np.log10(max_pcl), num = number_stages, base = 10.0)[::-1]
+    pacing_list = [int(i) for i in pacing_list]
+
+    slopes = []
+    onsets = []
+    for severity in severities:
+        di_list, apd_list, max_grad = s1s2_protocol(model, number_S1, PCL_S1, pre_pacing, min_di, max_di, number_di, repolarisation, cell_type, HF_model = HF_model, plot_from_function = False, processes = processes, HF_severity = severity)
+        slopes.append(max_grad)
+        onsets.append(severity_onsets(m_str, cell_type, severity, pacing_list, time_per_stage, onset_tolerance, pre_pacing, repolarisation))
+        print 'Severity {}: restitution slope {}, alternans onset {} ms, 2:1 block onset {} ms'.format(np.round(severity, 2), np.round(max_grad, 2), onsets[-1][0], onsets[-1][1])
+    return(severities, np.asarray(slopes), np.asarray(onsets))
+
+# Main function for testing
+def main():
+    cell_types = {0:'Endocardial', 1: 'Epicardial', 2: 'Mid-myocardial'}
+    cell_type = 0
+    PCL = 1000
+    severities = np.linspace(0, 1.5, 50)
+
+    pl.figure()
+    for m_str in ['Ord_HF_Gomez', 'Ord_HF_Elshrif']:
+        severities, apd_list = severity_sweep(m_str, severities, cell_type = cell_type, PCL = PCL, processes = multiprocessing.cpu_count())
+        pl.plot(severities, apd_list[:, -1])
+    pl.axvline(1, color = 'k', linestyle = '--')
+    pl.legend(['HF Gomez', 'HF Elshrif'])
+    pl.xlabel('HF severity (0 healthy, 1 HF model)')
+    pl.ylabel('APD 90 (ms)')
+    pl.title("O'hara (2011) {} cell at {} ms PCL".format(cell_types[cell_type], PCL))
+
+    # Restitution slope and alternans / 2:1 block onsets over a coarser set of severities
+    severities, slopes, onsets = severity_restitution('Ord_HF_Gomez', np.linspace(0, 1.5, 7), cell_type = cell_type, processes = multiprocessing.cpu_count())
+    pl.figure()
+    pl.subplot(2, 1, 1)
+    pl.plot(severities, slopes, 'x-')
+    pl.axhline(1, color = 'k', linestyle = ':')
+    pl.ylabel('Max S1-S2 restitution slope')
+    pl.subplot(2, 1, 2)
+    pl.plot(severities, onsets, 'x-')
+    pl.legend(['Alternans', '2:1 block'])
+    pl.xlabel('HF severity (0 healthy, 1 HF model)')
+    pl.ylabel('Onset PCL (ms)')
+    pl.show()
+
+if __name__ == "__main__":
+    main()
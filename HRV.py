@@ -2,6 +2,9 @@
 import myokit
 import matplotlib.pyplot as pl
 from manual_APD import ap_duration
+from pacing_protocol import PacingProtocol, beat_table, trace_beat_table
+from scenarios import scenario, run_scenarios, run_trace, run_window_apd, run_beat_table
+import model_registry
 import numpy as np
 from HF_model import *
 
@@ -10,44 +13,29 @@ from HF_model import *
 ## -------------------------------------------------------------------------- ##
 
 # Plots for protocol, APs and restitution curve
-def HRV(model, HF_model, number_runs = 50, cell_type = 1, noise = False, AP_plot = False, protocol_plot = True, restitution_curve = True, APD_time_plot = False):
-
-    cell_types = {0:'Endocardial', 1: 'Epicardial', 2: 'Mid-myocardial'}
-    if model == 'tentusscher-2006':
-        label = 'cell.type'
-        name  = 'Ten-Tusscher (2006)'
-        HF_label = 'TT'
-    elif model == 'grandi-2010':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010)'
-        HF_label = 'GPB'
-    elif model == 'grandi-2010_modified':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010) with late sodium channel'
-        HF_label = 'GPB'
-    elif model == 'ohara-2011':
-        label = 'cell.mode'
-        name = "O'hara (2011)"
-        HF_label = 'Ord'
-    elif model == 'ohara-cipa-v1-2017.mmt':
-        label = 'cell.celltype'
-        name = "O'hara- CiPA (2017)"
-        HF_label = 'Ordcipa'
-
-    m = myokit.load_model('{}.mmt'.format(model))
-    models_HF = {'Ord_HF_Gomez' : Ord_HF_Gomez, 'Ord_HF_Elshrif' : Ord_HF_Elshrif, 'GPB_HF_Gomez' : GPB_HF_Gomez, 'GPB_HF_Gomez': GPB_HF_Moreno, 'TT_HF_Lu' : TT_HF_Lu}
+# window (ms): run in windows of this length and analyse each as it comes, so the full
+# trace is never held in memory (no AP plot in this case)
+# beat_log: run beat by beat, keeping only the state at each stimulus and the APD of each beat
+# (beat_log.BeatTable, no AP plot either). The tables for healthy, HF at rest and HF 6-min walk
+# are returned
+# processes: run healthy, HF at rest and HF 6-min walk on this many worker processes at the same
+# time (scenarios.run_scenarios), None for one after another
+def HRV(model, HF_model, number_runs = 50, cell_type = 1, noise = False, AP_plot = False, protocol_plot = True, restitution_curve = True, APD_time_plot = False, window = None, beat_log = False, processes = None):
+
+    # Cell type constant, name and HF model names from the registry
+    info = model_registry.model_info(model)
+    label = info['cell_type_label']
+    name = info['name']
+    cell_types = info['cell_types']
+    model_registry.check_cell_type(model, cell_type)
+
+    m = model_registry.load_model(model)
+    # HF model: base model with scale constants, HF changes set as constants on the simulation
     if HF_model != None:
-        m_str = '{}_HF_{}'.format(HF_label, HF_model)
-        m_func = models_HF[m_str]
-        hf_m = m_func(cell_type)
-
-
-    # Protocol
-    p = myokit.Protocol()
-    hf_p = myokit.Protocol()
-    hf_6minwalk_p = myokit.Protocol()
+        m_str = model_registry.HF_model_name(model, HF_model)
+        hf_m = scaled_model(HF_base_model(m_str))
+        hf_constants = {label : cell_type}
+        hf_constants.update(HF_constants(m_str, cell_type))
 
 
     # 0.15-0.4Hz breathing rate (9-24 breaths a minute / 2500ms - 6666ms)
@@ -83,57 +71,53 @@ def HRV(model, HF_model, number_runs = 50, cell_type = 1, noise = False, AP_plot
     pacing_list = [np.round(60*1000.0/element,0) for element in hr_pacing_list]
     hf_pacing_list = [np.round(60*1000.0/element,0)  for element in hf_hr_pacing_list]
     exercise_pacing_list = [np.round(60*1000.0/element,0)  for element in hf_6minwalk_pacing_list]
-    beats_per_pace = 1
-
-    # Setting initital offset to zero
-    offset = 0
-    hf_offset = 0
-    hf_6minwalk_offset = 0
-
-    # Empty array to store offsets of new pacing in
-    offset_array = []
-    hf_offset_array = []
-    hf_6minwalk_offset_array =[]
-
-    # Array to store every PCL in
-    pace_array = []
-    hf_pace_array = []
-    hf_6minwalk_pace_array = []
-
-    for number in range(0, number_runs):
-        # Create protocol for healthy heart pacing
-        for pacing in pacing_list:
-            if noise == True:
-                pacing = np.round(np.random.normal(0, 5) + pacing,0)
-            p.schedule(1, start = offset, duration = 0.5, period = pacing, multiplier = beats_per_pace)
-            offset += beats_per_pace*pacing
-            pace_array.append(pacing)
-            offset_array.append(offset)
-        # Create protocol for HF at rest
-        for pacing in hf_pacing_list:
-            hf_p.schedule(1, start = hf_offset, duration = 0.5, period = pacing, multiplier = beats_per_pace)
-            hf_offset += beats_per_pace*pacing
-            hf_pace_array.append(pacing)
-            hf_offset_array.append(hf_offset)
-        # Create protocol for HF during final minutes of 6-min walk test
-        for pacing in exercise_pacing_list:
-            hf_6minwalk_p.schedule(1, start = hf_6minwalk_offset, duration = 0.5, period = pacing, multiplier = beats_per_pace)
-            hf_6minwalk_offset += beats_per_pace*pacing
-            hf_6minwalk_pace_array.append(pacing)
-            hf_6minwalk_offset_array.append(hf_6minwalk_offset)
-
-
-    ## Create and run simulation for healthy ventricular cell model ##
-    ## ------------------------------------------------------------ ##
-
-    s = myokit.Simulation(m, p)
-    s.set_constant(label, cell_type)
-    s.pre(np.sum(pacing_list)*10)
-    s.reset()
-    d = s.run(offset, log = ['membrane.V','engine.time'])
-    start, duration, thresh = ap_duration(d, number_runs*len(pacing_list), repolarisation = 90)
-
-    if AP_plot != False:
+
+    # Cycle length of every beat, number_runs of each cycle
+    pcls = np.tile(pacing_list, number_runs)
+    if noise == True:
+        # Fluctuations around the healthy pacing values
+        pcls = np.round(np.random.normal(0, 5, len(pcls)) + pcls, 0)
+    healthy = PacingProtocol(pcls)
+    hf_rest = PacingProtocol(np.tile(hf_pacing_list, number_runs))
+    hf_6minwalk = PacingProtocol(np.tile(exercise_pacing_list, number_runs))
+
+    # Protocols, end of each and PCL and end time of every beat
+    p, offset, pace_array, offset_array = healthy.protocol(), healthy.end, healthy.pcl, healthy.start + healthy.pcl
+    hf_p, hf_offset, hf_pace_array, hf_offset_array = hf_rest.protocol(), hf_rest.end, hf_rest.pcl, hf_rest.start + hf_rest.pcl
+    hf_6minwalk_p, hf_6minwalk_offset, hf_6minwalk_pace_array, hf_6minwalk_offset_array = hf_6minwalk.protocol(), hf_6minwalk.end, hf_6minwalk.pcl, hf_6minwalk.start + hf_6minwalk.pcl
+
+    ## Create and run simulations for healthy, HF at rest and HF 6-min walk ##
+    ## --------------------------------------------------------------------- ##
+
+    # The three are independent, run at the same time on processes worker processes
+    if window != None:
+        # One column (APD 90), NaN where not repolarised, so APs and durations line up
+        run, args = run_window_apd, [(window, [90])]*3
+    elif beat_log == True:
+        run, args = run_beat_table, [(pace_array, 90), (hf_pace_array, 90), (hf_6minwalk_pace_array, 90)]
+    else:
+        run, args = run_trace, [(90,)]*3
+    results = run_scenarios([
+        scenario(m, p, offset, {label : cell_type}, np.sum(pacing_list)*10, run = run, args = args[0]),
+        scenario(hf_m, hf_p, hf_offset, hf_constants, np.sum(hf_pacing_list)*10, HF_model = HF_model, run = run, args = args[1]),
+        scenario(hf_m, hf_6minwalk_p, hf_6minwalk_offset, hf_constants, np.sum(exercise_pacing_list)*10, HF_model = HF_model, run = run, args = args[2]),
+        ], processes)
+    # Trace, beat table or None for each
+    (start, duration, thresh), d = results[0]
+    (hf_start, hf_duration, hf_thresh), hf_d = results[1]
+    (hf_6minwalk_start, hf_6minwalk_duration, hf_6minwalk_thresh), hf_6minwalk_d = results[2]
+
+    # Beat table of each (PCL before each beat, APD...), for the restitution and APD plots
+    tables = []
+    for pacing, ((onset, apd, apd_thresh), output) in zip([healthy, hf_rest, hf_6minwalk], results):
+        if beat_log == True:
+            tables.append(beat_table(pacing, output['onset'], output['apd'], output['peak'], output['resting']))
+        elif window != None:
+            tables.append(beat_table(pacing, onset[:len(apd), 0], apd[:, 0]))
+        else:
+            tables.append(trace_beat_table(output, pacing, repolarisation = 90))
+
+    if AP_plot != False and window == None and beat_log == False:
         # Plot APs for healthy ventricular cell model
         pl.figure()
         pl.plot(d['engine.time'],d['membrane.V'])
@@ -146,19 +130,10 @@ def HRV(model, HF_model, number_runs = 50, cell_type = 1, noise = False, AP_plot
             length_includes_head=True, color = 'green')
             pl.text(start[i] + 20, -72, str(pace_array[i]))
 
-    ## Create and run simulation for HF at rest ##
-    ## ---------------------------------------- ##
+    ## APs for HF at rest ##
+    ## ------------------- ##
 
-    hf_s = myokit.Simulation(hf_m, hf_p)
-    hf_s.set_constant(label, cell_type)
-    hf_s.pre(np.sum(hf_pacing_list)*10)
-    hf_s.reset()
-    hf_d = hf_s.run(hf_offset, log = ['membrane.V','engine.time'])
-    # Calculate APDs
-    hf_start, hf_duration, hf_thresh = ap_duration(hf_d, number_runs*len(pacing_list), repolarisation = 90)
-
-
-    if AP_plot != False:
+    if AP_plot != False and window == None and beat_log == False:
         # Plot APs for HF ventricular cell model at rest
         pl.figure()
         pl.plot(hf_d['engine.time'],hf_d['membrane.V'])
@@ -171,17 +146,10 @@ def HRV(model, HF_model, number_runs = 50, cell_type = 1, noise = False, AP_plot
             pl.text(hf_start[i] + 20, -72, str(hf_pace_array[i]))
 
 
-    ## Create and run simulation for HF during final minutes of 6 min walk test ##
-    ## ------------------------------------------------------------------------ ##
+    ## APs for HF during final minutes of 6 min walk test ##
+    ## -------------------------------------------------- ##
 
-    hf_6minwalk_s = myokit.Simulation(hf_m, hf_6minwalk_p)
-    hf_6minwalk_s.set_constant(label, cell_type)
-    hf_6minwalk_s.pre(np.sum(exercise_pacing_list)*10)
-    hf_6minwalk_s.reset()
-    hf_6minwalk_d = hf_6minwalk_s.run(hf_6minwalk_offset, log = ['membrane.V','engine.time'])
-    hf_6minwalk_start, hf_6minwalk_duration, hf_6minwalk_thresh = ap_duration(hf_6minwalk_d, number_runs*len(pacing_list), repolarisation = 90)
-
-    if AP_plot != False:
+    if AP_plot != False and window == None and beat_log == False:
         # Plot APs for HF ventricular cell model 6 min walk
         pl.figure()
         pl.plot(hf_6minwalk_d['engine.time'],hf_6minwalk_d['membrane.V'])
@@ -216,11 +184,11 @@ def HRV(model, HF_model, number_runs = 50, cell_type = 1, noise = False, AP_plot
 
     if restitution_curve == True:
         pl.figure()
-        if len(duration)< len(pace_array):
-            pace_array = pace_array[:-1]
-        pl.plot(pace_array[len(pace_array)/2 -1:-1], duration[len(pace_array)/2:], '.')
-        pl.plot(hf_pace_array[len(pace_array)/2 -1: -1], hf_duration[len(pace_array)/2 :], '.')
-        pl.plot(hf_6minwalk_pace_array[len(pace_array)/2 -1:-1], hf_6minwalk_duration[len(pace_array)/2:], '.')
+        for table in tables:
+            # Second half of the beats, those with an AP that repolarised
+            beats = table['captured'] & ~np.isnan(table['apd'])
+            beats[:len(beats)/2] = False
+            pl.plot(table['pcl'][beats], table['apd'][beats], '.')
         pl.xlabel('PCL (ms)')
         pl.ylabel('APD (ms)')
         pl.title('Restitution Curves for Dynamic Protocol based on HRV')
@@ -231,15 +199,18 @@ def HRV(model, HF_model, number_runs = 50, cell_type = 1, noise = False, AP_plot
 
     if APD_time_plot == True:
         pl.figure()
-        pl.plot(offset_array, duration,'.-')
-        pl.plot(hf_offset_array, hf_duration,'.-')
-        pl.plot(hf_6minwalk_offset_array, hf_6minwalk_duration,'.-')
+        for table in tables:
+            beats = table['captured'] & ~np.isnan(table['apd'])
+            pl.plot(table['stimulus'][beats], table['apd'][beats],'.-')
         pl.xlabel('Time (ms)')
         pl.ylabel('APD (ms)')
         pl.title('APD varying over time with the HRV protocol')
     # Show plots
     pl.show()
 
+    if beat_log == True:
+        return(d, hf_d, hf_6minwalk_d)
+
 
 # Main function for testing
 def main():
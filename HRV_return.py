@@ -2,6 +2,11 @@
 import myokit
 import matplotlib.pyplot as pl
 from manual_APD import ap_duration
+from streaming_APD import run_windows
+from pacing_protocol import PacingProtocol, beat_table, trace_beat_table
+import model_registry
+import sim_cache
+import steady_cache
 import numpy as np
 from HF_model import *
 
@@ -10,39 +15,25 @@ from HF_model import *
 ## -------------------------------------------------------------------------- ##
 
 # Plots for protocol, APs and restitution curve
-def HRV_return(model, HF_model = None, HF_protocol = None, number_points_up = 30,number_runs = 50, cell_type = 0, restitution_curve = False , AP_plot = False, protocol_plot = True, max_PCL = None, min_PCL = None, average_init = None, APD_time_plot = False):
-
-    cell_types = {0:'Endocardial', 1: 'Epicardial', 2: 'Mid-myocardial'}
-    if model == 'tentusscher-2006':
-        label = 'cell.type'
-        name  = 'Ten-Tusscher (2006)'
-        HF_label = 'TT'
-    elif model == 'grandi-2010':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010)'
-        HF_label = 'GPB'
-    elif model == 'grandi-2010_modified':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010) with late sodium channel'
-        HF_label = 'GPB'
-    elif model == 'ohara-2011':
-        label = 'cell.mode'
-        name = "O'hara (2011)"
-        HF_label = 'Ord'
-    elif model == 'ohara-cipa-v1-2017':
-        label = 'cell.celltype'
-        name = "O'hara- CiPA (2017)"
-        HF_label = 'Ordcipa'
-
-    m = myokit.load_model('{}.mmt'.format(model))
-    models_HF = {'Ord_HF_Gomez' : Ord_HF_Gomez, 'Ord_HF_Elshrif' : Ord_HF_Elshrif, 'GPB_HF_Gomez' : GPB_HF_Gomez, 'GPB_HF_Gomez': GPB_HF_Moreno, 'TT_HF_Lu' : TT_HF_Lu,'Ordcipa_HF_Elshrif' : Ordcipa_HF_Elshrif, 'Ordcipa_HF_Gomez': Ordcipa_HF_Gomez}
+# window (ms): run in windows of this length and analyse each as it comes, so the full
+# trace is never held in memory (no AP plot in this case)
+def HRV_return(model, HF_model = None, HF_protocol = None, number_points_up = 30,number_runs = 50, cell_type = 0, restitution_curve = False , AP_plot = False, protocol_plot = True, max_PCL = None, min_PCL = None, average_init = None, APD_time_plot = False, window = None):
+
+    # Cell type constant, name and HF model names from the registry
+    info = model_registry.model_info(model)
+    label = info['cell_type_label']
+    name = info['name']
+    cell_types = info['cell_types']
+    model_registry.check_cell_type(model, cell_type)
+
+    m = model_registry.load_model(model)
+    constants = {label : cell_type}
     models_HF_col = {'Ord_HF_Gomez' : 'orange', 'Ord_HF_Elshrif' : 'limegreen', 'GPB_HF_Gomez' : 'orange', 'GPB_HF_Moreno': 'm', 'TT_HF_Lu' : 'gold', 'Ordcipa_HF_Elshrif' : 'limegreen', 'Ordcipa_HF_Gomez': 'orange'}
     if HF_model != None:
-        m_str = '{}_HF_{}'.format(HF_label, HF_model)
-        m_func = models_HF[m_str]
-        m = m_func(cell_type)
+        m_str = model_registry.HF_model_name(model, HF_model)
+        # Base model with scale constants, HF changes set as constants on the simulation
+        m = scaled_model(HF_base_model(m_str))
+        constants.update(HF_constants(m_str, cell_type))
         HF_model_label = 'HF ' + HF_model
         if HF_protocol == 'HF':
             col = models_HF_col[m_str]
@@ -52,9 +43,6 @@ def HRV_return(model, HF_model = None, HF_protocol = None, number_points_up = 30
         col = 'b'
 
 
-    # Protocol
-    p = myokit.Protocol()
-
     # Using sin wave to simulate step protocol
     points = np.linspace(0,2*np.pi, num  = number_points_up, endpoint = False)
     hr_pacing_list = []
@@ -93,36 +81,28 @@ def HRV_return(model, HF_model = None, HF_protocol = None, number_points_up = 30
 
     # Generate integer pacing values from instantaneous HR
     pacing_list = [np.round(60*1000.0/element,0) for element in hr_pacing_list]
-    beats_per_pace = 1
-
-    # Setting initital offset to zero
-    offset = 0
-
-    # Empty array to store offsets of new pacing in
-    offset_array = []
-
-    # Array to store every PCL in
-    pace_array = []
 
-    for number in range(0, number_runs):
-        for pacing in pacing_list:
-            # Create protocol schedule
-            p.schedule(1, start = offset, duration = 0.5, period = pacing, multiplier = beats_per_pace)
-            offset += beats_per_pace*pacing
-            pace_array.append(pacing)
-            offset_array.append(offset)
+    # Protocol of number_runs cycles, PCL and end time of every beat
+    pacing = PacingProtocol(np.tile(pacing_list, number_runs))
+    p, offset, pace_array, offset_array = pacing.protocol(), pacing.end, pacing.pcl, pacing.start + pacing.pcl
 
     ## Create and run simulation for healthy ventricular cell model ##
     ## ------------------------------------------------------------ ##
 
-    s = myokit.Simulation(m, p)
-    s.set_constant(label, cell_type)
-    s.pre(np.sum(pacing_list)*20)
+    s = sim_cache.simulation(m, p)
+    set_constants(s, constants)
+    steady_cache.pre(s, m, p, np.sum(pacing_list)*20, constants = constants, HF_model = HF_model)
     s.reset()
-    d = s.run(offset, log = ['membrane.V','engine.time'])
-    start, duration, thresh = ap_duration(d, number_runs*len(pacing_list), repolarisation = 90)
+    if window != None:
+        # One column (APD 90), NaN where not repolarised, so APs and durations line up
+        start, duration, thresh = run_windows(s, offset, window, repolarisation = [90], aligned = True)
+        table = beat_table(pacing, start[:len(duration), 0], duration[:, 0])
+    else:
+        d = s.run(offset, log = ['membrane.V','engine.time'])
+        start, duration, thresh = ap_duration(d, repolarisation = 90)
+        table = trace_beat_table(d, pacing, repolarisation = 90)
 
-    if AP_plot != False:
+    if AP_plot != False and window == None:
         # Plot APs for healthy ventricular cell model
         pl.figure()
         pl.plot(d['engine.time'],d['membrane.V'])
@@ -149,25 +129,17 @@ def HRV_return(model, HF_model = None, HF_protocol = None, number_points_up = 30
         #pl.title('Dynamic Pacing Protocol to mimic HRV')
         pl.legend([HF_model_label + protocol_label])
 
-    # If multiple stimuli in one AP, messes up using offsets, instead record starts of APs and pacing at that start
-    offset_array = np.asarray(offset_array)
-    offset_array1 = np.insert(offset_array,0,0)
-    pcl_start = np.zeros(len(duration))
-    for i in range(1,len(duration)):
-        z = np.nonzero(offset_array1 < start[i-1])[0][-1]
-        pcl_start[i] = pace_array[z]
-
-
+    # PCL before each AP and its APD, from the beat table (beats with an AP that repolarised)
+    beats = table['captured'] & ~np.isnan(table['apd'])
+    pcl_start = table['pcl'][beats]
+    duration = table['apd'][beats]
 
     ## APD vs time plot ##
     ## ---------------- ##
-    start = [element/1000.0 for element in start]
 
     if APD_time_plot == True:
         pl.figure()
-        if len(start) > len(duration):
-            start = start[0:-1]
-        pl.plot(start, duration,'.-', color = col)
+        pl.plot(table['onset'][beats]/1000.0, duration,'.-', color = col)
         pl.xlabel('Time (sec)')
         pl.ylabel('APD (ms)')
         #pl.title('APD varying over time with the HRV protocol')
@@ -2,8 +2,10 @@
 import myokit
 import matplotlib.pyplot as pl
 from manual_APD import ap_duration
+import multiprocessing
 import numpy as np
 from HF_model import Ord_HF_Gomez
+from restitution_protocols import s1s2_protocol
 
 ## O'hara Restitution
 ## S1S2 steady state S1 pacing at 1000ms, single
@@ -11,63 +13,27 @@ from HF_model import Ord_HF_Gomez
 # Using APD 90 for final S1 AP to calculate DI
 percent = 90
 bcl = 1000
-m = myokit.load_model('ohara-2011.mmt')
 
-# HF switch
+# HF switch (Gomez)
 HF = False
-if HF:
-    m = Ord_HF_Gomez()
 
-# Set indefinitely recurring event of constant bcl
-p = myokit.pacing.blocktrain(bcl, 0.5, offset=0, level=1.0, limit=0)
-s = myokit.Simulation(m, p)
-
-# Set cell type
+# Cell type
 cell_types = {'Endocardial': 0, 'Epicardial' : 1, 'Mid-myocardial' : 2}
 cell_type = 'Endocardial'
-s.set_constant('cell.mode', cell_types[cell_type])
 
-# Pre-pace with these conditions
-s.pre(100*bcl)
-
-# Set number of S1 beats to record after pre-pacing
+# 3 S1 beats after pre-pacing, S2 beat after the final S1 AP + DI. DI points run in parallel,
+# each from the state at the end of the S1 beats
+# Have lines on graph for APD 30, 50, 70 and 90, all from the same S2 simulations
 paces  = 3
-p = myokit.pacing.blocktrain(bcl, 0.5, offset=0, level=1.0, limit=paces)
-d = s.run(paces*bcl)
-
-# Calculate end of APD for final S1 beat. Can add DI to this value for S2 start time
-start, duration, thresh = ap_duration(d, paces, repolarisation = percent)
-end_final_s1 = start[-1] + duration[-1]
+percents = [90, 70, 50, 30]
+di_list, apd_duration, max_grad = s1s2_protocol('ohara-2011', paces, PCL_S1 = bcl, pre_pacing = 100, min_di = 10, max_di = 10000, number_di = 30,
+    repolarisation = percents, cell_type = cell_types[cell_type], log_scale = True, HF_model = 'Gomez' if HF else None, plot_from_function = False,
+    processes = multiprocessing.cpu_count(), end_repolarisation = percent)
 
-# Reset so haven't run 3 paces already
-s.reset()
 pl.figure()
-
-# Have lines on graph for APD 30, 50, 70 and 90
-for percent in [90, 70, 50, 30]:
-    di_list = []
-    apd_duration = []
-    # Equally space points on base 10 log scale
-    for di in np.logspace(1,4, num = 30, base = 10.0):
-
-        # Finite number of S1 beats
-        p = myokit.pacing.blocktrain(bcl, 0.5, offset=0, level=1.0, limit=paces)
-        # Schedule S2 beat for the end of last AP (using APD 90) + given DI
-        p.schedule(1, end_final_s1 + di, 0.5, bcl, 1)
-
-        # Set protocol, run and calculate APDs
-        s.set_protocol(p)
-        d = s.run((paces + 1)*bcl + di)
-        start, duration, thresh = ap_duration(d, paces + 2, repolarisation = percent)
-
-        # Storing apd and DI for this pacing length
-        apd_duration.append(duration[-1])
-        di_list.append(di)
-        s.reset()
-
-    # Plot line once iterated over all DI values
-    pl.plot(di_list,apd_duration)
-    pl.plot(di_list,apd_duration, 'x', label = '_nolegend_')
+# Plot line for each APD once iterated over all DI values
+pl.plot(di_list,apd_duration)
+pl.plot(di_list,apd_duration, 'x', label = '_nolegend_')
 
 # Plot S1S2 protocol restitution curve
 pl.xlabel('Diastole interval (ms)')
@@ -124,7 +90,7 @@ d = s.run(offset, log = ['membrane.V','engine.time'])
 logint = p.create_log_for_interval(0, p.characteristic_time(), for_drawing = True)
 
 # Use ap_duration function to calculate start times and durations
-start, duration, thresh = ap_duration(d, 30000*len(pacing_list), repolarisation = 95, log_for_interval = logint)
+start, duration, thresh = ap_duration(d, repolarisation = 95)
 
 # First offset equal to zero, so remove first entry from the list
 offset_list = offset_list[1:]
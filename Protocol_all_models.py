@@ -3,6 +3,7 @@ import myokit
 import matplotlib.pyplot as pl
 from manual_APD import ap_duration
 import numpy as np
+import model_registry
 from HF_model import Ord_HF_Gomez
 from restitution_protocols import *
 
@@ -14,24 +15,8 @@ models = ['tentusscher-2006', 'grandi-2010_modified', 'ohara-2011', 'ohara-cipa-
 i = 1
 pl.figure()
 for model in models:
-    m = myokit.load_model('{}.mmt'.format(model))
-    p = myokit.Protocol()
-    s = myokit.Simulation(m,p)
-    if model == 'tentusscher-2006':
-        label = 'cell.type'
-        HF_model = 'Lu'
-    elif model == 'grandi-2010':
-        label = 'type.epi'
-        HF_model = 'Gomez'
-    elif model == 'grandi-2010_modified':
-        label = 'type.epi'
-        HF_model = 'Gomez'
-    elif model == 'ohara-2011':
-        label = 'cell.mode'
-        HF_model = 'Gomez'
-    elif model == 'ohara-cipa-v1-2017':
-        label = 'cell.celltype'
-        HF_model = 'Gomez'
+    # First HF model of each model in the registry (Lu for Ten-Tusscher, Gomez for the others)
+    HF_model = model_registry.model_info(model)['HF_models'][0]
     # Not mid-myocardial cells
     for cell_type in range(0,2):
         # Each model on the same line
@@ -48,7 +33,7 @@ for model in models:
         di_list, apd_list, max_grad = s1s2_protocol(model, number_S1 = 5, PCL_S1 = 1000, pre_pacing = 50, min_di = 10, max_di = 1000, number_di = 30, repolarisation = 90, cell_type = cell_type, log_scale = False, HF_model = HF_model, plot_from_function = False)
         pl.plot(di_list,apd_list, 'r.-')
 
-        if model == 'ohara-2011' or model == 'ohara-cipa-v1-2017':
+        if 'Elshrif' in model_registry.model_info(model)['HF_models']:
             di_list, apd_list, max_grad = s1s2_protocol(model, number_S1 = 5, PCL_S1 = 1000, pre_pacing = 50, min_di = 10, max_di = 1000, number_di = 30, repolarisation = 90, cell_type = cell_type, log_scale = False, HF_model = 'Elshrif', plot_from_function = False)
             pl.plot(di_list,apd_list, 'c.-')
             pl.legend(['Normal','HF {} '.format(HF_model), 'HF Elshrif'])
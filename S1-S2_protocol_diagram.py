@@ -18,7 +18,7 @@ p.schedule(1,100,0.5,pcl,3)
 p.schedule(1,2*pcl + 500, 0.5, pcl, 1)
 s.set_protocol(p)
 d = s.run(4*pcl)
-start, duration, thresh = ap_duration(d, 4)
+start, duration, thresh = ap_duration(d)
 
 pl.figure()
 pl.plot(d['engine.time'],d['membrane.V'])
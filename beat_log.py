@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import matplotlib.pyplot as pl
+import myokit
+import numpy as np
+from streaming_APD import StreamingAPD
+
+## Per-beat logging ##
+## ---------------- ##
+
+# Ion drift, steady state checks and APD return maps only need one row per beat, but s.run with a
+# log keeps every solver step of the whole protocol. run_beats runs one beat at a time and keeps
+# the full state at each stimulus plus a few scalars per beat in a BeatTable, so memory grows by
+# one row per beat (a 1500 beat HRV run is a few hundred kB, mostly the state vectors).
+
+# With scalars on, the voltage of the beat being run is logged and reduced to its peak and resting
+# potential before the next beat starts. APDs are found across beats by a StreamingAPD, which keeps
+# the samples since the end of the last repolarised AP, so an AP still going at the next stimulus
+# (APD longer than the PCL, 2:1 block) is measured once it repolarises, as ap_duration on the
+# whole trace would (segmentation threshold from the first beat, see streaming_APD). Each AP is
+# put in the row of the beat its onset is in. With scalars off nothing is logged
+# (myokit.LOG_NONE) and only the states are kept
+
+# Scalar columns of the table, one value per beat (nan where not found, e.g. no AP)
+scalar_columns = ['time', 'pcl', 'onset', 'apd', 'thresh', 'peak', 'resting']
+
+class BeatTable(object):
+
+    # Rows are beats: state at the stimulus (one column per state variable) and the scalar
+    # columns. Arrays are grown by doubling, so adding a row is cheap
+
+    def __init__(self, number_states, state_names = None, size = 64):
+        self.number = 0
+        self.state_names = state_names
+        self.states = np.zeros((size, number_states))
+        self.scalars = np.zeros((size, len(scalar_columns)))*np.nan
+
+    def add(self, state, **scalars):
+        if self.number == len(self.states):
+            self.states = np.concatenate((self.states, np.zeros(self.states.shape)))
+            self.scalars = np.concatenate((self.scalars, np.zeros(self.scalars.shape)*np.nan))
+        self.states[self.number] = state
+        for key in scalars:
+            self.scalars[self.number, scalar_columns.index(key)] = scalars[key]
+        self.number += 1
+
+    def __len__(self):
+        return(self.number)
+
+    def __getitem__(self, key):
+        # A scalar column by name, or a state variable column by name (e.g. 'sodium.nai')
+        if key in scalar_columns:
+            return(self.scalars[:self.number, scalar_columns.index(key)])
+        if self.state_names is None or key not in self.state_names:
+            raise KeyError('No column {} in beat table'.format(key))
+        return(self.states[:self.number, self.state_names.index(key)])
+
+    def state(self):
+        # States at each stimulus, one row per beat
+        return(self.states[:self.number])
+
+    def ap_duration(self):
+        # [onset, duration, thresh] as manual_APD.ap_duration, one AP per beat. Durations of
+        # beats without repolarisation are left out, as ap_duration does
+        apd = self['apd']
+        found = ~np.isnan(self['onset'])
+        return[self['onset'][found], apd[~np.isnan(apd)], self['thresh'][~np.isnan(apd)]]
+
+    def save(self, filename):
+        # .npz with states, state names and the scalar columns
+        columns = dict((key, self[key]) for key in scalar_columns)
+        np.savez(filename, states = self.state(), state_names = np.asarray(self.state_names or []), **columns)
+
+def run_beats(s, pcls, scalars = True, repolarisation = 90, state_names = None, voltage = 'membrane.V', time = 'engine.time'):
+
+    # Run s for one beat of each PCL in pcls, from its current time and state (each beat should
+    # start at a stimulus of the protocol set on s). Returns a BeatTable with a row per beat
+    table = BeatTable(len(s.state()), state_names, size = max(len(pcls), 1))
+    analyser = StreamingAPD(repolarisation = [repolarisation], aligned = True)
+    for pcl in pcls:
+        start = s.time()
+        state = s.state()
+        if not scalars:
+            s.run(pcl, log = myokit.LOG_NONE)
+            table.add(state, time = start, pcl = pcl)
+            continue
+
+        # Trace of this beat only, reduced to the scalars and then dropped. The analyser keeps
+        # what it still needs of it
+        d = s.run(pcl, log = [voltage, time])
+        V = np.asarray(d[voltage], dtype = float)
+        table.add(state, time = start, pcl = pcl, peak = V.max(), resting = V.min())
+        analyser.add({'membrane.V' : V, 'engine.time' : d[time]})
+        del d, V
+        add_aps(table, analyser)
+
+    if scalars:
+        analyser.finish()
+        add_aps(table, analyser)
+    return(table)
+
+def add_aps(table, analyser):
+    # Move the APs the analyser has finished since the last call into the rows of the beats their
+    # onsets are in (the first AP of a beat, if there are more)
+    columns = dict((key, scalar_columns.index(key)) for key in ['onset', 'apd', 'thresh'])
+    while analyser.onset:
+        onset = analyser.onset.pop(0)[:, 0]
+        duration = analyser.duration.pop(0)[:, 0]
+        thresh = analyser.thresh.pop(0)[:, 0]
+        rows = np.searchsorted(table['time'], onset, side = 'right') - 1
+        for i, row in enumerate(rows):
+            if row < 0 or not np.isnan(table.scalars[row, columns['onset']]):
+                continue
+            table.scalars[row, columns['onset']] = onset[i]
+            if i < len(duration) and not np.isnan(duration[i]):
+                table.scalars[row, columns['apd']] = duration[i]
+                table.scalars[row, columns['thresh']] = thresh[i]
+
+# Main function for testing
+def main():
+    # Ion drift over the first beats from the initial state, without a full trace
+    m = myokit.load_model('ohara-cipa-v1-2017.mmt')
+    pcl = 1000
+    beats = 300
+    p = myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=0)
+    s = myokit.Simulation(m, p)
+    table = run_beats(s, [pcl]*beats, state_names = [v.qname() for v in m.states()])
+    print '{} beats, table {} kB'.format(len(table), (table.states.nbytes + table.scalars.nbytes)/1024)
+
+    pl.figure()
+    pl.subplot(2, 1, 1)
+    pl.plot(table['sodium.nai'])
+    pl.ylabel('Na_i at stimulus (mM)')
+    pl.subplot(2, 1, 2)
+    pl.plot(table['apd'])
+    pl.xlabel('Beat')
+    pl.ylabel('APD 90 (ms)')
+    pl.show()
+
+if __name__ == "__main__":
+    main()
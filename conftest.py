@@ -0,0 +1,3 @@
+# Tests run without a display: plots go to a non-interactive backend
+import matplotlib
+matplotlib.use('Agg')
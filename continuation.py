@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+import myokit
+import matplotlib.pyplot as pl
+from manual_APD import ap_duration, state_change, steady_pre
+from shooting import anderson_steady, cycle_map
+import model_registry
+import sim_cache
+import numpy as np
+from HF_model import *
+
+## Continuation of periodic orbits across PCL ##
+## ------------------------------------------ ##
+
+# Bifurcation diagram (APD against PCL) from periodic orbits instead of 30 s of pacing per stage.
+# Starting from the steady state at the longest PCL, PCL is stepped down and each orbit is found
+# by shooting (shooting.anderson_steady) from the orbit at the previous PCL, which takes a few
+# beats per PCL. Orbits are found whether stable or not, so the period 1 branch is followed past
+# period doubling (unstable) as well as the period 2 branch that starts there.
+
+# Stability comes from the multipliers of the beat map (eigenvalues of its Jacobian), found with
+# a few Arnoldi steps, one beat each (Jacobian times vector by finite differences). Period
+# doubling is where a multiplier goes through -1. PCL steps get smaller as the largest multiplier
+# gets close to 1 in size, and larger away from it.
+
+# Columns of the branch table, one row per orbit
+columns = ['period', 'PCL', 'stable', 'APD_1', 'APD_2', 'multiplier', 'abs_multiplier', 'beats']
+
+def multipliers(F, x, number = 6, eps = 1e-3, abs_tol = 1e-6):
+
+    # Largest multipliers of map F at fixed point x, from number Arnoldi steps (number + 1 map
+    # evaluations). Variables are scaled by their size, so the perturbation is eps of each.
+    # Returns multipliers (largest first) and the eigenvector of the largest
+    scale = abs(x) + abs_tol
+    fx = F(x)
+    Q = np.zeros((len(x), number + 1))
+    H = np.zeros((number + 1, number))
+    q = np.random.RandomState(0).randn(len(x))
+    Q[:, 0] = q/np.linalg.norm(q)
+    for j in range(number):
+        # Jacobian (of the scaled map) times Q[:, j]
+        w = (F(x + eps*scale*Q[:, j]) - fx)/(eps*scale)
+        for i in range(j + 1):
+            H[i, j] = np.dot(Q[:, i], w)
+            w = w - H[i, j]*Q[:, i]
+        H[j + 1, j] = np.linalg.norm(w)
+        if H[j + 1, j] < 1e-12:
+            # Exact invariant subspace found
+            number = j + 1
+            break
+        Q[:, j + 1] = w/H[j + 1, j]
+
+    values, vectors = np.linalg.eig(H[:number, :number])
+    order = np.argsort(-abs(values))
+    vector = np.real(np.dot(Q[:, :number], vectors[:, order[0]]))*scale
+    return(values[order], vector)
+
+def orbit_apd(s, x, pcl, repolarisation = 90):
+    # APDs of the two beats from state x (the same for period 1, alternating for period 2).
+    # nan where there is no AP (2:1 block)
+    s.set_state(list(x))
+    s.set_time(0)
+    d = s.run(2*pcl, log = ['membrane.V','engine.time'])
+    start, duration, thresh = ap_duration(d, repolarisation = repolarisation)
+    apd = np.zeros(2)*np.nan
+    apd[:min(2, len(duration))] = duration[:2]
+    return(apd)
+
+def orbit(s, x, pcl, period, max_beats, number_multipliers):
+    # Orbit at pcl from guess x, and its multipliers. Returns state, beats, converged,
+    # multipliers and eigenvector of the largest
+    s.set_protocol(myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=0))
+    s.set_time(0)
+    s.set_state(list(x))
+    beats, period, change = anderson_steady(s, pcl, period, max_beats, check_beats = 0)
+    x = np.asarray(s.state(), dtype = float)
+    if change > 1:
+        return(x, beats, False, None, None)
+    s.set_time(0)
+    values, vector = multipliers(cycle_map(s, pcl, period), x, number_multipliers)
+    return(x, beats + period*(number_multipliers + 1), True, values, vector)
+
+def collapsed(s, x, pcl):
+    # True if orbit x of the period 2 map is a period 1 orbit
+    s.set_time(0)
+    return(state_change([x, cycle_map(s, pcl, 1)(x)], 1)[0] <= 1)
+
+def period_2_start(s, x, vector, pcl, max_beats, check_beats = 20):
+    # Pace onto the period 2 orbit from off period 1 orbit x, along the eigenvector of its
+    # multiplier near -1. Close to the orbit the state hardly changes over 2 beats, so check_beats
+    # are paced before checking for a steady state. Returns the state and the beats simulated
+    s.set_protocol(myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=0))
+    s.set_time(0)
+    s.set_state(list(x + 1e-2*vector/np.max(abs(vector)/(abs(x) + 1e-6))))
+    s.pre(check_beats*pcl)
+    beats, period, change = steady_pre(s, pcl, max_beats, max_period = 2)
+    return(np.asarray(s.state(), dtype = float), beats + check_beats)
+
+def follow_branch(s, x, period, max_pcl, min_pcl, max_step, min_step, max_beats, number_multipliers, repolarisation, beats_so_far = 0):
+
+    # Follow the orbits of one period from PCL max_pcl (x a guess of the orbit there) down to
+    # min_pcl. Returns the table rows, the first period doubling (PCL of the doubling, first PCL
+    # past it, state and eigenvector there) and the number of beats simulated
+    rows = []
+    doubling = None
+    pcl = float(max_pcl)
+    step = float(max_step)
+    previous = None
+    beats_total = beats_so_far
+    while pcl >= min_pcl:
+        x_new, beats, converged, values, vector = orbit(s, x, pcl, period, max_beats, number_multipliers)
+        beats_total += beats
+        if not converged:
+            # Step back to the last orbit with a smaller step
+            if previous == None or step/2 < min_step:
+                print 'Orbit not found at PCL {}, branch stopped'.format(pcl)
+                break
+            step = step/2
+            pcl = previous[0] - step
+            continue
+
+        if period == 2 and collapsed(s, x_new, pcl):
+            # Found the period 1 orbit (a fixed point of the period 2 map too). Pace onto the
+            # period 2 orbit from off the period 1 orbit, or skip this PCL if there is none
+            x_new, beats = period_2_start(s, x_new, vector, pcl, max_beats)
+            beats_total += beats
+            if collapsed(s, x_new, pcl):
+                pcl = pcl - step
+                continue
+            x_new, beats, converged, values, vector = orbit(s, x_new, pcl, period, max_beats, number_multipliers)
+            beats_total += beats
+            if not converged or collapsed(s, x_new, pcl):
+                pcl = pcl - step
+                continue
+
+        mu = values[0]
+        apd = orbit_apd(s, x_new, pcl, repolarisation)
+        beats_total += 2
+        rows.append([period, pcl, float(abs(mu) < 1), apd[0], apd[1], np.real(mu), abs(mu), beats_total])
+
+        # Period doubling: real multiplier through -1 between the last PCL and this one
+        if doubling == None and previous != None and np.real(mu) < -1 and abs(np.imag(mu)) < 1e-6 and previous[1] >= -1:
+            pcl_doubling = previous[0] + (pcl - previous[0])*(-1 - previous[1])/(np.real(mu) - previous[1])
+            doubling = (pcl_doubling, pcl, x_new, vector)
+
+        # Smaller steps close to a bifurcation
+        if abs(abs(mu) - 1) < 0.1:
+            step = max(step/2, min_step)
+        elif abs(abs(mu) - 1) > 0.3:
+            step = min(step*1.5, max_step)
+        previous = (pcl, np.real(mu) if abs(np.imag(mu)) < 1e-6 else 0)
+        x = x_new
+        pcl = pcl - step
+
+    return(rows, doubling, beats_total)
+
+def continuation(model, cell_type = 1, HF_model = None, HF_severity = 1.0, max_pcl = 1000, min_pcl = 150, max_step = 50, min_step = 2, pre_pacing = 1000, max_beats = 200, number_multipliers = 6, repolarisation = 90):
+
+    # Branch table (rows as in columns) of the period 1 orbits from max_pcl to min_pcl and the
+    # period 2 orbits from the first period doubling on, for a model, cell type and HF model
+    info = model_registry.model_info(model)
+    model_registry.check_cell_type(model, cell_type)
+    constants = {info['cell_type_label'] : cell_type}
+    if HF_model != None:
+        m_str = model_registry.HF_model_name(model, HF_model)
+        m = scaled_model(HF_base_model(m_str))
+        constants.update(HF_constants(m_str, cell_type, HF_severity))
+    else:
+        m = model_registry.load_model(model)
+
+    p = myokit.pacing.blocktrain(max_pcl, 0.5, offset=0, level=1.0, limit=0)
+    s = sim_cache.simulation(m, p)
+    set_constants(s, constants)
+
+    # Period 1 orbit at the longest PCL, nothing to follow from if it is not found
+    beats, period, change = anderson_steady(s, max_pcl, 1, pre_pacing)
+    if change > 1:
+        print 'Orbit not found at PCL {}, no branch'.format(max_pcl)
+        return(np.zeros((0, len(columns))))
+    x = np.asarray(s.state(), dtype = float)
+    rows, doubling, beats = follow_branch(s, x, 1, max_pcl, min_pcl, max_step, min_step, max_beats, number_multipliers, repolarisation, beats)
+
+    if doubling != None:
+        # Period 2 orbit next to the doubling, paced onto from off the period 1 orbit
+        pcl_doubling, pcl, x, vector = doubling
+        print 'Period doubling at PCL {} ms'.format(np.round(pcl_doubling, 1))
+        x, more_beats = period_2_start(s, x, vector, pcl, max_beats)
+        more_rows, more_doubling, beats = follow_branch(s, x, 2, pcl, min_pcl, max_step, min_step, max_beats, number_multipliers, repolarisation, beats + more_beats)
+        rows += more_rows
+
+    # One row per orbit, also when there are none
+    return(np.asarray(rows, dtype = float).reshape(-1, len(columns)))
+
+def save_branch(table, filename):
+    # Branch table to a csv file with the column names as header
+    np.savetxt(filename, table, delimiter = ',', header = ','.join(columns), comments = '')
+
+def plot_branch(table, colour = 'b'):
+    # APD against PCL, stable orbits solid, unstable dashed
+    for period in [1, 2]:
+        for stable, style in [(1, '-'), (0, '--')]:
+            rows = table[(table[:, 0] == period) & (table[:, 2] == stable)]
+            if len(rows) == 0:
+                continue
+            pl.plot(rows[:, 1], rows[:, 3], colour + style)
+            if period == 2:
+                pl.plot(rows[:, 1], rows[:, 4], colour + style)
+
+# Main function for testing
+def main():
+    model = 'ohara-cipa-v1-2017'
+    cell_type = 0
+    pl.figure()
+    for HF_model, colour in [(None, 'b'), ('Gomez', 'r')]:
+        table = continuation(model, cell_type = cell_type, HF_model = HF_model)
+        save_branch(table, '{}_{}_{}_branch.csv'.format(model, cell_type, HF_model))
+        if len(table) == 0:
+            continue
+        print '{} beats simulated for {} orbits'.format(int(table[-1, -1]), len(table))
+        plot_branch(table, colour)
+    pl.xlabel('PCL (ms)')
+    pl.ylabel('APD 90 (ms)')
+    pl.title("{} {} cell, stable (solid) and unstable (dashed) orbits".format(model_registry.model_info(model)['name'], model_registry.model_info(model)['cell_types'][cell_type]))
+    pl.show()
+
+if __name__ == "__main__":
+    main()
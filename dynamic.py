@@ -53,10 +53,11 @@ while pcl > min_pcl:
 s = myokit.Simulation(m, p)
 
 # Run the simulation with final offset value, equal to time passed for whole protocol
-d = s.run(offset)
+# Only the variables ap_duration needs are logged, not every variable
+d = s.run(offset, log = ['membrane.V','engine.time'])
 
 # Use ap_duration function to calculate start times and durations
-start, duration = ap_duration(d, paces*beats_per_pace)
+start, duration = ap_duration(d)
 
 # First offset equal to zero, so remove first entry from the list
 offset_list = offset_list[1:]
@@ -35,7 +35,7 @@ s.set_constant('cell.mode', cell_types[cell_type])
 d = s.run(offset, log = ['membrane.V','engine.time'])
 
 # Use ap_duration function to calculate start times and durations
-start, duration, thresh = ap_duration(d, 30000 + 3000, repolarisation = 90)
+start, duration, thresh = ap_duration(d, repolarisation = 90)
 
 pl.figure()
 pl.plot(d['engine.time'],d['membrane.V'])
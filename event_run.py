@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import matplotlib.pyplot as pl
+import myokit
+import numpy as np
+from manual_APD import ap_duration
+
+## Runs that stop once the measured AP is over ##
+## ------------------------------------------ ##
+
+# S1-S2 style protocols run for a fixed time that is mostly diastole after the AP being measured.
+# run_until runs a simulation in short chunks and stops after the chunk in which a stop condition
+# is met, with the fixed time as a cap. The solver is not told about the condition, so the run
+# goes up to chunk ms past it
+
+def after_repolarisation(k = 1, AP_threshold = -80, repolarisation = None, voltage = 'membrane.V'):
+    # Stop condition: the k-th AP of the run (upward crossing of AP_threshold) has repolarised.
+    # With repolarisation (APD %, or a list of them), once V is back below that AP's APD
+    # threshold: resting + (100 - repolarisation)% of (peak - resting). The resting value is the
+    # lowest V before the upstroke, never above the one ap_duration finds, so the threshold is
+    # never above ap_duration's and its APD end is in the trace (use ap_duration with
+    # finish_last = True and the same AP_threshold). Without, once V is back below AP_threshold
+    if repolarisation is not None:
+        repolarisation = np.max(repolarisation)
+    count = {'ups' : 0, 'last' : None, 'rest' : np.inf, 'peak' : -np.inf}
+    def stop(d):
+        V = np.asarray(d[voltage], dtype = float)
+        if count['last'] != None:
+            V = np.concatenate(([count['last']], V))
+        if len(V) == 0:
+            return(False)
+        count['last'] = V[-1]
+        if count['ups'] >= k:
+            # k-th upstroke in an earlier chunk
+            kth_up = 0
+        else:
+            ups = np.flatnonzero((V[1:] > AP_threshold) & (V[:-1] <= AP_threshold)) + 1
+            if count['ups'] + len(ups) < k:
+                count['ups'] += len(ups)
+                count['rest'] = min(count['rest'], V.min())
+                return(False)
+            kth_up = ups[k - count['ups'] - 1]
+            count['rest'] = min(count['rest'], V[:kth_up].min())
+            count['ups'] += len(ups)
+
+        # From the k-th upstroke on
+        V = V[kth_up:]
+        if repolarisation is None:
+            return(bool(np.any(V < AP_threshold)))
+        # Peak so far at each point, the threshold can only be passed on the way down from it
+        peak = np.maximum.accumulate(np.concatenate(([count['peak']], V)))[1:]
+        count['peak'] = peak[-1]
+        thresh = count['rest'] + 0.01*(100 - repolarisation)*(peak - count['rest'])
+        return(bool(np.any((V < thresh) & (V < peak))))
+    return(stop)
+
+def run_until(s, duration, stop, chunk = 20, first = 0, log = ['membrane.V','engine.time']):
+    # Run s for at most duration ms, the first ms in one go and then in chunks of chunk ms, until
+    # stop(log of the chunk) is True. Returns the log (numpy arrays, one per logged variable)
+    # and whether the run was stopped before duration
+    end = s.time() + duration
+    logs = []
+    step = min(first, duration) if first > 0 else min(chunk, duration)
+    while True:
+        d = s.run(step, log = log)
+        logs.append(d)
+        if stop(d):
+            break
+        if s.time() >= end - 1e-9:
+            break
+        step = min(chunk, end - s.time())
+
+    # One log, dropping the time point logged both at the end of a chunk and start of the next
+    trace = dict((name, np.concatenate([np.asarray(d[name], dtype = float) for d in logs])) for name in log)
+    time = trace['engine.time'] if 'engine.time' in trace else trace[log[-1]]
+    keep = np.concatenate(([True], np.diff(time) > 0))
+    for name in trace:
+        trace[name] = trace[name][keep]
+    return(trace, s.time() < end - 1e-9)
+
+# Main function for testing
+def main():
+    # S1-S2 beat measured with a fixed length run and with a run stopped after the S2 AP
+    m = myokit.load_model('tentusscher-2006.mmt')
+    pcl = 600
+    p = myokit.pacing.blocktrain(pcl, 0.5, offset=20, level=1.0, limit=1)
+    p.schedule(1, 400, 0.5, pcl, 1)
+    s = myokit.Simulation(m, p)
+    AP_threshold = s.state()[m.get('membrane.V').indice()] + 5
+
+    d = s.run(5*pcl, log = ['membrane.V','engine.time'])
+    start, duration, thresh = ap_duration(d, repolarisation = [50, 90], AP_threshold = AP_threshold)
+    print 'Fixed run {} ms, APDs {}'.format(5*pcl, duration[-1])
+
+    s.reset()
+    d, stopped = run_until(s, 5*pcl, after_repolarisation(2, AP_threshold, [50, 90]))
+    start, duration, thresh = ap_duration(d, repolarisation = [50, 90], AP_threshold = AP_threshold, finish_last = True)
+    print 'Stopped run {} ms, APDs {}'.format(np.round(d['engine.time'][-1], 1), duration[-1])
+
+    pl.figure()
+    pl.plot(d['engine.time'], d['membrane.V'])
+    pl.xlabel('Time (ms)')
+    pl.ylabel('Membrane Potential (mV)')
+    pl.show()
+
+if __name__ == "__main__":
+    main()
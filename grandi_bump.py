@@ -2,6 +2,8 @@
 import myokit
 import matplotlib.pyplot as pl
 from manual_APD import ap_duration
+import steady_cache
+from log_policy import run_logged, beat_windows
 import numpy as np
 
 ## Investigating Grandi bump ##
@@ -47,7 +49,7 @@ pl.suptitle('{} 1st beat, Grandi (2010)'.format(cell_type))
 s.reset()
 s.set_constant('type.epi', cell_types[cell_type])
 s.set_tolerance(1*np.e**-8, 1*np.e**-8)
-s.pre(pcl*199)
+steady_cache.pre(s, m, p, pcl*199, constants = {'type.epi' : cell_types[cell_type]}, tolerance = (1*np.e**-8, 1*np.e**-8))
 d = s.run(pcl)
 pl.figure()
 pl.subplot(3,2,1)
@@ -82,7 +84,6 @@ s.set_tolerance(1*np.e**-8, 1*np.e**-8)
 
 pl.figure()
 beats = [1,2,3,6,12,20,60,100,150,200]
-time_beats_start = [(element -1)*10000 for element in beats]
 beats_legend = [str(element)+'th AP' for element in beats]
 beats_legend[0] = '1st AP'
 beats_legend[1] = '2nd AP'
@@ -92,26 +93,28 @@ beats_legend[2] = '3rd AP'
 #cm = pl.get_cmap('gist_rainbow')
 #pl.set_color_cycle([cm(1.*i/num_colours) for i in range(num_colours)])
 
-d = s.run(200*pcl,log_interval = 0.1, log = ['engine.time','membrane.V','calcium.I_Ca_tot_junc','calcium.I_Ca_tot_sl', 'ical.I_Ca_junc', 'ical.I_Ca_sl' ])
+# Only the chosen beats are logged, one log per beat, time shifted back to the first beat
+logs = run_logged(s, beat_windows(p, [element - 1 for element in beats]), log_interval = 0.1, log = ['engine.time','membrane.V','calcium.I_Ca_tot_junc','calcium.I_Ca_tot_sl', 'ical.I_Ca_junc', 'ical.I_Ca_sl' ])
+beat_time = [np.asarray(d['engine.time']) - (element - 1)*pcl for d, element in zip(logs, beats)]
 pl.subplot(1,5,1)
-for beat in time_beats_start:
-    pl.plot(d['engine.time'][0:10000],d['membrane.V'][beat:beat+10000])
+for d, time in zip(logs, beat_time):
+    pl.plot(time, d['membrane.V'])
 pl.title('Membrane potential, AP')
 pl.subplot(1,5,2)
-for beat in time_beats_start:
-    pl.plot(d['engine.time'][0:10000],d['ical.I_Ca_junc'][beat:beat+10000])
+for d, time in zip(logs, beat_time):
+    pl.plot(time, d['ical.I_Ca_junc'])
 pl.title('ICal (junc)')
 pl.subplot(1,5,3)
-for beat in time_beats_start:
-    pl.plot(d['engine.time'][0:10000],d['ical.I_Ca_sl'][beat:beat+10000])
+for d, time in zip(logs, beat_time):
+    pl.plot(time, d['ical.I_Ca_sl'])
 pl.title('ICal (sl)')
 pl.subplot(1,5,4)
-for beat in time_beats_start:
-    pl.plot(d['engine.time'][0:10000],d['calcium.I_Ca_tot_junc'][beat:beat+10000])
+for d, time in zip(logs, beat_time):
+    pl.plot(time, d['calcium.I_Ca_tot_junc'])
 pl.title('I Ca (junc)')
 pl.subplot(1,5,5)
-for beat in time_beats_start:
-    pl.plot(d['engine.time'][0:10000],d['calcium.I_Ca_tot_sl'][beat:beat+10000])
+for d, time in zip(logs, beat_time):
+    pl.plot(time, d['calcium.I_Ca_tot_sl'])
     pl.legend(beats_legend)
 pl.title('I Ca (sl)')
 pl.suptitle('Membrane potential and calcium channel currents at a certain beat in a cycle using the Grandi (2010) Model')
@@ -47,7 +47,7 @@ d = s.run(offset, log = ['membrane.V','engine.time'])
 print 'finished running'
 
 # Use ap_duration function to calculate start times and durations
-start, duration, thresh = ap_duration(d, beats_per_pace*len(interval))
+start, duration, thresh = ap_duration(d)
 print 'apd calculated'
 
 # First offset equal to zero, so remove first entry from the list
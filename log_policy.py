@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import matplotlib.pyplot as pl
+import myokit
+import numpy as np
+from manual_APD import ap_duration
+
+## Logging only chosen beats ##
+## ------------------------- ##
+
+# Traces are often only looked at for a few beats: the last APs of each dynamic protocol stage,
+# or the 1st, 2nd, ... 200th beat in grandi_bump.py. A logging policy here is a list of windows
+# (start, end) in ms, built from the beats of a protocol. run_logged runs the whole protocol but
+# only logs inside the windows (myokit.LOG_NONE in between), giving one log per window.
+# segments_apd finds the APDs of each of those logs
+
+def protocol_beats(p, limit = None):
+    # Start time, period and event (stage) number of every stimulus of protocol p, one row each.
+    # Events that recur indefinitely give limit beats
+    beats = []
+    for stage, event in enumerate(p.events()):
+        if event.period() == 0:
+            number = 1
+        elif event.multiplier() > 0:
+            number = event.multiplier()
+        elif limit != None:
+            number = limit
+        else:
+            raise ValueError('Protocol recurs indefinitely, a limit on the beats is needed')
+        for beat in range(int(number)):
+            beats.append((event.start() + beat*event.period(), event.period(), stage))
+    return(np.asarray(beats, dtype = float).reshape(-1, 3))
+
+def stage_windows(p, first = -5, number = 5):
+    # One window per event (stage) of p, over beats first to first + number - 1 of the stage.
+    # first counts back from the end of the stage when negative, e.g. -5 for the last 5 beats
+    beats = protocol_beats(p)
+    windows = []
+    for stage in range(len(p.events())):
+        stage_beats = beats[beats[:, 2] == stage]
+        chosen = stage_beats[first:][:number] if first < 0 else stage_beats[first:first + number]
+        if len(chosen):
+            windows.append((chosen[0, 0], chosen[-1, 0] + chosen[-1, 1]))
+    return(windows)
+
+def beat_windows(p, indices, length = None):
+    # One window for each beat index (0 for the first stimulus of p), lasting its period or length ms
+    beats = protocol_beats(p, limit = max(indices) + 1)
+    return([(beats[i, 0], beats[i, 0] + (length if length != None else beats[i, 1])) for i in indices])
+
+def run_logged(s, windows, end = None, log = ['membrane.V','engine.time'], log_interval = None):
+    # Run s from its current time, logging only inside the windows (sorted, not overlapping).
+    # If end is given, runs on unlogged until then. Returns one log per window
+    logs = []
+    for window_start, window_end in windows:
+        if window_start > s.time():
+            s.run(window_start - s.time(), log = myokit.LOG_NONE)
+        logs.append(s.run(window_end - s.time(), log = log, log_interval = log_interval))
+    if end != None and end > s.time():
+        s.run(end - s.time(), log = myokit.LOG_NONE)
+    return(logs)
+
+def segments_apd(logs, repolarisation = 90):
+    # [onset, duration, thresh] of each log, one list entry per window (as run_stages, split by
+    # stage). Each window is segmented on its own minimum voltage + 5mV
+    start = []
+    duration = []
+    thresh = []
+    for d in logs:
+        window_start, window_duration, window_thresh = ap_duration(d, repolarisation = repolarisation)
+        start.append(window_start)
+        duration.append(window_duration)
+        thresh.append(window_thresh)
+    return[start, duration, thresh]
+
+# Main function for testing
+def main():
+    # Last 5 APs of each stage of a short dynamic protocol, logging nothing else
+    m = myokit.load_model('ohara-cipa-v1-2017.mmt')
+    p = myokit.Protocol()
+    offset = 0
+    pacing_list = [1000, 800, 600, 400, 300]
+    for pacing in pacing_list:
+        p.schedule(1, start = offset, duration = 0.5, period = pacing, multiplier = 20)
+        offset += 20*pacing
+    s = myokit.Simulation(m, p)
+    logs = run_logged(s, stage_windows(p, -5, 5), offset)
+    start, duration, thresh = segments_apd(logs)
+    print 'Logged {} time points in {} windows'.format(sum(len(d['engine.time']) for d in logs), len(logs))
+
+    pl.figure()
+    for pacing, stage_duration in zip(pacing_list, duration):
+        pl.plot([pacing]*len(stage_duration), stage_duration, '.', c = 'b')
+    pl.xlabel('PCL (ms)')
+    pl.ylabel('APD 90 (ms)')
+    pl.show()
+
+if __name__ == "__main__":
+    main()
@@ -3,280 +3,370 @@
 import matplotlib.pyplot as pl
 import myokit
 import numpy as np
+from periodic_orbit import OrbitDetector, lag_changes, periodic_orbit, resample_beats
 
-def ap_duration(d, paces, repolarisation = 90):
+## Vectorised APD calculation ##
+## -------------------------- ##
 
-    # Convert membrane potential and time lists to numpy arrays
-    V = np.asarray(d['membrane.V'])
-    # Depending on model, sometimes environment.time, others engine.time
-    time = np.asarray(d['engine.time'])
-
-    # Blank numpy arrays to contain resting values, max peaks for each AP
-    # Times of peaks, duration of APs and start of AP above some threshold
-    # Assuming no 1:2 (or 1:3 etc.) ratios, so number of paces >= number of APs
-    resting_values = np.zeros(2*paces + 2)
-    peak_values = np.zeros(2*paces + 2)
-    time_of_peak_values = np.zeros(2*paces + 2)
-    onset = np.zeros(2*paces + 2) # Plus 2 in case starts mid AP and ends with incomplete AP
-    duration_ap = np.zeros(2*paces + 2)
-
-    # Segmenting each period using the minimum voltage + 5mV as threshold
-    AP_threshold = min(V) + 5
-    # Boolean whether in AP or outside
-    in_ap = 0
-    # Counter for number of APs
-    responses = 0
-    max_upstroke_velocity = 0.0 # Unsure if needed for this purpose
-    inf = float("inf")
-
-    current_minimum_velocity = inf
-    current_resting_value = inf
-    current_peak = -inf
-    resting_potential_gradient_thresh = 0.01 # Gradient taken from Chaste code
-
-    # Boolean for if section of AP where gradient < 0.01 has been found
-    flat_bit_found = 0
-    apd_end_time = None
-    apd_start_time = None
-
-    # Iterating over time points
-    for i in range(1, len(V)):
-
-        # Gradient calculated using difference in potential over time difference from previous time point
-        voltage_grad = (V[i]-V[i-1])/float((time[i]-time[i-1]))
-        if voltage_grad >= max_upstroke_velocity:
-            max_upstroke_velocity = voltage_grad
-            current_time_upstroke = time[i]
-
-        # Looking for rest section of AP, either flat-ish gradient or minimum voltage
-        if abs(voltage_grad) <= current_minimum_velocity and abs(voltage_grad) <= resting_potential_gradient_thresh and not in_ap:
-            current_minimum_velocity = abs(voltage_grad)
-            current_resting_value = V[i-1]
-            flat_bit_found  = 1
-
-        # Keep storing mimimum voltage if flat bit has not been found for period
-        elif V[i-1] < current_resting_value and flat_bit_found == 0 and not in_ap:
-            current_resting_value = V[i-1]
-
-        ### Crossing threshold. Start of AP ###
-        if V[i] > AP_threshold and V[i-1] <= AP_threshold and not in_ap:
-
-            # Now within AP
-            in_ap = 1
-
-
-            # Set resting value for this AP. Used as minimum
-            resting_values[responses] = current_resting_value
+# Same contract as the original sample-by-sample loop (kept in test_manual_APD.py), but crossings,
+# resting values, peaks and APD thresholds are all found with array operations
 
-            # Re-initialise these values for next AP
-            current_minimum_velocity = inf
-            current_resting_value = inf
-            flat_bit_found = 0
+# repolarisation can also be a list of levels, e.g. [30, 50, 70, 90]. The trace is then
+# segmented once and onset, duration and thresh are matrices with one column per level, and
+# each column is what that level on its own would give
 
-            # Linear interpolation to store onset time.
-            # y = y0 + (x -x0)*(y1-y0)/(x1 -x0). y: time, x : voltage
-            onset[responses] = time[i-1] + (AP_threshold - V[i-1])*(time[i]-time[i-1])/(V[i]-V[i-1])
+# Durations are only returned for APs where repolarisation was found, as the original loop did
+# (for a list of levels, an AP is dropped unless it was found at every level). aligned = True
+# keeps one duration per completed AP instead, NaN where repolarisation was not found, so they
+# line up with thresh and the first rows of onset. Onset has a row for every AP, including an
+# unfinished final one
 
-            switching_phase = True
+# AP_threshold can be given when d is only part of a longer trace, to segment it the same way
 
-        # In AP, record height of the peak and corresponding time. Useful check if printed
-        elif in_ap and V[i] > current_peak:
-            current_peak = V[i]
-            current_peak_time = time[i]
+# finish_last = True measures a final AP that is still above AP_threshold when the trace ends as
+# if it ended there (peak up to the end), for runs stopped once it has repolarised at the APD
+# threshold (event_run.after_repolarisation)
 
-        # Cross threshold again. End of AP. Update variables
-        elif in_ap and V[i] < AP_threshold and V[i-1] >= AP_threshold:
+def ap_duration(d, paces = None, repolarisation = 90, AP_threshold = None, aligned = False, finish_last = False):
+    # paces is not needed, arrays are sized from the APs found in the trace
 
-            # No longer in AP
-            in_ap = 0
-
-            # Record peak values
-            peak_values[responses] = current_peak
-            time_of_peak_values[responses] = current_peak_time
-
-            # Updates tally of number of APs
-            responses += 1
-
-            # Re-initialise values for next AP
-            current_peak_time = -inf
-            max_upstroke_velocity = -inf
-            current_peak = AP_threshold
-            current_time_of_upstroke_velocity = 0.0
+    # Convert membrane potential and time lists to numpy arrays
+    V = np.asarray(d['membrane.V'], dtype = float)
+    # Depending on model, sometimes environment.time, others engine.time
+    time = np.asarray(d['engine.time'], dtype = float)
 
-        # Loop round to next time point
+    # Segmenting each period using the minimum voltage + 5mV as threshold
+    if AP_threshold is None:
+        AP_threshold = V.min() + 5
+
+    upstroke, end, onset, resting_values, peak_values = ap_segments(V, time, AP_threshold)
+    if finish_last and len(upstroke) > len(peak_values):
+        # Peak of the unfinished AP as ap_segments finds it for a completed one
+        after = V[upstroke[-1] + 1:]
+        peak_values = np.append(peak_values, after.max() if len(after) else np.broadcast_to(AP_threshold, V.shape)[upstroke[-1]])
+    onset_apd, duration_ap, thresh = apd_thresholds(V, time, AP_threshold, onset, resting_values, peak_values, repolarisation)
+    if np.ndim(repolarisation) > 0:
+        repolarised = ~np.isnan(duration_ap).any(axis = 1)
+    else:
+        repolarised = ~np.isnan(duration_ap)
+
+    if not aligned:
+        duration_ap = duration_ap[repolarised]
+    return[onset_apd, duration_ap, thresh]
 
-    # Keep only non-zero terms. Matrices containing start and duration of APs at set threshold
-    onset = onset[np.nonzero(onset)]
-    peak_values = peak_values[np.nonzero(peak_values)]
-    time_of_peak_values = time_of_peak_values[np.nonzero(time_of_peak_values)]
+def ap_features(d, repolarisation = 90, AP_threshold = None):
+
+    # Onset, duration (NaN where repolarisation was not found), threshold, peak and resting value
+    # of every completed AP, all the same length (see pacing_protocol.beat_table)
+    V = np.asarray(d['membrane.V'], dtype = float)
+    time = np.asarray(d['engine.time'], dtype = float)
+    if AP_threshold is None:
+        AP_threshold = V.min() + 5
+
+    upstroke, end, onset, resting_values, peak_values = ap_segments(V, time, AP_threshold)
+    onset_apd, duration_ap, thresh = apd_thresholds(V, time, AP_threshold, onset, resting_values, peak_values, repolarisation)
+    number_aps = len(peak_values)
+    return[onset_apd[:number_aps], duration_ap, thresh, peak_values, resting_values[:number_aps]]
+
+def ap_segments(V, time, AP_threshold, analysed = None):
+
+    # AP_threshold is either one value or one value per time point.
+    # Time points where analysed is False are skipped. An AP still going when they start is dropped
+    threshold = np.broadcast_to(AP_threshold, V.shape)
+    if analysed is None:
+        analysed = np.ones(len(V), dtype = bool)
+
+    ## Threshold crossings ##
+    ## ------------------- ##
+
+    # Start of AP: crossing threshold upwards. End of AP: crossing back down
+    ups = np.flatnonzero((V[1:] > threshold[1:]) & (V[:-1] <= threshold[1:]) & analysed[1:]) + 1
+    downs = np.flatnonzero((V[1:] < threshold[1:]) & (V[:-1] >= threshold[1:]) & analysed[1:]) + 1
+    # Start of a skipped section also ends the AP, apart from at the final time point
+    aborts = np.flatnonzero(analysed[:-2] & ~analysed[1:-1]) + 1
+
+    # Merge into one time ordered list of events, 1 for start and 0 for end
+    events = np.concatenate((ups, downs, aborts))
+    is_up = np.concatenate((np.ones(len(ups), dtype = bool), np.zeros(len(downs) + len(aborts), dtype = bool)))
+    is_abort = np.concatenate((np.zeros(len(ups) + len(downs), dtype = bool), np.ones(len(aborts), dtype = bool)))
+    order = np.argsort(events, kind = 'mergesort')
+    events = events[order]
+    is_up = is_up[order]
+    is_abort = is_abort[order]
+
+    # Only an event that switches between in/out of AP counts, starting outside an AP
+    switch = is_up != np.concatenate(([False], is_up[:-1]))
+    events = events[switch]
+    is_abort = is_abort[switch]
+
+    # Alternating start, end, start, end... Final AP may not have finished
+    upstroke = events[0::2]
+    closing = events[1::2]
+    aborted = is_abort[1::2]
+
+    # Linear interpolation to store onset time.
+    # y = y0 + (x -x0)*(y1-y0)/(x1 -x0). y: time, x : voltage
+    thr = threshold[upstroke]
+    onset = time[upstroke-1] + (thr - V[upstroke-1])*(time[upstroke]-time[upstroke-1])/(V[upstroke]-V[upstroke-1])
+
+    ## Resting value before each AP ##
+    ## ---------------------------- ##
+
+    # Looking at points from the end of the previous AP up to and including the upstroke
+    window_start = np.concatenate(([1], closing + 1))[:len(upstroke)]
+    window_end = upstroke + 1
+    resting_values = resting_potential(V, time, window_start, window_end, analysed)
+
+    # Drop APs cut off by a skipped section
+    keep = np.concatenate((~aborted, np.ones(len(upstroke) - len(closing), dtype = bool)))
+    complete = upstroke[:len(closing)][~aborted]
+    end = closing[~aborted]
+
+    ## Peak of each completed AP ##
+    ## ------------------------- ##
+
+    # Height of the peak between upstroke and end of AP (threshold if nothing higher)
+    peak_values = np.array(threshold[complete], dtype = float)
+    has_peak = end > complete + 1
+    if np.any(has_peak):
+        bounds = np.column_stack((complete[has_peak] + 1, end[has_peak])).ravel()
+        peak_values[has_peak] = np.maximum.reduceat(V, bounds)[::2]
+
+    return(upstroke[keep], end, onset[keep], resting_values[keep], peak_values)
+
+def resting_potential(V, time, window_start, window_end, analysed = None):
+
+    # Resting value for each window [window_start, window_end) of time points.
+    # Either the flattest bit (gradient < 0.01, taken from Chaste code) or the minimum voltage
+    resting_potential_gradient_thresh = 0.01
+    inf = float("inf")
+    if len(window_start) == 0:
+        return(np.zeros(0))
+
+    # Gradient at each time point, using difference with the previous time point
+    # Padded with inf at the start and end so that index i is time point i
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        voltage_grad = np.abs(np.diff(V)/np.diff(time))
+    flat_grad = np.where(voltage_grad <= resting_potential_gradient_thresh, voltage_grad, inf)
+    flat_grad = np.concatenate(([inf], flat_grad, [inf]))
+    # Voltage at the previous time point, used as the resting value
+    previous_V = np.concatenate(([inf], V, [inf]))[:len(flat_grad)]
+    if analysed is not None:
+        flat_grad[:-1][~analysed] = inf
+        previous_V[:-1][~analysed] = inf
+
+    bounds = np.column_stack((window_start, window_end)).ravel()
+    min_grad = np.minimum.reduceat(flat_grad, bounds)[::2]
+    min_V = np.minimum.reduceat(previous_V, bounds)[::2]
+    flat_bit_found = np.isfinite(min_grad)
+
+    # Last point in each window with the minimum gradient
+    window = np.searchsorted(window_start, np.arange(len(flat_grad)), side = 'right') - 1
+    inside = (window >= 0) & (np.arange(len(flat_grad)) < window_end[window])
+    is_min = inside & (flat_grad == min_grad[window]) & flat_bit_found[window]
+    min_index = np.flatnonzero(is_min)
+    last_min = min_index[np.maximum(np.searchsorted(min_index, window_end) - 1, 0)] if len(min_index) else 0
+
+    return(np.where(flat_bit_found, previous_V[last_min], min_V))
+
+def apd_thresholds(V, time, AP_threshold, onset, resting_values, peak_values, repolarisation = 90):
 
     ### Varying thresholds calculated for each AP ###
     ### ----------------------------------------- ###
     # Using min and max of each AP, calculating specific percent of AP duration
 
-    # Clone onset matrix, to fill with APD (90/50 etc) starts
-    onset_apd = onset
-    thresh = []
-
-    # Iterating over APs rather than time points
-    for ap_index in range(0, len(peak_values)):
-        # Custom threshold for each AP. Range*(100-repolarisation %) + resting value
-        custom_thresh = resting_values[ap_index] + 0.01*(100-repolarisation)*(peak_values[ap_index]-resting_values[ap_index])
-        thresh.append(custom_thresh)
-        starting_time_index = np.nonzero(time > onset[ap_index])[0][0] - 1
-
-        # The APD 90/50.. threshold is greater than earlier threshold
-        # Look forwards in time
-        if custom_thresh >= AP_threshold:
-            prev_v = V[starting_time_index]
-            prev_t = time[starting_time_index]
-            for t in range(starting_time_index,len(time)):
-                if V[t] > custom_thresh and V[t-1] < custom_thresh:
-                    # Linear interpolation
-                    apd_start_time = prev_t + ((custom_thresh - prev_v) / float(V[t] - prev_v)) * (time[t] - prev_t)
-                    onset_apd[ap_index] = apd_start_time
-                    apd_starting_index = t
-                    break
-                prev_v = V[t]
-                prev_t = time[t]
-
-        # Look backwards to find custom threshold, i.e. threshold is lower than previous threshold used
+    # repolarisation is one level or a list of levels. All levels are searched together: the
+    # thresholds are a matrix with one row per AP and one column per level, and the threshold at
+    # every time point is a row per level, so each search is one pass over the trace. Returns
+    # onset (every AP), duration (completed APs, NaN where not found) and thresh, one column per
+    # level for a list
+    levels = np.atleast_1d(np.asarray(repolarisation, dtype = float))
+    number_levels = len(levels)
+    number_aps = len(peak_values)
+    onset_apd = np.repeat(np.asarray(onset, dtype = float)[:, None], number_levels, axis = 1)
+    if number_aps == 0:
+        return(as_levels(repolarisation, onset_apd, np.zeros((0, number_levels)), np.zeros((0, number_levels))))
+    resting_values = resting_values[:number_aps]
+
+    # Custom threshold for each AP and level. Range*(100-repolarisation %) + resting value
+    thresh = resting_values[:, None] + 0.01*(100 - levels[None, :])*(peak_values - resting_values)[:, None]
+
+    # Time point just before each AP onset. Each AP searched from here to the next AP
+    starting_time_index = np.searchsorted(time, onset[:number_aps], side = 'right') - 1
+    region_end = np.concatenate((starting_time_index[1:], [len(V)]))
+    region_start = np.concatenate(([0], starting_time_index[:-1]))
+
+    # Threshold at every time point of the region belonging to each AP, one row per level
+    # Forward searches look in [start index, next start index), backward in (previous start index, start index]
+    forward_thresh = np.full((number_levels, len(V)), np.nan)
+    backward_thresh = np.full((number_levels, len(V)), np.nan)
+    aps = np.arange(number_aps)
+    forward_thresh[:, starting_time_index[0]:] = thresh.T[:, np.repeat(aps, np.maximum(region_end - starting_time_index, 0))]
+    backward_thresh[:, 1:starting_time_index[-1] + 1] = thresh.T[:, np.repeat(aps, np.maximum(starting_time_index - region_start, 0))]
+
+    # Searches below look for the indices of the flattened rows: time point i at level j is
+    # j*len(V) + i, so the region of each AP at each level is its own range of indices
+    level_offset = len(V)*np.arange(number_levels)[None, :]
+    region = lambda index: (np.broadcast_to(index, thresh.shape) + level_offset).ravel()
+    unflatten = lambda t: np.where(t.reshape(thresh.shape) >= 0, t.reshape(thresh.shape) - level_offset, -1)
+
+    apd_start_time = np.full(thresh.shape, np.nan)
+    apd_starting_index = np.full(thresh.shape, -1, dtype = int)
+
+    # The APD 90/50.. threshold is greater than earlier threshold (at the time point before the AP)
+    # Look forwards in time for crossing upwards
+    forwards = thresh >= np.broadcast_to(AP_threshold, V.shape)[starting_time_index][:, None]
+    with np.errstate(invalid = 'ignore'):
+        level, rise = np.nonzero((V[None, 1:] > forward_thresh[:, 1:]) & (V[None, :-1] < forward_thresh[:, 1:]))
+    t = unflatten(first_index(level*len(V) + rise + 1, region(starting_time_index[:, None]), region(region_end[:, None])))
+    for ap_index, level in zip(*np.nonzero(forwards & (t < 0))):
+        # Not found before next AP, keep looking until the end of the trace
+        t[ap_index, level] = first_crossing(V, max(starting_time_index[ap_index], 1), thresh[ap_index, level], upwards = True)
+    found = forwards & (t >= 0)
+    t = t[found]
+    # Linear interpolation
+    apd_start_time[found] = time[t-1] + (thresh[found] - V[t-1])/(V[t] - V[t-1])*(time[t] - time[t-1])
+    apd_starting_index[found] = t
+
+    # Look backwards to find custom threshold, i.e. threshold is lower than previous threshold used
+    backwards = ~forwards
+    with np.errstate(invalid = 'ignore'):
+        below = np.flatnonzero(V[None, :] < backward_thresh)
+    t = unflatten(last_index(below, region(region_start[:, None] + 1), region(starting_time_index[:, None] + 1)))
+    for ap_index, level in zip(*np.nonzero(backwards & (t < 0))):
+        below_ap = np.flatnonzero(V[1:starting_time_index[ap_index] + 1] < thresh[ap_index, level])
+        t[ap_index, level] = below_ap[-1] + 1 if len(below_ap) else -1
+    found = backwards & (t >= 0)
+    t = t[found]
+    # Linear interpolation
+    apd_start_time[found] = time[t+1] + (thresh[found] - V[t+1])/(V[t] - V[t+1])*(time[t] - time[t+1])
+    apd_starting_index[found] = t + 1
+
+    # Onset at APD 90/50.. threshold, where found
+    started = apd_starting_index >= 0
+    onset_apd[:number_aps][started] = apd_start_time[started]
+
+    # Look forwards in time for repolarisation
+    with np.errstate(invalid = 'ignore'):
+        below = np.flatnonzero(V[None, :] < forward_thresh)
+    t = unflatten(first_index(below, region(np.maximum(apd_starting_index, starting_time_index[:, None])), region(region_end[:, None])))
+    t[~started] = -1
+    for ap_index, level in zip(*np.nonzero(started & (t < 0))):
+        t[ap_index, level] = first_crossing(V, apd_starting_index[ap_index, level], thresh[ap_index, level], upwards = False)
+    found = t >= 0
+    t = t[found]
+    # Linear interpolation
+    apd_end_time = time[t-1] + (thresh[found] - V[t-1])/(V[t] - V[t-1])*(time[t] - time[t-1])
+
+    # NaN where no repolarisation was found
+    duration_ap = np.full(thresh.shape, np.nan)
+    duration_ap[found] = apd_end_time - apd_start_time[found]
+
+    return(as_levels(repolarisation, onset_apd, duration_ap, thresh))
+
+def as_levels(repolarisation, onset_apd, duration_ap, thresh):
+    # One column per level for a list of levels, 1d arrays for one level
+    if np.ndim(repolarisation) > 0:
+        return(onset_apd, duration_ap, thresh)
+    return(onset_apd[:, 0], duration_ap[:, 0], thresh[:, 0])
+
+def first_index(hits, lower, upper):
+    # First of the sorted indices hits in [lower, upper) for each region, -1 if none
+    position = np.searchsorted(hits, lower)
+    index = hits[np.minimum(position, len(hits) - 1)] if len(hits) else np.zeros(len(lower), dtype = int)
+    return(np.where((position < len(hits)) & (index < upper), index, -1))
+
+def last_index(hits, lower, upper):
+    # Last of the sorted indices hits in [lower, upper) for each region, -1 if none
+    position = np.searchsorted(hits, upper) - 1
+    index = hits[np.maximum(position, 0)] if len(hits) else np.zeros(len(lower), dtype = int)
+    return(np.where((position >= 0) & (index >= lower), index, -1))
+
+def first_crossing(V, start, level, upwards = True):
+    # First index from start where V crosses level (upwards), or is below level, -1 if none
+    # Searched in doubling chunks so a crossing close to start is found cheaply
+    size = 1024
+    while start < len(V):
+        stop = min(start + size, len(V))
+        if upwards:
+            hits = np.flatnonzero((V[start:stop] > level) & (V[start-1:stop-1] < level))
         else:
-            prev_v = V[starting_time_index + 1]
-            prev_t = time[starting_time_index + 1]
-            for t in range(starting_time_index, 0, -1):
-                if V[t] < custom_thresh:
-                    # Linear interpolation
-                    apd_start_time = prev_t + ((custom_thresh - prev_v) / float((V[t] - prev_v))) * (time[t] - prev_t)
-                    onset_apd[ap_index] = apd_start_time
-                    apd_starting_index = (t + 1);
-                    break;
-                prev_v = V[t]
-                prev_t = time[t]
-
-        if apd_end_time != None and apd_start_time != None and apd_start_time < apd_end_time:
-            # Skip to next AP if start of this AP is reached before last AP is finished
-            continue
-
-        # If apd_start_index has a value then look forwards in time for repolarisation
-        if apd_starting_index != None:
-            prev_t = time[apd_starting_index - 1]
-            prev_v = V[apd_starting_index -1]
-            for t in range(apd_starting_index, len(time)):
-                if V[t] < custom_thresh:
-                    # Linear interpolation
-                    apd_end_time = time[t - 1] + ((custom_thresh - prev_v) / (V[t] - prev_v)) * (time[t] - time[t - 1])
-                    duration_ap[ap_index] = apd_end_time - apd_start_time
-                    #print apd_end_time, apd_start_time
-                    break
-                prev_t = time[t]
-                prev_v = V[t]
-
-        # Re-initialise for next AP.
-        apd_starting_index = None
-        apd_end_time = None
-        apd_start_time = None
-        # Loop to next AP
-
-    duration_ap = duration_ap[np.nonzero(duration_ap)]
-    return[onset_apd, duration_ap, thresh]
-
-def steady(m,p,pcl,paces):
-    # Create simulation using user defined model and protocol
+            hits = np.flatnonzero(V[start:stop] < level)
+        if len(hits):
+            return(start + hits[0])
+        start = stop
+        size *= 2
+    return(-1)
+
+def steady(m,p,pcl,paces, max_period = 8, tolerance = 0.3):
+    # Number of paces until the voltage trace is on a periodic orbit, running paces beats at a
+    # time. Each beat is resampled onto the same points (resample_beats), so any log_interval
+    # works, and the orbit is found when every point of the last few beats is within tolerance
+    # mV of the beat one period before (periodic_orbit, period up to max_period beats). Paces are
+    # counted from the start of pacing up to and including the beat that confirms the orbit
     s = myokit.Simulation(m,p)
-    ss = 0
+    offset = p.events()[0].start() if len(p.events()) else 0
+    beats = np.zeros((0, 200))
+    last = {'engine.time' : [], 'membrane.V' : []}
     count = 0
-    while ss == 0:
+    while True:
         # Progress report
         print "In steady function"
-
-        # Run for pcl*paces, specifying to use time values every 0.1 ms interval for solver
-        d  = s.run(paces*pcl, log = ['engine.time', 'membrane.V'], log_interval = 0.1)
-
-        # Lengthy step due to log_interval component, so progress report when this is finished
-        print "Simulations finished running"
-
-        # Use function to calculate start and AP duration, default APD 90
-        start, duration, thresh = ap_duration(d, paces)
-        min = float("inf")
-        # Find long-short patterns. Linearly repeating
-
-        for i in range(1, 10):
-            #if np.round(duration[-1],0) != np.round(duration[-1 - i],0):
-            #    continue
-            #else:
-            #    seq = i
-            #    print seq
-            #    break
-
-            if abs(duration[-1] - duration[-1-i]) < min:
-                min  = abs(duration[-1] - duration[-1-i])
-                seq = i
-            else:
-                continue
-
-
-        print seq
-        # If there is greater than a 1:1 ratio
-        paces_per_period = np.round(float(start[-1] - start[-2])/ float(pcl),0)
-        print paces_per_period
-        # How many time points in each period (AP) (time interval for solver 0.1)
-        time_points_per_period = pcl*paces_per_period/0.1
-
-        # Convert membrane potential list into numpy array
-        V = np.asarray(d['membrane.V'])
-
-        # If multiple paces per period, V may not be divisible by no. time_points_per_period
-        # Slice the end of the array off so it is divisble and can reshape array
-        remainder = int(len(V)%time_points_per_period)
-
-        if remainder != 0:
-            V = V[0:-remainder]
-
-        # Reshape array so that each period is on a seperate row
-        # Each column contains the same point in an AP, but for different beats
-        V = np.reshape(V, (-1, int(time_points_per_period)))
-
-        # Euclidean distance and percentage change between adjacent periods calculated
-        perc = np.zeros(len(V)-seq)
-        dist_array = np.zeros(len(V)-seq)
-
-        # Length V = number of rows --> number of APs (periods)
-        for i in range(10*seq,len(V)):
-            dist_av = 0
-            for j in range(1,10):
-                # L-infinte
-                dist = max(abs(V[i]-V[i-j*seq]))
-                dist_av += dist
-                # Euclidean dist
-                #dist = np.sqrt(np.sum((V[i]-V[i-seq])**2))
-
-            dist_av = dist_av / j
-
-            #perc[i-seq] = (dist/abs(np.mean(V[i-seq])))*100
-            dist_array[i- seq] = dist_av
-        # Moving average for 10 terms calculated for percentage change
-        #moving_av = np.convolve(perc, np.ones((10,))/10, mode='valid')
-        moving_av_dist = np.convolve(dist_array, np.ones((10,))/10, mode='valid')
-        pl.figure()
-        pl.plot(d['engine.time'],d['membrane.V'])
-
-
-        # Plot results
-        pl.figure()
-        pl.plot(range(seq,len(V)), dist_array)
-        pl.xlabel('Period Number')
-        pl.ylabel("L-infinite norm of membrane potential and previous period's membrane potential")
-
-        if np.size(np.nonzero(dist_array < 0.3)) < 1:
-            ss =  0
-            count += paces
-            print count
-
-        else:
-            ss = paces_per_period*np.nonzero(dist_array < 0.3)[0][0] + count
-
-    return(ss)
+        d = s.run(paces*pcl, log = ['engine.time', 'membrane.V'])
+        count += paces
+        # Beats completed in this run, after those already resampled. The last run is kept for
+        # a beat that started in it
+        completed = int(np.floor((s.time() - offset)/pcl + 1e-9))
+        beat_start = offset + pcl*np.arange(len(beats), completed)
+        trace = dict((name, np.concatenate((last[name], d[name]))) for name in last)
+        beats = np.concatenate((beats, resample_beats(trace, beat_start, pcl)))
+        last = d
+
+        # Absolute change only: scaled change is |change| / tolerance. beat is the row of the
+        # confirming beat, counted from the first beat paced
+        beat, period, change = periodic_orbit(beats, max_period, rel_tol = 0, abs_tol = tolerance)
+        if period:
+            print 'Period {} orbit'.format(period)
+            ss = int(beat) + 1
+            return(ss)
+        print count
+
+## Pre-pacing until steady ##
+## ----------------------- ##
+
+# Same test as steady, but on the full state vector at each stimulus instead of the voltage
+# trace, one beat at a time (periodic_orbit.OrbitDetector). The state is compared with the state
+# 1 to max_period beats before, so alternans (period 2) or 2:1 block can settle as well. Change of
+# each state variable is scaled as the solver does: |change| / (rel_tol*|x| + abs_tol), the same
+# when no variable changes by more than 1
+
+def state_change(states, max_period = 2, rel_tol = 1e-4, abs_tol = 1e-6):
+    # states: one row per beat, last row the newest. Returns the smallest scaled change of the
+    # newest state and the period it was found for (inf, 0 if there are not enough beats)
+    newest = lag_changes(states, max_period, rel_tol, abs_tol)[:, -1]
+    if np.isinf(np.min(newest)):
+        return(np.inf, 0)
+    period = np.argmin(newest) + 1
+    return(newest[period - 1], period)
+
+def steady_pre(s, pcl, max_beats = 1000, max_period = 2, rel_tol = 1e-4, abs_tol = 1e-6, confirm = 1):
+
+    # Pre-pace simulation s one beat (pcl ms, or one cycle of a repeating protocol) at a time,
+    # until the state at the stimulus is periodic or max_beats is reached. Each beat of the orbit
+    # has to repeat confirm times. As with s.pre, the time is not changed and the default state
+    # becomes the final state.
+    # Returns the number of beats taken, the period found and the final change (the closest
+    # period and its change if not steady)
+    detector = OrbitDetector(max_period, confirm, rel_tol, abs_tol)
+    detector.add(s.state())
+    for beat in range(1, int(max_beats) + 1):
+        s.pre(pcl)
+        period = detector.add(s.state())
+        if period:
+            return(beat, period, detector.change)
+
+    print 'Not steady after {} beats, change {}'.format(int(max_beats), detector.change)
+    return(int(max_beats), detector.period, detector.change)
 
 def main():
 
@@ -307,7 +397,7 @@ def main():
       pl.figure()
       pl.plot(d['engine.time'], d['membrane.V'])
       pl.title('Ohara-Rudy-CIPA (2017) Epicardial cell at {} pace cycle length'.format(pacing))
-      start, duration, thresh = ap_duration(d, paces)
+      start, duration, thresh = ap_duration(d)
       print start
       if len(start) > len(duration):
           start = start[0:-1]
@@ -335,8 +425,9 @@ def main():
     logint = p.create_log_for_interval(0, p.characteristic_time(), for_drawing = True)
 
     d = s.run(10*bcl + 20*pcl + 19*30)
-    start, duration, thresh = ap_duration(d, 10*bcl + 20*pcl + 19*30, log_for_interval = logint)
+    start, duration, thresh = ap_duration(d)
     print len(start)
+
     print start
     pl.figure()
     pl.plot(d['engine.time'], d['membrane.V'])
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import time
+import myokit
+import numpy as np
+
+## Cache of parsed models ##
+## ---------------------- ##
+
+# myokit.load_model parses the .mmt file on every call. load_model below parses each file once
+# per process and returns a clone of the parsed model, which can be changed freely.
+# A file is parsed again when it changes: its modification time or size changes and its
+# contents hash differs from the one parsed
+
+# Parsed models, by absolute path: (modification time and size, sha1 of contents, model)
+models = {}
+# Models built from a parsed model (e.g. HF_model.scaled_model), by (path, key): (sha1, model)
+derived = {}
+
+def load_model(filename):
+    # Use in place of myokit.load_model(filename)
+    return(parsed_model(filename)[1].clone())
+
+def parsed_model(filename):
+    # sha1 of the file and the cached model. Not to be changed, use load_model for a copy
+    path = os.path.abspath(filename)
+    info = os.stat(path)
+    stamp = (info.st_mtime, info.st_size)
+    entry = models.get(path)
+    if entry != None and entry[0] == stamp:
+        return(entry[1:])
+
+    with open(path, 'rb') as f:
+        source = f.read()
+    digest = hashlib.sha1(source).hexdigest()
+    if entry != None and entry[1] == digest:
+        # Touched but not changed
+        models[path] = (stamp, digest, entry[2])
+        return(entry[1:])
+
+    m = myokit.load_model(path)
+    models[path] = (stamp, digest, m)
+    return(digest, m)
+
+def derived_model(filename, key, build):
+    # Clone of build(model), where model is a clone of the model in filename. build is only
+    # called the first time for each key, or when the file has changed
+    path = os.path.abspath(filename)
+    digest, m = parsed_model(path)
+    entry = derived.get((path, key))
+    if entry == None or entry[0] != digest:
+        entry = (digest, build(m.clone()))
+        derived[(path, key)] = entry
+    return(entry[1].clone())
+
+def clear():
+    # Forget all parsed models
+    models.clear()
+    derived.clear()
+
+# Main function for testing
+def main():
+    for run in ['first (parsed)', 'second (cached)']:
+        start = time.time()
+        m = load_model('ohara-cipa-v1-2017.mmt')
+        print 'Loading model {} took {} s'.format(run, np.round(time.time() - start, 4))
+
+    # Clones are independent of the cached model
+    m.get('cell.celltype').set_rhs(1)
+    print 'Cell type of a new clone', load_model('ohara-cipa-v1-2017.mmt').get('cell.celltype').rhs()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import os
+import model_cache
+
+## Registry of models ##
+## ------------------ ##
+
+# Everything the protocols need to know about each model, in one place:
+# file: .mmt file of the model (only parsed when the model is loaded, see load_model)
+# name: name for plot titles
+# cell_type_label: constant that sets the cell type
+# cell_types: valid cell types, by value of that constant
+# HF_label: first part of the HF model names (HF_model.py), e.g. 'Ord' for Ord_HF_Gomez
+# HF_models: HF models of the model, first one used when no HF model is asked for
+
+ventricular_cell_types = {0:'Endocardial', 1: 'Epicardial', 2: 'Mid-myocardial'}
+grandi_cell_types = {0:'Endocardial', 1: 'Epicardial'}
+
+models = {
+    'tentusscher-2006' : {
+        'name' : 'Ten-Tusscher (2006)',
+        'cell_type_label' : 'cell.type',
+        'cell_types' : ventricular_cell_types,
+        'HF_label' : 'TT',
+        'HF_models' : ['Lu'],
+    },
+    'grandi-2010' : {
+        'name' : 'Grandi (2010)',
+        'cell_type_label' : 'type.epi',
+        'cell_types' : grandi_cell_types,
+        # HF models are applied to the modified model, which has the late sodium channel
+        'HF_label' : 'GPB',
+        'HF_models' : ['Gomez', 'Moreno'],
+    },
+    'grandi-2010_modified' : {
+        'name' : 'Grandi (2010) with late sodium channel',
+        'cell_type_label' : 'type.epi',
+        'cell_types' : grandi_cell_types,
+        'HF_label' : 'GPB',
+        'HF_models' : ['Gomez', 'Moreno'],
+    },
+    'ohara-2011' : {
+        'name' : "O'hara (2011)",
+        'cell_type_label' : 'cell.mode',
+        'cell_types' : ventricular_cell_types,
+        'HF_label' : 'Ord',
+        'HF_models' : ['Gomez', 'Elshrif'],
+    },
+    'ohara-cipa-v1-2017' : {
+        'name' : "O'hara- CiPA (2017)",
+        'cell_type_label' : 'cell.celltype',
+        'cell_types' : ventricular_cell_types,
+        'HF_label' : 'Ordcipa',
+        'HF_models' : ['Gomez', 'Elshrif'],
+    },
+}
+
+# Same for all models
+for model in models:
+    models[model].setdefault('file', '{}.mmt'.format(model))
+
+def model_name(model):
+    # Registry name of a model, also accepting the file name ('ohara-cipa-v1-2017.mmt')
+    model = os.path.basename(model)
+    if model.endswith('.mmt'):
+        model = model[:-4]
+    if model not in models:
+        raise ValueError('Unknown model {}, expected one of {}'.format(model, sorted(models)))
+    return(model)
+
+def model_info(model):
+    # Dict of the registry entry of a model
+    return(models[model_name(model)])
+
+def load_model(model):
+    # Copy of the model, parsed once per process
+    return(model_cache.load_model(model_info(model)['file']))
+
+def HF_model_name(model, HF_model):
+    # Full HF model name, e.g. ('ohara-2011', 'Gomez') -> 'Ord_HF_Gomez'
+    info = model_info(model)
+    if HF_model not in info['HF_models']:
+        raise ValueError('Unknown HF model {} for {}, expected one of {}'.format(HF_model, model, info['HF_models']))
+    return('{}_HF_{}'.format(info['HF_label'], HF_model))
+
+def check_cell_type(model, cell_type):
+    # Cell type must be one the model has
+    info = model_info(model)
+    if cell_type not in info['cell_types']:
+        raise ValueError('Cell type {} not in {} ({})'.format(cell_type, info['name'], info['cell_types']))
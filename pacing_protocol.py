@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import matplotlib.pyplot as pl
+import myokit
+import numpy as np
+from manual_APD import ap_features
+
+## Pacing protocols from an array of cycle lengths ##
+## ----------------------------------------------- ##
+
+# HRV, HRV_return, return_loop and dynamic_protocol pace with a cycle length that changes from
+# beat to beat or stage to stage. A PacingProtocol holds the cycle length of every beat as one
+# array, with the stimulus times, stages and PCL of each beat worked out from it exactly, so
+# nothing has to be read back from a myokit Protocol or a drawing log of it.
+
+# A stage is a run of beats with the same PCL, unless the stages are given (from_stages). The
+# myokit Protocol has one recurring event per stage, scheduled last to first: each event then
+# goes in at the head of myokit's event list, instead of the whole list being walked for each
+
+class PacingProtocol(object):
+
+    def __init__(self, pcls, duration = 0.5, level = 1.0, offset = 0, stage_beat = None):
+        # pcls: cycle length of every beat (ms). duration, level: of each stimulus.
+        # offset: time of the first stimulus. stage_beat: first beat of each stage, if stages
+        # are not just runs of the same PCL (two stages of one PCL in a row)
+        self.pcl = np.asarray(pcls, dtype = float)
+        self.duration = duration
+        self.level = level
+        self.offset = offset
+
+        # Stimulus time of every beat, and end of the final beat
+        self.start = offset + np.concatenate(([0], np.cumsum(self.pcl)[:-1]))
+        self.end = offset + np.sum(self.pcl)
+
+        # First beat, number of beats, start time and PCL of each stage, and stage of every beat
+        if stage_beat is None:
+            stage_beat = np.concatenate(([0], np.flatnonzero(np.diff(self.pcl) != 0) + 1))
+        self.stage_beat = np.asarray(stage_beat, dtype = int)
+        self.stage_beats = np.diff(np.append(self.stage_beat, len(self.pcl)))
+        self.stage_start = self.start[self.stage_beat]
+        self.stage_pcl = self.pcl[self.stage_beat]
+        self.stage = np.repeat(np.arange(len(self.stage_beat)), self.stage_beats)
+
+    def __len__(self):
+        return(len(self.pcl))
+
+    def protocol(self):
+        # myokit Protocol with one event per stage
+        p = myokit.Protocol()
+        for i in range(len(self.stage_beat) - 1, -1, -1):
+            p.schedule(self.level, start = self.stage_start[i], duration = self.duration, period = self.stage_pcl[i], multiplier = int(self.stage_beats[i]))
+        return(p)
+
+    def beat_of(self, time):
+        # Beat in which each time falls (-1 before the first stimulus)
+        return(np.searchsorted(self.start, time, side = 'right') - 1)
+
+    def save(self, filename):
+        # .npz with the cycle lengths and stimulus settings, load to read back
+        np.savez(filename, pcl = self.pcl, duration = self.duration, level = self.level, offset = self.offset, stage_beat = self.stage_beat)
+
+# Columns of a beat table, one row per stimulus: stimulus time, PCL before it (from the previous
+# stimulus), whether an AP started before the next stimulus, onset, DI (from the end of the last
+# AP), APD, peak and resting potential of that AP. NaN where there is no AP or no previous beat
+beat_columns = ['stimulus', 'pcl', 'captured', 'onset', 'di', 'apd', 'peak', 'resting']
+
+def beat_table(pacing, onset, apd, peak = None, resting = None):
+
+    # Beat table (dict of column arrays) from the APs found in a trace, e.g. by
+    # manual_APD.ap_features: onset and APD of each AP (NaN if not repolarised), peak and
+    # resting if known. Each AP belongs to the beat whose stimulus comes last before its onset,
+    # the first AP in a beat is kept. Beats without an AP (one AP spanning several stimuli,
+    # 2:1 block) are not captured
+    onset = np.asarray(onset, dtype = float)
+    number = len(pacing)
+    table = {'stimulus' : pacing.start, 'pcl' : np.concatenate(([np.nan], pacing.pcl[:-1]))}
+
+    beat = pacing.beat_of(onset)
+    inside = (beat >= 0) & (beat < number)
+    beats, first = np.unique(beat[inside], return_index = True)
+    ap = np.flatnonzero(inside)[first]
+    table['captured'] = np.zeros(number, dtype = bool)
+    table['captured'][beats] = True
+
+    for name, values in [('onset', onset), ('apd', apd), ('peak', peak), ('resting', resting)]:
+        table[name] = np.zeros(number)*np.nan
+        if values is not None:
+            table[name][beats] = np.asarray(values, dtype = float)[ap]
+
+    # DI: onset minus the end of the AP of the previous captured beat
+    table['di'] = np.zeros(number)*np.nan
+    table['di'][beats[1:]] = table['onset'][beats[1:]] - (table['onset'] + table['apd'])[beats[:-1]]
+    return(table)
+
+def trace_beat_table(d, pacing, repolarisation = 90, AP_threshold = None):
+    # Beat table from a trace of the whole protocol
+    onset, apd, thresh, peak, resting = ap_features(d, repolarisation, AP_threshold)
+    return(beat_table(pacing, onset, apd, peak, resting))
+
+def from_stages(pacing_list, beats_per_stage, duration = 0.5, level = 1.0, offset = 0, coupling = None):
+    # Protocol of stages (dynamic protocol): beats_per_stage beats (one number, or one per stage)
+    # of each PCL in pacing_list. coupling: if given, the interval from the last stimulus of each
+    # stage to the first of the next (and to the end of the protocol), as in S1-CI-S2
+    beats = np.broadcast_to(np.asarray(beats_per_stage, dtype = int), np.shape(pacing_list))
+    stage_beat = np.concatenate(([0], np.cumsum(beats)[:-1]))
+    pcls = np.repeat(np.asarray(pacing_list, dtype = float), beats)
+    if coupling is not None:
+        pcls[np.cumsum(beats) - 1] = coupling
+    return(PacingProtocol(pcls, duration, level, offset, stage_beat))
+
+def load(filename):
+    # PacingProtocol saved with save
+    stored = np.load(filename)
+    return(PacingProtocol(stored['pcl'], float(stored['duration']), float(stored['level']), float(stored['offset']), stored['stage_beat']))
+
+# Main function for testing
+def main():
+    # 50 runs of a 30 point HRV cycle: 1500 beats
+    points = np.linspace(0, 2*np.pi, num = 30, endpoint = False)
+    pcls = np.tile(np.round(60*1000.0/(70 + 18.5*np.sin(points - np.pi/2.0)), 0), 50)
+    pacing = PacingProtocol(pcls)
+    p = pacing.protocol()
+    print '{} beats, {} stages, {} events, ends at {} ms'.format(len(pacing), len(pacing.stage_beat), len(p.events()), pacing.end)
+
+    pl.figure()
+    pl.plot(pacing.start, pacing.pcl, '.-')
+    pl.xlim(0, 50000)
+    pl.xlabel('Time (ms)')
+    pl.ylabel('PCL (ms)')
+    pl.show()
+
+if __name__ == "__main__":
+    main()
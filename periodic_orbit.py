@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import matplotlib.pyplot as pl
+import myokit
+import numpy as np
+
+## Periodic orbit detection ##
+## ------------------------ ##
+
+# A beat here is one row: the state at a stimulus, or a beat of the voltage trace resampled onto
+# the same number of points (resample_beats). The beats are on a period k orbit (k up to
+# max_period: 1:1, alternans, 2:1 block, longer Wenckebach-like patterns) when each of the last
+# confirm*k beats is the same as the beat k before it, so every beat of the orbit is seen to
+# repeat confirm times. The change of each value is scaled by rel_tol*|x| + abs_tol, the same when
+# no value changes by more than 1. The smallest such k is the period (a period 1 orbit is also
+# period 2, 4, ...). manual_APD.steady (voltage beats) and manual_APD.steady_pre (states) both use
+# this test
+
+def lag_changes(beats, max_period = 8, rel_tol = 1e-4, abs_tol = 1e-6):
+    # Scaled change of every beat from the beat k before, k = 1 to max_period: one row per k,
+    # one column per beat (inf where there is no beat k before)
+    beats = np.asarray(beats, dtype = float)
+    number = len(beats)
+    changes = np.full((max_period, number), np.inf)
+    for k in range(1, min(max_period, number - 1) + 1):
+        scale = rel_tol*np.maximum(abs(beats[k:]), abs(beats[:-k])) + abs_tol
+        changes[k - 1, k:] = np.max(abs(beats[k:] - beats[:-k])/scale, axis = 1)
+    return(changes)
+
+def confirmed(changes, confirm = 2):
+    # From lag_changes: True where the beat ends a run of confirm*k beats, each the same as the
+    # beat k before (period k confirmed at that beat). One row per k
+    max_period, number = changes.shape
+    # Running count of beats that differ, so a window sum is a difference of two counts
+    differ = np.concatenate((np.zeros((max_period, 1)), np.cumsum(changes > 1, axis = 1)), axis = 1)
+    found = np.zeros(changes.shape, dtype = bool)
+    for k in range(1, max_period + 1):
+        window = confirm*k
+        if window < number:
+            found[k - 1, window:] = (differ[k - 1, window + 1:] - differ[k - 1, 1:-window]) == 0
+    return(found)
+
+def periodic_orbit(beats, max_period = 8, confirm = 2, rel_tol = 1e-4, abs_tol = 1e-6):
+    # First beat at which a periodic orbit is confirmed, its period and the largest change over
+    # the confirming beats. (-1, 0, inf) if none is found
+    changes = lag_changes(beats, max_period, rel_tol, abs_tol)
+    found = confirmed(changes, confirm)
+    beat_found = np.flatnonzero(np.any(found, axis = 0))
+    if len(beat_found) == 0:
+        return(-1, 0, np.inf)
+    beat = beat_found[0]
+    period = np.flatnonzero(found[:, beat])[0] + 1
+    return(beat, period, np.max(changes[period - 1, beat - confirm*period + 1:beat + 1]))
+
+class OrbitDetector(object):
+
+    # The same test beat by beat during a run (manual_APD.steady_pre): add each beat as it is
+    # paced, and stop pacing as soon as add gives a period. Only the beats still needed for a
+    # test are kept. Until a period is found, period and change are those of the closest earlier
+    # beat to the newest one
+
+    def __init__(self, max_period = 8, confirm = 2, rel_tol = 1e-4, abs_tol = 1e-6):
+        self.max_period = max_period
+        self.confirm = confirm
+        self.rel_tol = rel_tol
+        self.abs_tol = abs_tol
+        self.beats = []
+        self.period = 0
+        self.change = np.inf
+
+    def add(self, beat):
+        # Add the newest beat. Returns the period confirmed with it, 0 if none yet
+        self.beats.append(np.asarray(beat, dtype = float))
+        self.beats = self.beats[-(self.confirm + 1)*self.max_period - 1:]
+        changes = lag_changes(self.beats, self.max_period, self.rel_tol, self.abs_tol)
+        found = confirmed(changes, self.confirm)[:, -1]
+        if not np.any(found):
+            newest = changes[:, -1]
+            self.period = 0 if np.isinf(np.min(newest)) else np.argmin(newest) + 1
+            self.change = np.min(newest)
+            return(0)
+        self.period = np.flatnonzero(found)[0] + 1
+        self.change = np.max(changes[self.period - 1, -self.confirm*self.period:])
+        return(self.period)
+
+def resample_beats(d, beat_start, pcl, points = 200, voltage = 'membrane.V'):
+    # Voltage of each beat (starting at the times in beat_start, lasting pcl ms) at points evenly
+    # spaced times, one row per beat. Works with any log_interval, or none (variable steps)
+    time = np.asarray(d['engine.time'], dtype = float)
+    V = np.asarray(d[voltage], dtype = float)
+    times = np.asarray(beat_start, dtype = float)[:, None] + np.linspace(0, pcl, points, endpoint = False)[None, :]
+    return(np.interp(times.ravel(), time, V).reshape(times.shape))
+
+# Main function for testing
+def main():
+    # Beats to reach a periodic orbit over a range of PCLs
+    from manual_APD import steady_pre
+    m = myokit.load_model('ohara-cipa-v1-2017.mmt')
+    pcls = range(200, 1001, 100)
+    beats = []
+    for pcl in pcls:
+        p = myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=0)
+        s = myokit.Simulation(m, p)
+        s.set_constant('cell.celltype', 1)
+        beat, period, change = steady_pre(s, pcl, max_beats = 2000, max_period = 8, confirm = 2)
+        print 'PCL {} ms: period {} orbit after {} beats'.format(pcl, period, beat)
+        beats.append(beat)
+
+    pl.figure()
+    pl.plot(pcls, beats, 'x-')
+    pl.xlabel('PCL (ms)')
+    pl.ylabel('Beats to periodic orbit')
+    pl.show()
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,16 @@
 import myokit
 import matplotlib.pyplot as pl
 from manual_APD import ap_duration
-from apd_dynamic import apd_dynamic
+from apd_dynamic import apd_dynamic, apd_stage
+from log_policy import run_logged, stage_windows, segments_apd
+from event_run import run_until, after_repolarisation
+from scenarios import scenario, run_scenarios
+from pacing_protocol import from_stages
+import steady_grid
+import model_registry
+import sim_cache
+import steady_cache
+import multiprocessing
 import numpy as np
 from HF_model import *
 
@@ -20,88 +29,93 @@ from HF_model import *
 
 #models = ['tentusscher-2006', 'grandi-2010', 'ohara-2011', 'ohara-cipa-v1-2017', 'grandi-2010_modified']
 #HF_model = ['Gomez','Elshrif','Moreno', 'Lu']
-def dynamic_protocol(model, time_per_stage = 30000, stimuli_per_pace = None , max_pcl = 1000, min_pcl = 50, number_stages = 20, repolarisation = 90, cell_type = 1, voltage_plot = False, HF_model = None, plot_from_function = True):
-    cell_types = {0:'Endocardial', 1: 'Epicardial', 2: 'Mid-myocardial'}
-    if model == 'tentusscher-2006':
-        label = 'cell.type'
-        name  = 'Ten-Tusscher (2006)'
-        HF_label = 'TT'
-    elif model == 'grandi-2010':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010)'
-        HF_label = 'GPB'
-    elif model == 'grandi-2010_modified':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010) with late sodium channel'
-        HF_label = 'GPB'
-    elif model == 'ohara-2011':
-        label = 'cell.mode'
-        name = "O'hara (2011)"
-        HF_label = 'Ord'
-    elif model == 'ohara-cipa-v1-2017':
-        label = 'cell.celltype'
-        name = "O'hara- CiPA (2017)"
-        HF_label = 'Ordcipa'
-
-    p = myokit.Protocol()
-    m = myokit.load_model('{}.mmt'.format(model))
-    models_HF = {'Ord_HF_Gomez' : Ord_HF_Gomez, 'Ord_HF_Elshrif' : Ord_HF_Elshrif, 'GPB_HF_Gomez' : GPB_HF_Gomez, 'GPB_HF_Gomez': GPB_HF_Moreno, 'TT_HF_Lu' : TT_HF_Lu}
+# stream = True runs and analyses one PCL stage at a time, so only one stage is held in memory
+# (no voltage plot in this case, as the full trace is never kept)
+# HF_severity: fraction of the HF remodelling applied (0 healthy, 1 full HF model), see HF_constants
+# pre_pacing: if given, start from the steady state at the first PCL (found by shooting, at most
+# pre_pacing beats) instead of the model's initial state
+# onset_tolerance (ms): if given, number_stages is a coarse grid and stages are added where the
+# response changes until the onsets of alternans and 2:1 block are found to this tolerance
+# (see adaptive_stages). The onsets are returned
+# log_beats: only log the last log_beats beats of each stage (at least 6, as the last 4 APDs
+# before the final one are plotted), nothing is logged in between. No voltage plot in this case
+# processes: run healthy and HF on this many worker processes at the same time
+# (scenarios.run_scenarios), None for one after another
+# warm_start: each stage starts from the steady state at its PCL, from a grid of steady states at
+# the stage PCLs (steady_grid, found once per model and protocol and stored), instead of the state
+# the last stage ended in. Stages then only need a few beats (stimuli_per_pace) to settle. Runs
+# stage by stage as with stream = True, so no voltage plot
+# stream, log_beats, warm_start and onset_tolerance each choose a different way of running the
+# stages, so only one of them can be given (dynamic_mode), and voltage_plot only with none of them
+def dynamic_protocol(model, time_per_stage = 30000, stimuli_per_pace = None , max_pcl = 1000, min_pcl = 50, number_stages = 20, repolarisation = 90, cell_type = 1, voltage_plot = False, HF_model = None, plot_from_function = True, stream = False, HF_severity = 1.0, pre_pacing = None, onset_tolerance = None, log_beats = None, processes = None, warm_start = False):
+    mode = dynamic_mode(stream, log_beats, warm_start, onset_tolerance, voltage_plot)
+
+    # Cell type constant, name and HF model names from the registry
+    info = model_registry.model_info(model)
+    label = info['cell_type_label']
+    name = info['name']
+    cell_types = info['cell_types']
+    model_registry.check_cell_type(model, cell_type)
+
+    m = model_registry.load_model(model)
+    # HF model: base model with scale constants, HF changes set as constants on the simulation
     if HF_model != None:
-        m_str = '{}_HF_{}'.format(HF_label, HF_model)
-        m_func = models_HF[m_str]
-        hf_m = m_func(cell_type)
-
-    # Empty arrays to fill.
-    period = []
-    offset_list = []
-    offset = 0
+        m_str = model_registry.HF_model_name(model, HF_model)
+        hf_m = scaled_model(HF_base_model(m_str))
+        hf_constants = {label : cell_type}
+        hf_constants.update(HF_constants(m_str, cell_type, HF_severity))
 
     # More points around high pacing, more likely to see graph bifurcate
     pacing_list = np.logspace(np.log10(min_pcl), np.log10(max_pcl), num = number_stages, base = 10.0)[::-1]
     pacing_list = [int(i) for i in pacing_list]
 
     # Starting at low frequency pacing (1Hz), 30 seconds at each pacing and then moving towards 230ms
-    for pacing in pacing_list:
-        beats_per_pace = (time_per_stage)/pacing
-        if stimuli_per_pace != None:
-            beats_per_pace = stimuli_per_pace
-            no_runs = 50*np.sum(pacing_list)
-        else:
-            no_runs = time_per_stage*len(pacing_list)
-        p.schedule(1, start = offset, duration =0.5, period = pacing, multiplier = beats_per_pace)
-        offset_list.append(offset)
-        # Next set of pacing events to be scheduled by this offset (beats per pace * pace)
-        offset += beats_per_pace*pacing
-        period.append(pacing)
-
-    # Set up simulation using this scheduled protocol
-    s = myokit.Simulation(m, p)
-    s.set_constant(label, cell_type)
-
-    ## HF model as well ##
+    beats_per_pace = [(time_per_stage)/pacing if stimuli_per_pace == None else stimuli_per_pace for pacing in pacing_list]
+    pacing = from_stages(pacing_list, beats_per_pace)
+    # Protocol, start of each stage and end of the whole protocol
+    p, offset_list, offset = pacing.protocol(), list(pacing.stage_start), pacing.end
+
+    if mode == 'adaptive':
+        # Set up simulations using this scheduled protocol, HF model as well
+        s = sim_cache.simulation(m, p)
+        s.set_constant(label, cell_type)
+        if pre_pacing != None:
+            steady_cache.pre(s, m, p, pre_pacing*pacing_list[0], constants = {label : cell_type}, beat = pacing_list[0])
+        hf_s = None
+        if HF_model != None:
+            hf_s = sim_cache.simulation(hf_m, p)
+            set_constants(hf_s, hf_constants)
+            if pre_pacing != None:
+                steady_cache.pre(hf_s, hf_m, p, pre_pacing*pacing_list[0], constants = hf_constants, HF_model = HF_model, beat = pacing_list[0])
+        return(adaptive_plot(s, hf_s, pacing_list, time_per_stage, stimuli_per_pace, onset_tolerance, repolarisation, '{} {} Cells'.format(name, cell_types[cell_type])))
+
+    # Healthy and HF model run the scheduled protocol independently, at the same time on
+    # processes worker processes (one after another if None)
+    pre = None if pre_pacing == None else pre_pacing*pacing_list[0]
+    states = hf_states = None
+    if mode == 'warm_start':
+        # Grid at the stage PCLs found here (or loaded) before any workers start, so every
+        # lookup is a grid point, whatever min_pcl and max_pcl are
+        grid_pcls, grid_states = steady_grid.grid(m, {label : cell_type}, pacing_list)
+        states = [steady_grid.lookup(grid_pcls, grid_states, pcl) for pcl in pacing_list]
+        if HF_model != None:
+            grid_pcls, grid_states = steady_grid.grid(hf_m, hf_constants, pacing_list, HF_model = HF_model)
+            hf_states = [steady_grid.lookup(grid_pcls, grid_states, pcl) for pcl in pacing_list]
+    args = (offset_list, repolarisation, stream, log_beats, voltage_plot, states)
+    dynamic_scenarios = [scenario(m, p, offset, {label : cell_type}, pre, beat = pacing_list[0], run = run_dynamic, args = args)]
     if HF_model != None:
-        hf_s = myokit.Simulation(hf_m, p)
-        hf_s.set_constant(label, cell_type)
-        hf_d = hf_s.run(offset, log = ['membrane.V','engine.time'])
-        hf_start, hf_duration, hf_thresh = apd_dynamic(hf_d, p, no_runs, repolarisation = repolarisation)
+        hf_args = (offset_list, repolarisation, stream, log_beats, voltage_plot, hf_states)
+        dynamic_scenarios.append(scenario(hf_m, p, offset, hf_constants, pre, HF_model = HF_model, beat = pacing_list[0], run = run_dynamic, args = hf_args))
+    results = run_scenarios(dynamic_scenarios, processes)
+    (start, duration, thresh), d = results[0]
 
+    if HF_model != None:
+        (hf_start, hf_duration, hf_thresh), hf_d = results[1]
         hf_final_apd = np.zeros(len(offset_list))
         hf_final_apd2 = np.zeros(len(offset_list))
         hf_final_apd3 = np.zeros(len(offset_list))
         hf_final_apd4 = np.zeros(len(offset_list))
 
-    # Run the simulation with final offset value, equal to time passed for whole protocol
-    d = s.run(offset, log = ['membrane.V','engine.time'])
-
-    # Including log of paces, as pacing is not constant, changes threshold for each pace
-    logint = p.create_log_for_interval(0, p.characteristic_time(), for_drawing = True)
-
-    # Use ap_duration function to calculate start times and durations
-    #start, duration, thresh = ap_duration(d, 30000*len(pacing_list), repolarisation = 95, log_for_interval = logint)
-    start, duration, thresh = apd_dynamic(d, p, no_runs, repolarisation = repolarisation)
-
     # Numpy array to contain final APD for each pacing cycle (and 3 previous APs in case of alternans)
     final_apd = np.zeros(len(offset_list))
     final_apd2 = np.zeros(len(offset_list))
@@ -122,39 +136,21 @@ def dynamic_protocol(model, time_per_stage = 30000, stimuli_per_pace = None , ma
             pl.axvline(x= value, color = 'red', ls = 'dotted', ymin = 0.05, ymax = 0.96)
 
 
-    # Fill arrays with APDs for last few APs at each PCL
-    for i in range(len(offset_list)):
-        # Final peak of pacing cycle = peak before the first of a new pacing cycle
-
-        # Index_start = The index of the start of pacing cycle in start array
-        index_start = np.nonzero(start >= offset_list[i])[0][0]
-
-        pl.arrow(start[index_start-2], thresh[index_start-2], duration[index_start-2], 0, head_width=2, head_length=duration[index_start-2]/3, length_includes_head=True)
+    # Fill arrays with APDs for last few APs at each PCL (results already split by stage)
+    for i in range(len(pacing_list)):
+        # Second to last AP of the stage, as the last may run into the next stage
+        pl.arrow(start[i][-2], thresh[i][-2], duration[i][-2], 0, head_width=2, head_length=duration[i][-2]/3, length_includes_head=True)
         #pl.text(start + duration_ap/3, -90, str(int(duration_ap)) + ' ms')
 
-        # index_1 -1 to get peak at the end of the previous cycle
-        final_apd[i] = duration[index_start -2]
-        final_apd2[i] = duration[index_start - 3]
-        final_apd3[i] = duration[index_start - 4]
-        final_apd4[i] = duration[index_start - 5]
+        final_apd[i] = duration[i][-2]
+        final_apd2[i] = duration[i][-3]
+        final_apd3[i] = duration[i][-4]
+        final_apd4[i] = duration[i][-5]
         if HF_model != None:
-            hf_index_start = np.nonzero(hf_start >= offset_list[i])[0][0]
-            hf_final_apd[i] = hf_duration[hf_index_start -2]
-            hf_final_apd2[i] = hf_duration[hf_index_start - 3]
-            hf_final_apd3[i] = hf_duration[hf_index_start - 4]
-            hf_final_apd4[i] = hf_duration[hf_index_start - 5]
-
-    # The final peak doesn't have an offset after, so can be indexed by the final duration recorded (take a few for alternans)
-    final_apd[-1] = duration[-2]
-    final_apd2[-1] = duration[-3]
-    final_apd3[-1] = duration[-4]
-    final_apd4[-1] = duration[-5]
-
-    if HF_model != None:
-        hf_final_apd[-1] = hf_duration[-2]
-        hf_final_apd2[-1] = hf_duration[-3]
-        hf_final_apd3[-1] = hf_duration[-4]
-        hf_final_apd4[-1] = hf_duration[-5]
+            hf_final_apd[i] = hf_duration[i][-2]
+            hf_final_apd2[i] = hf_duration[i][-3]
+            hf_final_apd3[i] = hf_duration[i][-4]
+            hf_final_apd4[i] = hf_duration[i][-5]
 
     # Plot the restitution curve
     pl.figure()
@@ -164,10 +160,6 @@ def dynamic_protocol(model, time_per_stage = 30000, stimuli_per_pace = None , ma
     pl.plot(pacing_list,final_apd4,'.', c = 'b')
 
     if HF_model != None:
-        hf_final_apd[-1] = hf_duration[-2]
-        hf_final_apd2[-1] = hf_duration[-3]
-        hf_final_apd3[-1] = hf_duration[-4]
-        hf_final_apd4[-1] = hf_duration[-5]
         pl.plot(pacing_list, hf_final_apd, '.', c = 'C1')
         pl.plot(pacing_list, hf_final_apd2,'.', c = 'C1')
         pl.plot(pacing_list, hf_final_apd3,'.', c = 'C1')
@@ -180,91 +172,242 @@ def dynamic_protocol(model, time_per_stage = 30000, stimuli_per_pace = None , ma
     pl.title('{} {} Cells Dynamic Protocol Restitution Curve'.format(name,cell_types[cell_type]))
     pl.show()
 
+def dynamic_mode(stream = False, log_beats = None, warm_start = False, onset_tolerance = None, voltage_plot = False):
+    # How dynamic_protocol runs its stages: 'full' (one run, whole trace logged), 'stream',
+    # 'log_beats', 'warm_start' or 'adaptive' (onset_tolerance). ValueError for more than one
+    modes = [mode for mode, chosen in [('stream', stream == True), ('log_beats', log_beats != None), ('warm_start', warm_start == True), ('adaptive', onset_tolerance != None)] if chosen]
+    if len(modes) > 1:
+        raise ValueError('Only one of stream, log_beats, warm_start and onset_tolerance can be used, got {}'.format(', '.join(modes)))
+    mode = modes[0] if modes else 'full'
+    if voltage_plot == True and mode != 'full':
+        raise ValueError('No voltage plot with {}, as the whole trace is not logged'.format(mode))
+    return(mode)
+
+def run_dynamic(s, m, p, duration, offset_list, repolarisation = 90, stream = False, log_beats = None, keep_trace = False, states = None):
+    # Run the dynamic protocol p on s (run function of a scenarios.scenario). APDs split by stage,
+    # and the trace if keep_trace and the whole trace was logged. states: state to start each
+    # stage from (warm start), run stage by stage
+    if states != None:
+        return(run_stages(s, offset_list, duration, repolarisation, states), None)
+    if log_beats != None:
+        # Logging only the final beats of each stage
+        return(segments_apd(run_logged(s, stage_windows(p, -log_beats, log_beats), duration), repolarisation), None)
+    if stream == True:
+        # One stage at a time, each log discarded once its APDs are found
+        return(run_stages(s, offset_list, duration, repolarisation), None)
+
+    # Run the simulation with final offset value, equal to time passed for whole protocol
+    d = s.run(duration, log = ['membrane.V','engine.time'])
+    # Thresholds for each stage, as pacing is not constant
+    result = apd_dynamic(d, p, repolarisation = repolarisation, per_stage = True, stage_start = offset_list)
+    trace = {'membrane.V' : np.asarray(d['membrane.V']), 'engine.time' : np.asarray(d['engine.time'])} if keep_trace else None
+    return(result, trace)
+
+def run_stages(s, offset_list, offset, repolarisation = 90, states = None):
+    # Run the dynamic protocol stage by stage, keeping the APDs of each stage but not its log.
+    # states: if given, each stage starts from states[i] instead of where the last stage ended
+    stage_bounds = list(offset_list) + [offset]
+    start = []
+    duration = []
+    thresh = []
+    for i in range(len(offset_list)):
+        if states != None:
+            s.set_state(states[i])
+        d = s.run(stage_bounds[i+1] - stage_bounds[i], log = ['membrane.V','engine.time'])
+        stage_start, stage_duration, stage_thresh = apd_stage(d, stage_bounds[i], stage_bounds[i+1], repolarisation)
+        start.append(stage_start)
+        duration.append(stage_duration)
+        thresh.append(stage_thresh)
+        del d
+    return[start, duration, thresh]
+
+## Adaptive dynamic protocol ##
+## -------------------------- ##
+
+# Onset of alternans and 2:1 block are only known to the spacing of the PCL grid in
+# dynamic_protocol. Here the grid is coarse: when the response changes between two stages, the
+# stage before is forked from and stages are run in between, bisecting the two PCLs until they are
+# less than tolerance ms apart. Each stage starts from the state at the end of the last stage
+# with a longer PCL and the same response, as it would have in a protocol with that stage added
+
+# Response of a stage: 0 1:1 (no alternans), 1 alternans, 2 2:1 block
+responses = {0 : '1:1', 1 : 'Alternans', 2 : '2:1 block'}
+
+def response_pattern(stage_start, stage_duration, pcl, alternans_threshold = 5):
+    # Response from the APs of a stage (as from apd_stage). Alternans when the last APDs
+    # differ by more than alternans_threshold ms, 2:1 when APs come every other beat or less
+    if len(stage_duration) < 4:
+        return(2)
+    if np.median(np.diff(stage_start[-4:])) > 1.5*pcl:
+        return(2)
+    if np.max(abs(np.diff(stage_duration[-4:-1]))) > alternans_threshold:
+        return(1)
+    return(0)
+
+def run_stage(s, state, pcl, beats, repolarisation = 90, alternans_threshold = 5):
+    # One stage of beats at pcl from state. Returns final state, response and APDs of the stage
+    s.set_protocol(myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=beats))
+    s.set_state(state)
+    s.set_time(0)
+    d = s.run(beats*pcl, log = ['membrane.V','engine.time'])
+    stage_start, stage_duration, stage_thresh = apd_stage(d, 0, beats*pcl, repolarisation)
+    return(s.state(), response_pattern(stage_start, stage_duration, pcl, alternans_threshold), stage_duration)
+
+def adaptive_stages(s, pacing_list, time_per_stage = 30000, stimuli_per_pace = None, tolerance = 5, repolarisation = 90, alternans_threshold = 5):
+
+    # Run the stages of pacing_list (longest PCL first) from the current state of s, adding stages
+    # where the response changes until each onset is found to tolerance ms.
+    # Returns PCLs, responses and APDs of all stages run (sorted, longest PCL first), the onset
+    # of each response as (longest PCL with it, shortest PCL without it) and the time simulated
+    def beats(pcl):
+        return(int(stimuli_per_pace) if stimuli_per_pace != None else int(time_per_stage/pcl))
+
+    stages = []
+    onsets = {}
+    simulated = 0
+    state = s.state()
+    previous = None
+    for pcl in pacing_list:
+        new_state, response, stage_duration = run_stage(s, state, pcl, beats(pcl), repolarisation, alternans_threshold)
+        simulated += beats(pcl)*pcl
+        stages.append((pcl, response, stage_duration))
+
+        if previous != None and response > previous[1]:
+            # Bisect between the previous stage and this one
+            longer, longer_response, longer_state = previous
+            shorter, shorter_response = pcl, response
+            while longer - shorter > tolerance:
+                middle = 0.5*(longer + shorter)
+                middle_state, middle_response, middle_duration = run_stage(s, longer_state, middle, beats(middle), repolarisation, alternans_threshold)
+                simulated += beats(middle)*middle
+                stages.append((middle, middle_response, middle_duration))
+                if middle_response > longer_response:
+                    shorter, shorter_response = middle, middle_response
+                else:
+                    longer, longer_state = middle, middle_state
+            # Every response passed between the two stages starts here
+            for onset_response in range(longer_response + 1, shorter_response + 1):
+                onsets.setdefault(responses[onset_response], (shorter, longer))
+
+        state = new_state
+        previous = (pcl, response, new_state)
+
+    stages.sort(key = lambda stage: -stage[0])
+    pcls = np.asarray([stage[0] for stage in stages])
+    stage_responses = np.asarray([stage[1] for stage in stages])
+    return(pcls, stage_responses, [stage[2] for stage in stages], onsets, simulated)
+
+def adaptive_plot(s, hf_s, pacing_list, time_per_stage, stimuli_per_pace, tolerance, repolarisation, title):
+    # Adaptive stages for healthy and HF (hf_s None for healthy only), restitution curve with the
+    # final APDs of every stage. Returns the onsets, by 'Healthy' and 'HF'
+    all_onsets = {}
+    pl.figure()
+    for result_name, sim, colour in [('Healthy', s, 'b'), ('HF', hf_s, 'C1')]:
+        if sim == None:
+            continue
+        pcls, stage_responses, stage_durations, onsets, simulated = adaptive_stages(sim, pacing_list, time_per_stage, stimuli_per_pace, tolerance, repolarisation)
+        print_onsets(onsets, result_name)
+        print '{} stages, {} s simulated'.format(len(pcls), np.round(simulated/1000.0, 1))
+        all_onsets[result_name] = onsets
+        for i, pcl in enumerate(pcls):
+            # Last APs of the stage, leaving out the last one as dynamic_protocol does
+            final = stage_durations[i][-5:-1]
+            pl.plot([pcl]*len(final), final, '.', c = colour, label = result_name if i == 0 else '_nolegend_')
+        for response in onsets:
+            pl.axvline(onsets[response][1], color = colour, ls = 'dotted')
+    pl.legend()
+    pl.xlabel('PCL (ms)')
+    pl.ylabel('APD {} (ms)'.format(repolarisation))
+    pl.title('{} Adaptive Dynamic Protocol Restitution Curve'.format(title))
+    pl.show()
+    return(all_onsets)
+
+def print_onsets(onsets, name):
+    for response in ['Alternans', '2:1 block']:
+        if response in onsets:
+            print '{} {} onset between {} and {} ms PCL'.format(name, response, np.round(onsets[response][0], 1), np.round(onsets[response][1], 1))
+        else:
+            print '{} no {} found'.format(name, response)
+
 ## S1- S2 Protocol ##
 ## --------------- ##
 
 #models = ['tentusscher-2006', 'grandi-2010', 'ohara-2011', 'ohara-cipa-v1-2017.mmt']
-def s1s2_protocol(model, number_S1, PCL_S1 = 1000, pre_pacing = 200, min_di = 10, max_di = 1000, number_di = 30, repolarisation = 90, cell_type = 1, log_scale = False, HF_model = None, plot_from_function = True):
-    cell_types = {0:'Endocardial', 1: 'Epicardial', 2: 'Mid-myocardial'}
-    if model == 'tentusscher-2006':
-        label = 'cell.type'
-        name  = 'Ten-Tusscher (2006)'
-        HF_label = 'TT'
-    elif model == 'grandi-2010':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010)'
-        HF_label = 'GPB'
-    elif model == 'grandi-2010_modified':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010) with late sodium channel'
-        HF_label = 'GPB'
-    elif model == 'ohara-2011':
-        label = 'cell.mode'
-        name = "O'hara (2011)"
-        HF_label = 'Ord'
-    elif model == 'ohara-cipa-v1-2017':
-        label = 'cell.celltype'
-        name = "O'hara- CiPA (2017)"
-        HF_label = 'Ordcipa'
+# processes: number of worker processes to run the DI points on (None runs them one by one)
+# end_repolarisation: APD % used for the end of the final S1 AP, the DI is measured from there
+# HF_severity: fraction of the HF remodelling applied (0 healthy, 1 full HF model), see HF_constants
+# pre_pacing_steady: pre-pace until the state is steady, with pre_pacing as the most beats
+# (by shooting, or by pacing only with pre_pacing_steady = 'pace')
+def s1s2_protocol(model, number_S1, PCL_S1 = 1000, pre_pacing = 200, min_di = 10, max_di = 1000, number_di = 30, repolarisation = 90, cell_type = 1, log_scale = False, HF_model = None, plot_from_function = True, processes = None, end_repolarisation = 95, HF_severity = 1.0, pre_pacing_steady = False):
+    # Cell type constant, name and HF model names from the registry
+    info = model_registry.model_info(model)
+    label = info['cell_type_label']
+    name = info['name']
+    cell_types = info['cell_types']
+    model_registry.check_cell_type(model, cell_type)
 
     p = myokit.Protocol()
-    m = myokit.load_model('{}.mmt'.format(model))
-    models_HF = {'Ord_HF_Gomez' : Ord_HF_Gomez, 'Ord_HF_Elshrif' : Ord_HF_Elshrif, 'GPB_HF_Gomez' : GPB_HF_Gomez, 'GPB_HF_Gomez': GPB_HF_Moreno, 'TT_HF_Lu' : TT_HF_Lu, 'Ordcipa_HF_Gomez' : Ordcipa_HF_Gomez, 'Ordcipa_HF_Elshrif' : Ordcipa_HF_Elshrif}
+    m = model_registry.load_model(model)
+    constants = {label : cell_type}
+    # HF model: base model with scale constants, HF changes set as constants on the simulation
     if HF_model != None:
-        m_str = '{}_HF_{}'.format(HF_label, HF_model)
-        m_func = models_HF[m_str]
-        m = m_func(cell_type)
+        m_str = model_registry.HF_model_name(model, HF_model)
+        m = scaled_model(HF_base_model(m_str))
+        constants.update(HF_constants(m_str, cell_type, HF_severity))
 
     # Set indefinitely recurring event of constant bcl
     p = myokit.pacing.blocktrain(PCL_S1, 0.5, offset=0, level=1.0, limit=0)
-    s = myokit.Simulation(m, p)
-    s.set_constant(label, cell_type)
+    s = sim_cache.simulation(m, p)
+    set_constants(s, constants)
 
-    # Pre-pace with these conditions
-    s.pre(pre_pacing*PCL_S1)
+    # Pre-pace with these conditions (loaded from the cache if done before)
+    steady_cache.pre(s, m, p, pre_pacing*PCL_S1, constants = constants, HF_model = HF_model, beat = PCL_S1 if pre_pacing_steady else None, solver = 'pace' if pre_pacing_steady == 'pace' else 'shooting')
     # Set number of S1 beats to record after pre-pacing
     p = myokit.pacing.blocktrain(PCL_S1, 0.5, offset=0, level=1.0, limit = number_S1)
     s.set_protocol(p)
-    d = s.run(number_S1*PCL_S1)
+    d = s.run(number_S1*PCL_S1, log = ['membrane.V','engine.time'])
 
     # Calculate end of AP for final S1 beat (APD 90). Can add DI to this value for S2 start time
-    start, duration, thresh = ap_duration(d, number_S1, repolarisation = 95)
+    start, duration, thresh = ap_duration(d, repolarisation = end_repolarisation)
     end_final_s1 = start[-1] + duration[-1]
 
-    # Reset
+    # The S1 beats are the same for every DI. Run them once up to the end of the final S1 AP
+    # and start every DI from this state, so only the S2 beat is simulated for each DI
     s.reset()
+    s.run(end_final_s1, log = myokit.LOG_NONE)
+    fork_state = s.state()
+
+    # S1 part of the trace each DI would have logged. Its minimum is needed for the threshold,
+    # the final S1 AP so the S2 AP is segmented exactly as in the full trace
+    V_s1 = np.asarray(d['membrane.V'])
+    time_s1 = np.asarray(d['engine.time'])
+    V_s1, time_s1 = V_s1[time_s1 < end_final_s1], time_s1[time_s1 < end_final_s1]
 
-    di_list = np.zeros(number_di)
-    apd_list = np.zeros(number_di)
-    i = 0
+    # repolarisation can be a list of levels, then apd_list has one column per level
     # Equally space points on base 10 log scale
     if log_scale == True:
         interval = np.logspace(int(np.log10(min_di)), int(np.log10(max_di)), num = number_di, base = 10.0)
     else:
         interval = np.linspace(min_di, max_di, num = number_di)
-    for di in interval:
-
-        # Finite number of S1 beats
-        p = myokit.pacing.blocktrain(PCL_S1, 0.5, offset=0, level=1.0, limit=number_S1)
-        # Schedule S2 beat for the end of last AP (using APD 90) + given DI
-        p.schedule(1, end_final_s1 + di, 0.5, PCL_S1, 1)
-
-        # Set protocol, run and calculate APDs
-        s.set_protocol(p)
-        d = s.run((number_S1 + 1)*PCL_S1 + di)
-        start, duration, thresh = ap_duration(d, number_S1 + 2, repolarisation = repolarisation)
-
-        # Storing apd and DI for this pacing length
-        apd_list[i] = (duration[-1])
-        di_list[i] = (di)
-        s.reset()
-        i += 1
-    grad_list = np.zeros(len(di_list) -1)
-    for i in range(1,len(di_list)):
-        grad_list[i-1] =  (apd_list[i]-apd_list[i-1])/(di_list[i] - di_list[i-1])
-    max_grad = max(grad_list)
+    di_list = np.asarray(interval)
+    fork = (number_S1, PCL_S1, fork_state, end_final_s1, V_s1, time_s1, repolarisation)
+
+    if processes == None:
+        apd_list = np.asarray([s2_apd(s, di, *fork) for di in di_list])
+    else:
+        # DIs are independent, spread over a pool of processes. Each worker builds its own
+        # simulation (compiled module loaded from the cache) and starts from fork_state
+        pool = multiprocessing.Pool(processes, initializer = init_s2_worker, initargs = (m.code(), constants, fork))
+        try:
+            # map gives the results back in DI order
+            apd_list = np.asarray(pool.map(s2_worker, list(di_list)))
+        finally:
+            pool.close()
+            pool.join()
+
+    # Gradient between neighbouring DIs, for each level
+    grad_list = (np.diff(apd_list, axis = 0).T/np.diff(di_list)).T
+    max_grad = np.max(grad_list, axis = 0)
 
     if plot_from_function == True:
         pl.figure()
@@ -274,7 +417,11 @@ def s1s2_protocol(model, number_S1, PCL_S1 = 1000, pre_pacing = 200, min_di = 10
 
         # Plot S1S2 protocol restitution curve
         pl.xlabel('Diastole interval (ms)')
-        pl.ylabel('APD {}(ms)'.format(repolarisation))
+        if np.ndim(repolarisation) > 0:
+            pl.legend(['APD {}'.format(percent) for percent in repolarisation])
+            pl.ylabel('APD (ms)')
+        else:
+            pl.ylabel('APD {}(ms)'.format(repolarisation))
         pl.title('{} {} Cell, {} ms PCL S1-S2 Protocol Restitution Curve'.format(name, cell_types[cell_type], PCL_S1))
         if log_scale == True:
             pl.xscale('log')
@@ -283,6 +430,51 @@ def s1s2_protocol(model, number_S1, PCL_S1 = 1000, pre_pacing = 200, min_di = 10
 
     return(di_list, apd_list, max_grad)
 
+def s2_apd(s, di, number_S1, PCL_S1, fork_state, end_final_s1, V_s1, time_s1, repolarisation = 90):
+    # APD of the S2 beat for one DI, forked from the state at the end of the final S1 AP.
+    # V_s1, time_s1: S1 trace up to that point
+
+    # Finite number of S1 beats
+    p = myokit.pacing.blocktrain(PCL_S1, 0.5, offset=0, level=1.0, limit=number_S1)
+    # Schedule S2 beat for the end of last AP (using APD 90) + given DI
+    p.schedule(1, end_final_s1 + di, 0.5, PCL_S1, 1)
+
+    # Segmentation threshold from the S1 trace (its minimum + 5mV), so it does not depend on
+    # how long the S2 run is. A full length run analysed with it gives the same APDs
+    AP_threshold = V_s1.min() + 5
+
+    # Fork from the end of the S1 train and run the S2 beat only, stopping once the S2 AP has
+    # repolarised at the APD threshold (of the deepest level), or after a PCL if there is no S2 AP
+    s.set_protocol(p)
+    s.set_state(fork_state)
+    s.set_time(end_final_s1)
+    d, stopped = run_until(s, (number_S1 + 1)*PCL_S1 + di - end_final_s1, after_repolarisation(1, AP_threshold, repolarisation), first = di)
+
+    # Calculate APDs (all levels at once) on the final S1 beat and S2 beat
+    # Final S1 AP, from the end of the AP before it so it starts outside an AP
+    ups = np.flatnonzero((V_s1[1:] > AP_threshold) & (V_s1[:-1] <= AP_threshold)) + 1
+    downs = np.flatnonzero((V_s1[1:] < AP_threshold) & (V_s1[:-1] >= AP_threshold)) + 1
+    downs = downs[downs < ups[-1]] if len(ups) else downs
+    first = downs[-1] if len(downs) else 0
+    V = np.concatenate((V_s1[first:], d['membrane.V']))
+    time = np.concatenate((time_s1[first:], d['engine.time']))
+    start, duration, thresh = ap_duration({'membrane.V' : V, 'engine.time' : time}, repolarisation = repolarisation, AP_threshold = AP_threshold, aligned = True, finish_last = stopped)
+
+    # APD of the final AP (the S2 beat), NaN if it has not repolarised
+    return(duration[-1])
+
+# Simulation and fork of each worker process, set once by init_s2_worker
+s2_worker_setup = {}
+
+def init_s2_worker(model_code, constants, fork):
+    s = sim_cache.simulation(myokit.parse_model(model_code))
+    set_constants(s, constants)
+    s2_worker_setup['s'] = s
+    s2_worker_setup['fork'] = fork
+
+def s2_worker(di):
+    return(s2_apd(s2_worker_setup['s'], di, *s2_worker_setup['fork']))
+
 ## Multistability Test Protocol. S1-CI-S2. ##
 ## --------------------------------------- ##
 
@@ -290,26 +482,14 @@ def s1cis2(model, time_per_stage, max_pcl = 1000, min_pcl = 100, number_stages =
     # S1-CI-C2. User should have defined number of bifurcations plots to produce, by number of CIs given.
     number_CI = len(CIs)
     CIs = np.asarray(CIs)
-    cell_types = {0:'Endocardial', 1: 'Epicardial', 2: 'Mid-myocardial'}
-    if model == 'tentusscher-2006':
-        label = 'cell.type'
-        name  = 'Ten-Tusscher (2006)'
-    elif model == 'grandi-2010':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010)'
-    elif model == 'grandi-2010_modified':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010) with late sodium channel'
-    elif model == 'ohara-2011':
-        label = 'cell.mode'
-        name = "O'hara (2011)"
-    elif model == 'ohara-cipa-v1-2017.mmt':
-        label = 'cell.celltype'
-        name = "O'hara- CiPA (2017)"
-
-    m = myokit.load_model('{}.mmt'.format(model))
+    # Cell type constant and name from the registry
+    info = model_registry.model_info(model)
+    label = info['cell_type_label']
+    name = info['name']
+    cell_types = info['cell_types']
+    model_registry.check_cell_type(model, cell_type)
+
+    m = model_registry.load_model(model)
 
     # Log spaced : more points around high pacing, more likely to see graph bifurcate
     #pacing_list = np.logspace(np.log10(min_pcl), np.log10(max_pcl), num = number_stages, base = 10.0)[::-1]
@@ -319,35 +499,22 @@ def s1cis2(model, time_per_stage, max_pcl = 1000, min_pcl = 100, number_stages =
     pacing_list = [int(i) for i in pacing_list]
 
     for ci in CIs:
-        # Empty arrays to fill.
-        period = []
-        offset_list = []
-        offset = 0
-        # Blank protocol to add to
-        p = myokit.Protocol()
-
         # Starting at low frequency pacing (1Hz), 30 seconds at each pacing and then moving towards 230ms
-        for pacing in pacing_list:
-            beats_per_pace = (time_per_stage)/pacing
-            p.schedule(1, start = offset, duration =0.5, period = pacing, multiplier = beats_per_pace)
-            offset_list.append(offset)
-            # Next set of pacing events to be scheduled, CI from last stimulus of S1 beat to first stimulus of S2 beat
-            offset += (beats_per_pace-1)*pacing + ci
-            period.append(pacing)
+        # Next stage starts CI from the last stimulus of the stage before
+        beats_per_pace = [(time_per_stage)/pacing for pacing in pacing_list]
+        pacing = from_stages(pacing_list, beats_per_pace, coupling = ci)
+        # Protocol, start of each stage and end of the whole protocol
+        p, offset_list, offset = pacing.protocol(), list(pacing.stage_start), pacing.end
 
         # Set up simulation using this scheduled protocol
-        s = myokit.Simulation(m, p)
+        s = sim_cache.simulation(m, p)
         s.set_constant(label, cell_type)
 
         # Run the simulation with final offset value, equal to time passed for whole protocol
         d = s.run(offset, log = ['membrane.V','engine.time'])
 
-        # Including log of paces, as pacing is not constant, changes threshold for each pace
-        logint = p.create_log_for_interval(0, p.characteristic_time(), for_drawing = True)
-
-        # Use ap_duration function to calculate start times and durations
-        #start, duration, thresh = ap_duration(d, 30000*len(pacing_list), repolarisation = 95, log_for_interval = logint)
-        start, duration, thresh = apd_dynamic(d, p, time_per_stage*len(pacing_list), repolarisation = repolarisation)
+        # Thresholds for each stage, as pacing is not constant
+        start, duration, thresh = apd_dynamic(d, p, repolarisation = repolarisation, per_stage = True, stage_start = offset_list)
 
         # Numpy array to contain final APD for each pacing cycle (and 3 previous APs in case of alternans)
         final_apd = np.zeros(len(offset_list))
@@ -369,30 +536,17 @@ def s1cis2(model, time_per_stage, max_pcl = 1000, min_pcl = 100, number_stages =
                 pl.axvline(x= value, color = 'red', ls = 'dotted', ymin = 0.05, ymax = 0.96)
 
 
-        # Fill arrays with APDs for last few APs at each PCL
-        for i in range(len(offset_list)):
-            # Final peak of pacing cycle = peak before the first of a new pacing cycle
-
-            # Index_start = The index of the start of pacing cycle in start array
-            print start
-            print offset_list
-            index_start = np.nonzero(start >= offset_list[i])[0][0]
-
-            pl.arrow(start[index_start-2], thresh[index_start-2], duration[index_start-2], 0, head_width=2, head_length=duration[index_start-2]/3, length_includes_head=True)
+        # Fill arrays with APDs for last few APs at each PCL (results already split by stage)
+        for i in range(len(pacing_list)):
+            # Second to last AP of the stage, as the last may run into the next stage
+            pl.arrow(start[i][-2], thresh[i][-2], duration[i][-2], 0, head_width=2, head_length=duration[i][-2]/3, length_includes_head=True)
             #pl.text(start + duration_ap/3, -90, str(int(duration_ap)) + ' ms')
 
-            # index_1 -1 to get peak at the end of the previous cycle
-            final_apd[i] = duration[index_start -2]
-            final_apd2[i] = duration[index_start - 3]
-            final_apd3[i] = duration[index_start - 4]
-            final_apd4[i] = duration[index_start - 5]
-
-        # The final peak doesn't have a peak after it, so can be indexed by the final duration recorded
-        final_apd[-1] = duration[-2]
-        # If the graph has a long-short pattern, take previous APDs and DIs as well
-        final_apd2[-1] = duration[-3]
-        final_apd3[-1] = duration[-4]
-        final_apd4[-1] = duration[-5]
+            # If the graph has a long-short pattern, take previous APDs as well
+            final_apd[i] = duration[i][-2]
+            final_apd2[i] = duration[i][-3]
+            final_apd3[i] = duration[i][-4]
+            final_apd4[i] = duration[i][-5]
 
         # Plot the restitution curve
         pl.figure()
@@ -2,37 +2,29 @@
 import myokit
 import matplotlib.pyplot as pl
 from manual_APD import ap_duration
+from streaming_APD import run_windows
+from pacing_protocol import PacingProtocol, beat_table, trace_beat_table
+import model_registry
+import sim_cache
+import steady_cache
 import numpy as np
 
 
 ## Return Loop protocol ##
 
 # Plots for protocol, APs and restitution curve
-def return_loop(model, number_runs = 30, cell_type = 0, AP_plot = False, protocol_plot = True, restitution_curve = True, linear = True):
-
-    cell_types = {0:'Endocardial', 1: 'Epicardial', 2: 'Mid-myocardial'}
-    if model == 'tentusscher-2006':
-        label = 'cell.type'
-        name  = 'Ten-Tusscher (2006)'
-    elif model == 'grandi-2010':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010)'
-    elif model == 'grandi-2010_modified':
-        label = 'type.epi'
-        cell_types = {0:'Endocardial', 1: 'Epicardial'}
-        name = 'Grandi (2010) with late sodium channel'
-    elif model == 'ohara-2011':
-        label = 'cell.mode'
-        name = "O'hara (2011)"
-    elif model == 'ohara-cipa-v1-2017.mmt':
-        label = 'cell.celltype'
-        name = "O'hara- CiPA (2017)"
-
-    m = myokit.load_model('{}.mmt'.format(model))
-
-    # Protocol
-    p = myokit.Protocol()
+# window (ms): run in windows of this length and analyse each as it comes, so the full
+# trace is never held in memory (no AP plot in this case)
+def return_loop(model, number_runs = 30, cell_type = 0, AP_plot = False, protocol_plot = True, restitution_curve = True, linear = True, window = None):
+
+    # Cell type constant and name from the registry
+    info = model_registry.model_info(model)
+    label = info['cell_type_label']
+    name = info['name']
+    cell_types = info['cell_types']
+    model_registry.check_cell_type(model, cell_type)
+
+    m = model_registry.load_model(model)
 
 
     max_pcl = 600
@@ -59,37 +51,28 @@ def return_loop(model, number_runs = 30, cell_type = 0, AP_plot = False, protoco
 
     # Generate integer pacing values from instantaneous HR
     pacing_list = [int(element) for element in hr_pacing_list]
-    beats_per_pace = 1
-
-    # Setting initital offset to zero
-    offset = 0
-
-    # Empty array to store offsets of new pacing in
-    offset_array = []
 
-    # Array to store every PCL in
-    pace_array = []
-
-    for number in range(0, number_runs):
-        # Create protocol for healthy heart pacing
-        for pacing in pacing_list:
-
-            p.schedule(1, start = offset, duration = 0.5, period = pacing, multiplier = beats_per_pace)
-            offset_array.append(offset)
-            offset += beats_per_pace*pacing
-            pace_array.append(pacing)
+    # Protocol of number_runs loops, PCL and start time of every beat
+    pacing = PacingProtocol(np.tile(pacing_list, number_runs))
+    p, offset, pace_array, offset_array = pacing.protocol(), pacing.end, pacing.pcl, pacing.start
 
     ## Create and run simulation for healthy ventricular cell model ##
     ## ------------------------------------------------------------ ##
 
-    s = myokit.Simulation(m, p)
+    s = sim_cache.simulation(m, p)
     s.set_constant(label, cell_type)
-    s.pre(600*100)
+    steady_cache.pre(s, m, p, 600*100, constants = {label : cell_type})
     s.reset()
-    d = s.run(offset, log = ['membrane.V','engine.time'])
-    start, duration, thresh = ap_duration(d, number_runs*len(pacing_list), repolarisation = 90)
+    if window != None:
+        # One column (APD 90), NaN where not repolarised, so APs and durations line up
+        start, duration, thresh = run_windows(s, offset, window, repolarisation = [90], aligned = True)
+        table = beat_table(pacing, start[:len(duration), 0], duration[:, 0])
+    else:
+        d = s.run(offset, log = ['membrane.V','engine.time'])
+        start, duration, thresh = ap_duration(d, repolarisation = 90)
+        table = trace_beat_table(d, pacing, repolarisation = 90)
 
-    if AP_plot != False:
+    if AP_plot != False and window == None:
         # Plot APs for healthy ventricular cell model
         pl.figure()
         pl.plot(d['engine.time'],d['membrane.V'])
@@ -115,20 +98,13 @@ def return_loop(model, number_runs = 30, cell_type = 0, AP_plot = False, protoco
 
     if restitution_curve == True:
         pl.figure()
-        if len(duration)< len(pace_array):
-            pace_array = pace_array[:-1]
-        offset_array = np.asarray(offset_array)
-        pcl_start = np.zeros(len(duration) + 1)
-
-        length = len(duration)
-        for i in range(0,length):
-            z = np.nonzero(offset_array < start[i])[0][-1]
-            pcl_start[i] = pace_array[z]
-
-        pcl_start = pcl_start[np.nonzero(pcl_start)]
-        print 'paces', pcl_start[-101:-1]
+        # PCL before each AP and its APD, from the beat table (beats with an AP that repolarised)
+        beats = table['captured'] & ~np.isnan(table['apd'])
+        pcl_start = table['pcl'][beats]
+        duration = table['apd'][beats]
+        print 'paces', pcl_start[-100:]
         print 'apd', duration[-100:]
-        pl.plot(pcl_start[len(pcl_start)/2 -1: -1], duration[len(pcl_start)/2:], '.', color = 'b')
+        pl.plot(pcl_start[len(pcl_start)/2:], duration[len(pcl_start)/2:], '.', color = 'b')
 
         pl.xlabel('PCL (ms)')
         pl.ylabel('APD (ms)')
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import myokit
+import matplotlib.pyplot as pl
+import multiprocessing
+import numpy as np
+from manual_APD import ap_duration
+from streaming_APD import run_windows
+from beat_log import run_beats
+import sim_cache
+import steady_cache
+from HF_model import set_constants
+
+## Independent scenarios run at the same time ##
+## ------------------------------------------- ##
+
+# HRV (healthy, HF at rest, HF 6-min walk) and dynamic_protocol (healthy, HF) pre-pace and run
+# simulations that do not depend on each other. A scenario holds everything one of them needs,
+# as text (model and protocol code) so it can be sent to a worker process, and run_scenarios
+# runs a list of them on a pool of processes, giving the results back in the same order.
+# Each worker compiles nothing: modules are compiled once here first and loaded from sim_cache
+
+def scenario(m, p, duration, constants = None, pre_pacing = None, HF_model = None, beat = None, run = None, args = ()):
+
+    # m, p: model and protocol. duration: ms run after pre-pacing (from time 0)
+    # constants: dict of constants set on the simulation, e.g. {'cell.celltype' : 0}
+    # pre_pacing, HF_model, beat: passed to steady_cache.pre (no pre-pacing if pre_pacing is None)
+    # run: function(s, m, p, duration, *args) that runs and analyses the scenario, and its
+    # results are returned. It has to be defined at the top level of a module (sent to workers
+    # by name), default run_trace
+    return({
+        'model' : m.code(),
+        'protocol' : p.code(),
+        'duration' : duration,
+        'constants' : constants or {},
+        'pre_pacing' : pre_pacing,
+        'HF_model' : HF_model,
+        'beat' : beat,
+        'run' : run_trace if run == None else run,
+        'args' : args,
+        })
+
+def run_scenario(scenario):
+    # Build the simulation, pre-pace and run one scenario
+    m = myokit.parse_model(scenario['model'])
+    p = myokit.parse_protocol(scenario['protocol'])
+    s = sim_cache.simulation(m, p)
+    set_constants(s, scenario['constants'])
+    if scenario['pre_pacing'] != None:
+        steady_cache.pre(s, m, p, scenario['pre_pacing'], constants = scenario['constants'], HF_model = scenario['HF_model'], beat = scenario['beat'])
+    # Start at time 0 from the pre-paced state
+    s.reset()
+    return(scenario['run'](s, m, p, scenario['duration'], *scenario['args']))
+
+def run_scenarios(scenarios, processes = None):
+    # Results of each scenario, in order. processes: number of worker processes, None to run
+    # them one after another in this process. Finishes when the slowest scenario does
+    if processes == None:
+        return([run_scenario(scenario) for scenario in scenarios])
+
+    # Compile each model once, workers then load it from the cache instead of all compiling it
+    for code in set(scenario['model'] for scenario in scenarios):
+        sim_cache.simulation(myokit.parse_model(code))
+
+    pool = multiprocessing.Pool(min(processes, len(scenarios)))
+    try:
+        # map gives the results back in scenario order
+        return(pool.map(run_scenario, scenarios))
+    finally:
+        pool.close()
+        pool.join()
+
+def run_trace(s, m, p, duration, repolarisation = 90):
+    # Full trace: [onset, duration, thresh] as ap_duration does and the trace
+    d = s.run(duration, log = ['membrane.V','engine.time'])
+    trace = {'membrane.V' : np.asarray(d['membrane.V']), 'engine.time' : np.asarray(d['engine.time'])}
+    return(ap_duration(trace, repolarisation = repolarisation), trace)
+
+def run_window_apd(s, m, p, duration, window = 10000, repolarisation = 90):
+    # Run in windows (streaming_APD.run_windows), no trace kept
+    return(run_windows(s, duration, window, repolarisation = repolarisation), None)
+
+def run_beat_table(s, m, p, duration, pcls, repolarisation = 90):
+    # One beat of each PCL at a time (beat_log.run_beats), results as ap_duration does and the
+    # beat table
+    table = run_beats(s, pcls, repolarisation = repolarisation, state_names = [v.qname() for v in m.states()])
+    return(table.ap_duration(), table)
+
+# Main function for testing
+def main():
+    # Epicardial and endocardial cells at the same time
+    m = myokit.load_model('ohara-cipa-v1-2017.mmt')
+    pcl = 1000
+    p = myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=0)
+    scenarios = [scenario(m, p, 10*pcl, {'cell.celltype' : cell_type}, 100*pcl) for cell_type in [0, 1]]
+    results = run_scenarios(scenarios, processes = 2)
+
+    pl.figure()
+    for (start, duration, thresh), trace in results:
+        pl.plot(trace['engine.time'], trace['membrane.V'])
+    pl.legend(['Endocardial', 'Epicardial'])
+    pl.xlabel('Time (ms)')
+    pl.ylabel('Membrane Potential (mV)')
+    pl.show()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import matplotlib.pyplot as pl
+import myokit
+import numpy as np
+from manual_APD import state_change, steady_pre
+
+## Steady state by shooting ##
+## ------------------------ ##
+
+# Pacing to steady state converges as slowly as the slowest variables (Na_i, K_i, CaMK), which
+# takes hundreds of beats. Here one pacing cycle is a map F on the state vector (one beat run
+# from state x at the start of the cycle) and the steady state is its fixed point F(x) = x.
+# Anderson acceleration finds it from the last few map evaluations, each being one beat (or
+# period beats, period 2 for alternans). No Jacobian is needed, so every iteration costs one
+# map evaluation, where Newton-Krylov would need several.
+
+# Convergence is checked as in manual_APD.steady_pre: no variable changes over one cycle by
+# more than rel_tol*|x| + abs_tol
+
+def cycle_map(s, pcl, period = 1):
+    # F(x): state after period beats of pcl ms from state x, at the start of the protocol cycle
+    # in which s is now. The simulation time is left unchanged
+    start = s.time()
+    def F(x):
+        s.set_state(list(x))
+        s.set_time(start)
+        s.run(period*pcl, log = myokit.LOG_NONE)
+        fx = np.asarray(s.state(), dtype = float)
+        s.set_time(start)
+        return(fx)
+    return(F)
+
+def anderson_steady(s, pcl, period = 1, max_beats = 1000, memory = 5, rel_tol = 1e-4, abs_tol = 1e-6, check_beats = 20):
+
+    # Fixed point of the period beat map, from the current state of s. As with s.pre, the time
+    # is not changed and the state and default state become the steady state.
+    # Returns the number of beats simulated, period and the final change.
+    # check_beats: beats paced from the fixed point to check it is stable
+    F = cycle_map(s, pcl, period)
+    x = np.asarray(s.state(), dtype = float)
+    fx = F(x)
+    beats = period
+
+    # Differences between iterates and between residuals, newest last
+    dX = []
+    dR = []
+    x_previous = r_previous = None
+    best = np.inf
+
+    while True:
+        r = fx - x
+        change = state_change([x, fx], 1, rel_tol, abs_tol)[0]
+        if change <= 1 or beats + period + check_beats > max_beats:
+            break
+
+        # Residuals scaled as the convergence check, so all variables count the same
+        weight = 1.0/(rel_tol*np.maximum(abs(x), abs(fx)) + abs_tol)
+        if change > 10*best:
+            # Diverging, restart from the last map evaluation
+            dX, dR = [], []
+            x_previous = None
+        best = min(best, change)
+
+        if x_previous is not None:
+            dX = (dX + [x - x_previous])[-memory:]
+            dR = (dR + [r - r_previous])[-memory:]
+
+        if len(dR):
+            # Combination of the last residuals closest to zero (least squares)
+            gamma = np.linalg.lstsq(np.transpose(dR)*weight[:, None], r*weight, rcond = -1)[0]
+            x_new = x + r - np.dot(np.transpose(np.add(dX, dR)), gamma)
+        else:
+            # Plain pacing step
+            x_new = fx
+
+        # Keep the sign of variables that do not change sign (concentrations, gates): shorten
+        # the step from the plain pacing step fx until it does, or take the pacing step
+        fixed_sign = np.sign(x) == np.sign(fx)
+        step = x_new - fx
+        for i in range(10):
+            x_new = fx + step
+            if np.all(np.isfinite(x_new)) and not np.any(fixed_sign & (np.sign(x_new) != np.sign(fx))):
+                break
+            step = step/2
+        else:
+            x_new = fx
+            dX, dR = [], []
+        x_previous, r_previous = x, r
+
+        x = x_new
+        fx = F(x)
+        beats += period
+
+    if change <= 1 and check_beats > 0:
+        # Fixed points can be unstable (period 1 orbit during alternans), then pacing moves away
+        # from them. Pace on from the fixed point and check it is still steady
+        for i in range(int(np.ceil(float(check_beats)/period))):
+            x, fx = fx, F(fx)
+            beats += period
+        change = state_change([x, fx], 1, rel_tol, abs_tol)[0]
+        if change > 1:
+            print 'Unstable period {} orbit'.format(period)
+
+    # Start from the final map evaluation, which is one cycle on from x
+    s.set_state(list(fx))
+    s.set_default_state(list(fx))
+    if change > 1:
+        print 'Not steady after {} beats, change {}'.format(beats, change)
+    return(beats, period, change)
+
+def shooting_pre(s, pcl, max_beats = 1000, max_period = 2, rel_tol = 1e-4, abs_tol = 1e-6, check_beats = 20):
+
+    # Same use and results as manual_APD.steady_pre. Looks for a period 1 steady state first.
+    # If there is none or it is unstable (alternans, 2:1 block), looks for the period 2 orbit
+    # the same way. Only if that fails or finds the period 1 orbit again (also a fixed point of
+    # the period 2 map) does pacing go on with the beats left
+    beats, period, change = anderson_steady(s, pcl, 1, max_beats, rel_tol = rel_tol, abs_tol = abs_tol, check_beats = check_beats)
+    if change <= 1 or max_period < 2 or beats + 2*check_beats >= max_beats:
+        return(beats, period, change)
+    # Near an unstable orbit the state hardly changes over 2 beats either, so move away first
+    s.pre(2*check_beats*pcl)
+    beats += 2*check_beats
+    start = s.state()
+    more_beats, period, change = anderson_steady(s, pcl, 2, max_beats - beats, rel_tol = rel_tol, abs_tol = abs_tol, check_beats = check_beats)
+    beats += more_beats
+    if change <= 1 and beats < max_beats:
+        x = np.asarray(s.state(), dtype = float)
+        collapsed = state_change([x, cycle_map(s, pcl, 1)(x)], 1, rel_tol, abs_tol)[0] <= 1
+        beats += 1
+        s.set_state(list(x))
+        if not collapsed:
+            return(beats, period, change)
+    if beats >= max_beats:
+        return(beats, period, change)
+    # Pace on from where the period 2 search started
+    s.set_state(start)
+    more_beats, period, change = steady_pre(s, pcl, max_beats - beats, max_period, rel_tol, abs_tol)
+    return(beats + more_beats, period, change)
+
+# Main function for testing
+def main():
+    # Beats to steady state by pacing and by shooting
+    m = myokit.load_model('ohara-cipa-v1-2017.mmt')
+    pcl = 1000
+    p = myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=0)
+
+    s = myokit.Simulation(m, p)
+    beats, period, change = steady_pre(s, pcl, max_beats = 2000)
+    paced = s.state()
+    print 'Pacing: {} beats'.format(beats)
+
+    s = myokit.Simulation(m, p)
+    beats, period, change = shooting_pre(s, pcl, max_beats = 2000)
+    shot = s.state()
+    print 'Shooting: {} beats'.format(beats)
+
+    pl.figure()
+    pl.semilogy(abs(np.asarray(paced) - np.asarray(shot))/(abs(np.asarray(paced)) + 1e-6), 'x')
+    pl.xlabel('State variable')
+    pl.ylabel('Relative difference, pacing and shooting')
+    pl.show()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import myokit
+import numpy as np
+
+## Cache of compiled simulations ##
+## ----------------------------- ##
+
+# myokit.Simulation(m, p) generates and compiles a C module every time, which takes seconds.
+# simulation(m, p) returns a Simulation that reuses a module compiled before for the same
+# generated code: first from this process, then from disk (compiled_cache folder), and only
+# compiles when neither has it. The disk cache is trimmed to max_size bytes, removing the
+# least recently used modules first.
+
+# CachedSimulation overrides myokit's private Simulation._compile and _run, and sets constants
+# and tolerances on the shared module itself, so it only works with the myokit versions it was
+# written for, and only if the private methods it relies on are as expected. With any other
+# myokit, simulation gives a plain myokit.Simulation (compiled every time) after a warning
+myokit_versions = ['1.28.0']
+
+def check_myokit():
+    # None if the cache can be used with this myokit, else the reason it cannot
+    if myokit.version(raw = True) not in myokit_versions:
+        return('sim_cache needs myokit {}, found {}'.format(' or '.join(myokit_versions), myokit.version(raw = True)))
+    # Arguments of the private myokit methods that are overridden or called
+    if sys.hexversion >= 0x03000000:
+        from inspect import getfullargspec as argspec
+    else:
+        from inspect import getargspec as argspec
+    expected = {
+        '_compile' : ['self', 'name', 'tpl', 'tpl_vars', 'libs', 'libd', 'incd', 'flags'],
+        '_run' : ['self', 'duration', 'log', 'log_interval', 'log_times', 'apd_threshold', 'progress', 'msg'],
+        '_export' : ['self', 'source', 'varmap', 'target'],
+        }
+    for method, args in expected.items():
+        try:
+            found = argspec(getattr(myokit.Simulation, method)).args
+        except (AttributeError, TypeError):
+            found = None
+        if found != args:
+            return('sim_cache: myokit.Simulation.{} is not as expected'.format(method))
+    return(None)
+
+# Checked once, warned about on the first simulation
+unsupported = check_myokit()
+warned = []
+
+# Delete the folder to clear it
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compiled_cache')
+max_size = 500*1024*1024
+
+# Modules loaded in this process, by key
+modules = {}
+# Simulation that last ran each module, and the constants ever changed on it
+active = {}
+changed_constants = {}
+
+def simulation(m, p = None, apd_var = None):
+    # Use in place of myokit.Simulation(m, p)
+    if unsupported is not None:
+        if not warned:
+            print 'Warning: {}, simulations are not cached'.format(unsupported)
+            warned.append(True)
+        return(myokit.Simulation(m, p, apd_var))
+    return(CachedSimulation(m, p, apd_var))
+
+class CachedSimulation(myokit.Simulation):
+
+    # Simulations of the same model share one C module. Constants, tolerances and step sizes
+    # live in the module, so they are recorded here and set again whenever a different
+    # simulation runs on the module than the one that ran last.
+
+    def __init__(self, model, protocol = None, apd_var = None):
+        self.tolerance = (1e-6, 1e-4)
+        self.max_step_size = None
+        self.min_step_size = None
+        super(CachedSimulation, self).__init__(model, protocol, apd_var)
+        active[self.cache_key] = self
+        # A new simulation starts from the model's own constants
+        self.activate(force = True)
+
+    def _compile(self, name, tpl, tpl_vars, libs, libd = None, incd = None, flags = None):
+        # Key from the code generated with a fixed module name, as myokit numbers its modules
+        tpl_vars = dict(tpl_vars)
+        tpl_vars['module_name'] = 'myokit_sim_cached'
+        h = hashlib.sha1()
+        h.update(as_bytes(self._export(tpl, tpl_vars)))
+        h.update(as_bytes(repr((libs, libd, incd, flags))))
+        h.update(as_bytes(repr((myokit.version(raw = True), sys.version, platform.platform()))))
+        key = h.hexdigest()
+        self.cache_key = key
+
+        if key in modules:
+            return(modules[key])
+
+        # Module name has to be the same when it is loaded again from disk
+        name = 'myokit_sim_' + key[:20]
+        tpl_vars['module_name'] = name
+        path = os.path.join(cache_dir, key)
+        if not os.path.isdir(path):
+            build(self, name, tpl, tpl_vars, libs, libd, incd, flags, path)
+        # Used now, so last to be removed
+        os.utime(path, None)
+        modules[key] = load_module(name, path)
+        return(modules[key])
+
+    def activate(self, force = False):
+        # Put this simulation's settings back into the shared module if another one ran last
+        if active.get(self.cache_key) is self and not force:
+            return
+        active[self.cache_key] = self
+        for qname in changed_constants.get(self.cache_key, ()):
+            self._sim.set_constant(qname, float(self._model.get(qname).rhs().eval()))
+        super(CachedSimulation, self).set_tolerance(*self.tolerance)
+        super(CachedSimulation, self).set_max_step_size(self.max_step_size)
+        super(CachedSimulation, self).set_min_step_size(self.min_step_size)
+
+    def _run(self, *args, **kwargs):
+        self.activate()
+        return(super(CachedSimulation, self)._run(*args, **kwargs))
+
+    def eval_derivatives(self, *args, **kwargs):
+        self.activate()
+        return(super(CachedSimulation, self).eval_derivatives(*args, **kwargs))
+
+    def set_constant(self, var, value):
+        self.activate()
+        super(CachedSimulation, self).set_constant(var, value)
+        if isinstance(var, myokit.Variable):
+            var = var.qname()
+        changed_constants.setdefault(self.cache_key, set()).add(self._model.get(var).qname())
+
+    def set_tolerance(self, abs_tol = 1e-6, rel_tol = 1e-4):
+        self.activate()
+        super(CachedSimulation, self).set_tolerance(abs_tol, rel_tol)
+        self.tolerance = (abs_tol, rel_tol)
+
+    def set_max_step_size(self, dtmax = None):
+        self.activate()
+        super(CachedSimulation, self).set_max_step_size(dtmax)
+        self.max_step_size = dtmax
+
+    def set_min_step_size(self, dtmin = None):
+        self.activate()
+        super(CachedSimulation, self).set_min_step_size(dtmin)
+        self.min_step_size = dtmin
+
+def build(sim, name, tpl, tpl_vars, libs, libd, incd, flags, path):
+
+    # Compile the module into path, as myokit does in a temporary folder
+    from setuptools import setup, Extension
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    d_temp = tempfile.mkdtemp(prefix = 'build_', dir = cache_dir)
+    try:
+        d_build = os.path.join(d_temp, 'build')
+        d_modul = os.path.join(d_temp, 'module')
+        os.makedirs(d_build)
+        os.makedirs(d_modul)
+        src_file = os.path.join(d_temp, 'source.c')
+        sim._export(tpl, tpl_vars, src_file)
+
+        ext = Extension(
+            str(name),
+            sources = [str(src_file)],
+            libraries = None if libs is None else [str(x) for x in libs],
+            library_dirs = None if libd is None else [str(x) for x in libd],
+            runtime_library_dirs = None if (libd is None or platform.system() == 'Windows') else [str(x) for x in libd],
+            include_dirs = None if incd is None else [str(x) for x in incd],
+            extra_compile_args = None if flags is None else [str(x) for x in flags],
+        )
+        with myokit.SubCapture() as s:
+            try:
+                setup(
+                    name = str(name),
+                    description = 'Temporary module',
+                    ext_modules = [ext],
+                    script_args = [
+                        str('build'),
+                        str('--build-base=' + d_build),
+                        str('install'),
+                        str('--install-lib=' + d_modul),
+                        str('--old-and-unmanageable'),
+                    ])
+            except (Exception, SystemExit) as e:
+                s.disable()
+                raise myokit.CompilationError('Unable to compile.\n' + str(e) + '\n' + s.text())
+            finally:
+                if os.path.exists(name + '.egg-info'):
+                    shutil.rmtree(name + '.egg-info')
+
+        # Another process may have finished the same module first, then keep theirs
+        try:
+            os.rename(d_modul, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    finally:
+        shutil.rmtree(d_temp, ignore_errors = True)
+
+    trim(keep = path)
+
+def trim(keep = None):
+    # Remove least recently used modules until the cache is below max_size
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for key in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, key)
+        if not os.path.isdir(path) or key.startswith('build_'):
+            continue
+        size = 0
+        for folder, subfolders, files in os.walk(path):
+            size += sum(os.path.getsize(os.path.join(folder, f)) for f in files)
+        entries.append((os.path.getmtime(path), size, path))
+
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+    for last_used, size, path in entries:
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors = True)
+        total -= size
+
+def load_module(name, path):
+    # Load a compiled module from a folder (same as myokit's own loading)
+    if sys.hexversion >= 0x03050000:
+        import importlib.machinery
+        import importlib.util
+        spec = importlib.machinery.PathFinder.find_spec(name, [path])
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return(module)
+    import imp
+    f, pathname, description = imp.find_module(name, [path])
+    f.close()
+    return(imp.load_dynamic(name, pathname))
+
+def as_bytes(text):
+    # Python 2 strings are already bytes
+    return(text if isinstance(text, bytes) else text.encode('utf-8'))
+
+# Main function for testing
+def main():
+    m = myokit.load_model('ohara-cipa-v1-2017.mmt')
+    p = myokit.pacing.blocktrain(1000, 0.5, offset=0, level=1.0, limit=0)
+
+    for run in ['first', 'second']:
+        start = time.time()
+        s = simulation(m, p)
+        print 'Creating simulation ({}) took {} s'.format(run, np.round(time.time() - start, 2))
+
+    # Two simulations on one module keep their own cell types
+    s1 = simulation(m, p)
+    s1.set_constant('cell.celltype', 1)
+    s2 = simulation(m, p)
+    d1 = s1.run(1000)
+    d2 = s2.run(1000)
+    print 'Epicardial and endocardial peak', max(d1['membrane.V']), max(d2['membrane.V'])
+
+if __name__ == "__main__":
+    main()
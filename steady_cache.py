@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import myokit
+import numpy as np
+from manual_APD import steady_pre
+from shooting import shooting_pre
+
+## Cache of pre-paced states ##
+## ------------------------- ##
+
+# s.pre(...) for a few hundred beats takes minutes, and the same model, cell type and protocol
+# is pre-paced again by every protocol function and script. pre() below does the same as
+# s.pre(duration) but stores the final state on disk, and the next call with the same set up
+# loads it instead of simulating.
+
+# States are stored as .npz files in this folder, one per set up. Delete the folder to clear it
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'steady_state_cache')
+
+def pre(s, m, p, duration, constants = None, HF_model = None, tolerance = None, cache = True, beat = None, solver = 'shooting'):
+
+    # Pre-pace simulation s (made from model m and protocol p) for duration ms.
+    # constants: dict of constants set on s with set_constant, e.g. {'cell.celltype' : 0}
+    # tolerance: (abs, rel) if set on s with set_tolerance. Both are part of the key,
+    # as they can not be read back from the simulation.
+    # beat: length of one beat (or one cycle of the protocol). If given, pre-pace one beat at a
+    # time and stop once the state is steady (manual_APD.steady_pre), duration is then the most
+    # it runs for. Returns the number of beats taken (also when loaded from the cache)
+    # solver: how the steady state is found with beat given, 'shooting' (shooting.shooting_pre)
+    # or 'pace' (pacing only, manual_APD.steady_pre)
+    # As with s.pre, the state and default state are set to the pre-paced state
+    if cache == False:
+        return(run_pre(s, duration, beat, solver))
+
+    path = os.path.join(cache_dir, state_key(s, m, p, duration, constants, HF_model, tolerance, beat, solver) + '.npz')
+    if os.path.isfile(path):
+        stored = np.load(path)
+        state = list(stored['state'])
+        s.set_default_state(state)
+        s.set_state(state)
+        return(None if beat == None else int(stored['beats']))
+
+    beats = run_pre(s, duration, beat, solver)
+
+    # Write to a temporary file first, so an interrupted run never leaves half a state
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    temp_path = path + '.{}.tmp'.format(os.getpid())
+    with open(temp_path, 'wb') as f:
+        np.savez(f, state = np.asarray(s.state(), dtype = float), beats = -1 if beats == None else beats)
+    os.rename(temp_path, path)
+    return(beats)
+
+def run_pre(s, duration, beat = None, solver = 'shooting'):
+    # Fixed length pre-pacing, or until steady (number of beats returned)
+    if beat == None:
+        s.pre(duration)
+        return
+    steady = shooting_pre if solver == 'shooting' else steady_pre
+    beats, period, change = steady(s, beat, max_beats = int(np.ceil(float(duration)/beat)))
+    print 'Steady after {} beats (period {})'.format(beats, period)
+    return(beats)
+
+def state_key(s, m, p, duration, constants = None, HF_model = None, tolerance = None, beat = None, solver = 'shooting'):
+
+    # Hash of everything that changes the pre-paced state. The model source includes any HF
+    # changes made to it, the HF model name is kept as well so keys are easy to tell apart
+    h = hashlib.sha1()
+    h.update(as_bytes(m.code()))
+    h.update(as_bytes(p.code()))
+    h.update(as_bytes(repr(sorted((constants or {}).items()))))
+    h.update(as_bytes(repr(HF_model)))
+    h.update(as_bytes(repr(None if tolerance is None else tuple(float(x) for x in tolerance))))
+    h.update(as_bytes(repr(float(duration))))
+    if beat != None:
+        # Pre-pacing until steady, with the same maximum, can end on a different state
+        h.update(as_bytes(repr(('steady', float(beat), solver))))
+    # Pre-pacing starts from the current state and time
+    h.update(np.asarray(s.state(), dtype = float).tobytes())
+    h.update(as_bytes(repr(float(s.time()))))
+    return(h.hexdigest())
+
+def as_bytes(text):
+    # Python 2 strings are already bytes
+    return(text if isinstance(text, bytes) else text.encode('utf-8'))
+
+def clear():
+    # Remove all cached states
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy') or name.endswith('.npz'):
+            os.remove(os.path.join(cache_dir, name))
+
+# Main function for testing
+def main():
+    import time
+    m = myokit.load_model('ohara-cipa-v1-2017.mmt')
+    pcl = 1000
+    p = myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=0)
+
+    for run in ['first (simulated)', 'second (cached)']:
+        s = myokit.Simulation(m, p)
+        s.set_constant('cell.celltype', 0)
+        start = time.time()
+        pre(s, m, p, 100*pcl, constants = {'cell.celltype' : 0})
+        print 'Pre-pacing {} took {} s'.format(run, np.round(time.time() - start, 2))
+
+if __name__ == "__main__":
+    main()
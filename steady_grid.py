@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import myokit
+import matplotlib.pyplot as pl
+import numpy as np
+from shooting import shooting_pre
+import model_registry
+import sim_cache
+import steady_cache
+from HF_model import *
+
+## Grid of steady states over PCL ##
+## ------------------------------ ##
+
+# Each stage of a dynamic protocol (and each PCL of a sweep) starts from the state the last stage
+# ended in, or the model's initial state, and spends most of its beats settling. Here the steady
+# state of a model (cell type, HF model) is found once at each PCL of a grid and stored on disk,
+# and lookup gives the state at any PCL to start from, so only a few settling beats are needed.
+# Grids can be over any PCLs, e.g. the stages of a protocol (restitution_protocols.dynamic_protocol
+# warm_start). The grid is found from the longest PCL down, each PCL starting from the state at
+# the one before (shooting.shooting_pre: period 2 state where there is alternans)
+
+# Default grid (ms)
+default_pcls = np.arange(200, 2001, 100)
+
+def grid(m, constants = None, pcls = default_pcls, max_beats = 1000, HF_model = None, cache = True):
+    # PCLs (longest first) and the steady state at each, one row per PCL, for model m with
+    # constants set. Stored in the steady_cache folder, loaded from there when found before
+    pcls = np.sort(np.asarray(pcls, dtype = float))[::-1]
+    constants = constants or {}
+    path = os.path.join(steady_cache.cache_dir, 'grid_' + grid_key(m, constants, pcls, max_beats, HF_model) + '.npz')
+    if cache and os.path.isfile(path):
+        stored = np.load(path)
+        return(stored['pcls'], stored['states'])
+
+    s = sim_cache.simulation(m, myokit.pacing.blocktrain(pcls[0], 0.5, offset=0, level=1.0, limit=0))
+    set_constants(s, constants)
+    states = []
+    for pcl in pcls:
+        s.set_protocol(myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=0))
+        s.set_time(0)
+        beats, period, change = shooting_pre(s, pcl, max_beats)
+        print 'PCL {} ms steady after {} beats (period {})'.format(pcl, beats, period)
+        states.append(s.state())
+    states = np.asarray(states, dtype = float)
+
+    if cache:
+        # Write to a temporary file first, so an interrupted run never leaves half a grid
+        if not os.path.isdir(steady_cache.cache_dir):
+            os.makedirs(steady_cache.cache_dir)
+        temp_path = path + '.{}.tmp'.format(os.getpid())
+        with open(temp_path, 'wb') as f:
+            np.savez(f, pcls = pcls, states = states)
+        os.rename(temp_path, path)
+    return(pcls, states)
+
+def grid_key(m, constants, pcls, max_beats, HF_model):
+    # Hash of everything that changes the grid
+    h = hashlib.sha1()
+    h.update(steady_cache.as_bytes(m.code()))
+    h.update(steady_cache.as_bytes(repr(sorted(constants.items()))))
+    h.update(steady_cache.as_bytes(repr(HF_model)))
+    h.update(steady_cache.as_bytes(repr((list(pcls), max_beats))))
+    return(h.hexdigest())
+
+def model_grid(model, cell_type = 1, HF_model = None, HF_severity = 1.0, pcls = default_pcls, max_beats = 1000):
+    # grid for a model from the registry, with cell type and HF model (e.g. 'Gomez') set
+    info = model_registry.model_info(model)
+    model_registry.check_cell_type(model, cell_type)
+    constants = {info['cell_type_label'] : cell_type}
+    if HF_model != None:
+        m_str = model_registry.HF_model_name(model, HF_model)
+        m = scaled_model(HF_base_model(m_str))
+        constants.update(HF_constants(m_str, cell_type, HF_severity))
+    else:
+        m = model_registry.load_model(model)
+    return(grid(m, constants, pcls, max_beats, HF_model))
+
+def lookup(pcls, states, pcl, interpolate = True):
+    # State to start from at pcl: linear between the two grid PCLs either side, or the nearest
+    # grid PCL (always outside the grid, with a warning as that state can be far from steady at
+    # pcl: build the grid over the PCLs it is used for)
+    order = np.argsort(pcls)
+    pcls = np.asarray(pcls, dtype = float)[order]
+    states = np.asarray(states, dtype = float)[order]
+    if pcl < pcls[0] or pcl > pcls[-1]:
+        print 'Warning: PCL {} ms outside the grid ({} to {} ms), using the state at {} ms'.format(pcl, pcls[0], pcls[-1], pcls[np.argmin(abs(pcls - pcl))])
+    if not interpolate or pcl <= pcls[0] or pcl >= pcls[-1]:
+        return(list(states[np.argmin(abs(pcls - pcl))]))
+    i = np.searchsorted(pcls, pcl) - 1
+    weight = (pcl - pcls[i])/(pcls[i + 1] - pcls[i])
+    return(list((1 - weight)*states[i] + weight*states[i + 1]))
+
+# Main function for testing
+def main():
+    # Beats to settle at 450 ms from the initial state and from the grid
+    model = 'ohara-cipa-v1-2017'
+    pcls, states = model_grid(model, cell_type = 0)
+    from manual_APD import steady_pre
+    m = model_registry.load_model(model)
+    pcl = 450
+    s = sim_cache.simulation(m, myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=0))
+    s.set_constant('cell.celltype', 0)
+    for start in ['initial state', 'grid']:
+        s.reset()
+        if start == 'grid':
+            s.set_state(lookup(pcls, states, pcl))
+        beats, period, change = steady_pre(s, pcl, max_beats = 2000)
+        print 'From {}: steady after {} beats'.format(start, beats)
+
+    pl.figure()
+    pl.plot(pcls, states[:, m.get('sodium.nai').indice()], 'x-')
+    pl.xlabel('PCL (ms)')
+    pl.ylabel('Steady state Na_i (mM)')
+    pl.show()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import matplotlib.pyplot as pl
+import myokit
+import numpy as np
+from manual_APD import ap_duration, ap_segments, apd_thresholds
+
+## Streaming APD calculation ##
+## ------------------------- ##
+
+# Long protocols (HRV, return loop, dynamic protocol) are run in windows instead of one s.run.
+# Each window is passed to a StreamingAPD, which keeps only the samples since the end of the
+# last finished AP and throws the rest away. Peak memory depends on the window, not the protocol
+
+# Results follow ap_duration: onset of every AP, durations where repolarisation was found (one
+# per completed AP, NaN where not found, with aligned = True) and the threshold of each
+# completed AP. Differences to ap_duration on the full trace:
+# - The segmentation threshold is the minimum voltage + 5mV of the first window (or given), as
+#   the minimum of the whole trace is not known until the end. The first window should hold a beat
+# - An AP whose repolarisation is never found is given up on once a later AP has repolarised
+# - While nothing repolarises (block, depolarised arrest) only the last max_buffer ms are kept,
+#   so an AP, or resting stretch before one, longer than that is cut short: the AP is given up
+#   on, the resting value is found from the part kept
+
+class StreamingAPD(object):
+
+    def __init__(self, repolarisation = 90, AP_threshold = None, aligned = False, max_buffer = 20000):
+        self.repolarisation = repolarisation
+        self.AP_threshold = AP_threshold
+        self.aligned = aligned
+        self.max_buffer = max_buffer
+
+        # Samples carried over to the next window, starting at the end of the last finished AP
+        self.V = np.zeros(0)
+        self.time = np.zeros(0)
+
+        # Results of finished APs, one array per window
+        self.onset = []
+        self.duration = []
+        self.thresh = []
+
+    def add(self, d):
+        # Analyse a new window of a simulation log. Only the carried over samples are kept
+        V = np.asarray(d['membrane.V'], dtype = float)
+        time = np.asarray(d['engine.time'], dtype = float)
+        if len(V) == 0:
+            return
+
+        # Drop a time point logged at the end of one window and the start of the next
+        if len(self.time) and time[0] <= self.time[-1]:
+            V = V[1:]
+            time = time[1:]
+
+        if self.AP_threshold is None:
+            # Segmenting each period using the minimum voltage (of the first window) + 5mV
+            self.AP_threshold = V.min() + 5
+
+        self.V = np.concatenate((self.V, V))
+        self.time = np.concatenate((self.time, time))
+        self.analyse(final = False)
+
+    def finish(self):
+        # Analyse what is left and return [onset, duration, thresh] as ap_duration does
+        if len(self.V) > 1:
+            self.analyse(final = True)
+        levels = np.ndim(self.repolarisation) > 0
+        shape = (0, len(self.repolarisation)) if levels else (0,)
+
+        onset = np.concatenate(self.onset) if self.onset else np.zeros(shape)
+        duration = np.concatenate(self.duration) if self.duration else np.zeros(shape)
+        thresh = np.concatenate(self.thresh) if self.thresh else np.zeros(shape)
+        if not self.aligned:
+            # Only return durations of APs where repolarisation was found (at every level)
+            duration = duration[~np.isnan(duration).any(axis = 1)] if levels else duration[~np.isnan(duration)]
+        return[onset, duration, thresh]
+
+    def analyse(self, final = False):
+        V = self.V
+        time = self.time
+        upstroke, end, onset, resting_values, peak_values = ap_segments(V, time, self.AP_threshold)
+        onset_apd, duration_ap, thresh = apd_thresholds(V, time, self.AP_threshold, onset, resting_values, peak_values, self.repolarisation)
+        if np.ndim(self.repolarisation) > 0:
+            repolarised = ~np.isnan(duration_ap).any(axis = 1)
+        else:
+            repolarised = ~np.isnan(duration_ap)
+
+        if final:
+            # Everything left, including the onset of an AP that has not finished
+            self.store(onset_apd, duration_ap, thresh, len(peak_values), len(onset_apd))
+            return
+
+        # APs up to the last one that has repolarised cannot change with more samples
+        finished = np.flatnonzero(repolarised)
+        if len(finished) == 0:
+            # Nothing to store, but the samples are not left to grow with the protocol: only the
+            # last max_buffer ms are kept
+            if time[-1] - time[0] > self.max_buffer:
+                start = np.searchsorted(time, time[-1] - self.max_buffer)
+                self.V = V[start:].copy()
+                self.time = time[start:].copy()
+            return
+        last = finished[-1]
+        self.store(onset_apd, duration_ap, thresh, last + 1, last + 1)
+
+        # Keep from the end of that AP, where the resting window of the next AP starts
+        self.V = V[end[last]:].copy()
+        self.time = time[end[last]:].copy()
+
+    def store(self, onset_apd, duration_ap, thresh, number_completed, number_onsets):
+        self.onset.append(onset_apd[:number_onsets])
+        self.duration.append(duration_ap[:number_completed])
+        self.thresh.append(thresh[:number_completed])
+
+def run_windows(s, duration, window = 10000, repolarisation = 90, AP_threshold = None, aligned = False, max_buffer = 20000):
+
+    # Run simulation s for duration in windows of at most window ms, analysing each window
+    # as it comes. Returns [onset, duration, thresh] as ap_duration does
+    analyser = StreamingAPD(repolarisation = repolarisation, AP_threshold = AP_threshold, aligned = aligned, max_buffer = max_buffer)
+    number_windows = int(np.ceil(float(duration)/window))
+    for i in range(number_windows):
+        d = s.run(min(window, duration - i*window), log = ['membrane.V','engine.time'])
+        analyser.add(d)
+        # Window is no longer needed
+        del d
+    return(analyser.finish())
+
+# Main function for testing
+def main():
+    # Streaming against the full trace for a short train of beats
+    m = myokit.load_model('ohara-cipa-v1-2017.mmt')
+    pcl = 1000
+    paces = 30
+    p = myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=0)
+    s = myokit.Simulation(m,p)
+    s.pre(100*pcl)
+    state = s.state()
+
+    d = s.run(paces*pcl, log = ['membrane.V','engine.time'])
+    start, duration, thresh = ap_duration(d)
+
+    s.reset()
+    s.set_state(state)
+    stream_start, stream_duration, stream_thresh = run_windows(s, paces*pcl, window = 2500)
+
+    print 'Full trace APDs', duration[-5:]
+    print 'Streamed APDs', stream_duration[-5:]
+
+    pl.figure()
+    pl.plot(duration, '.')
+    pl.plot(stream_duration, 'x')
+    pl.xlabel('Beat')
+    pl.ylabel('APD 90 (ms)')
+    pl.legend(['Full trace', 'Streamed'])
+    pl.show()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+import numpy as np
+import HF_severity
+
+## Severity sweep of restitution slope and onsets ##
+## ---------------------------------------------- ##
+
+def test_onset_pcls():
+    # Longest PCL with each response, nan for responses adaptive_stages did not find
+    onsets = HF_severity.onset_pcls({'Alternans' : (300, 350)})
+    assert onsets[0] == 300 and np.isnan(onsets[1])
+    assert np.allclose(HF_severity.onset_pcls({'Alternans' : (300, 350), '2:1 block' : (200, 250)}), [300, 200])
+
+def test_severity_restitution(monkeypatch):
+    # One S1-S2 slope and one onset row per severity, with the severity and short HF model name
+    # passed on
+    calls = []
+    def s1s2(model, *args, **kwargs):
+        calls.append((model, kwargs['HF_model'], kwargs['HF_severity']))
+        return([], [], 0.5 + kwargs['HF_severity'])
+    def onsets(m_str, cell_type, severity, pacing_list, *args):
+        assert pacing_list[0] == 1000 and pacing_list[-1] == 150
+        return(np.array([400*severity, np.nan]))
+    monkeypatch.setattr(HF_severity, 's1s2_protocol', s1s2)
+    monkeypatch.setattr(HF_severity, 'severity_onsets', onsets)
+
+    severities, slopes, onset = HF_severity.severity_restitution('Ord_HF_Gomez', [0, 0.5, 1])
+    assert [c[1:] for c in calls] == [('Gomez', 0), ('Gomez', 0.5), ('Gomez', 1)]
+    assert calls[0][0] == HF_severity.HF_base_model('Ord_HF_Gomez')
+    assert np.allclose(slopes, [0.5, 1, 1.5])
+    assert onset.shape == (3, 2) and np.allclose(onset[:, 0], [0, 200, 400]) and np.all(np.isnan(onset[:, 1]))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import numpy as np
+from beat_log import run_beats
+from manual_APD import ap_duration
+from test_event_run import TraceSimulation
+from test_manual_APD import synthetic_trace
+
+## Per-beat logging ##
+## ---------------- ##
+
+class StateTraceSimulation(TraceSimulation):
+    # TraceSimulation with a state (the time) for the beat table
+
+    def state(self):
+        return([self.t])
+
+def block_voltage(time):
+    # 2:1 block at a PCL of 250 ms: an AP every other stimulus, each lasting 300 ms
+    return(synthetic_trace([10, 510, 1010, 1510], None, apd = 300, time = time)['membrane.V'])
+
+def test_apd_longer_than_pcl():
+    # Each AP is measured past the end of its beat, as ap_duration measures it on the whole trace
+    pcl = 250
+    table = run_beats(StateTraceSimulation(block_voltage), [pcl]*8)
+    full = TraceSimulation(block_voltage).run(8*pcl)
+    start, duration, thresh = ap_duration(full, AP_threshold = -80, aligned = True)
+
+    assert len(table) == 8
+    assert np.allclose(table['time'], pcl*np.arange(8))
+    assert np.allclose(table['onset'][::2], start)
+    assert np.allclose(table['apd'][::2], duration)
+    assert np.allclose(table['thresh'][::2], thresh)
+    assert np.all(duration > pcl)
+    # Blocked beats have no AP of their own
+    assert np.all(np.isnan(table['onset'][1::2])) and np.all(np.isnan(table['apd'][1::2]))
+
+def test_final_ap_not_repolarised():
+    # The last AP is still going when the run ends: its onset is kept, its APD is not
+    table = run_beats(StateTraceSimulation(block_voltage), [250]*7)
+    assert not np.isnan(table['onset'][6]) and np.isnan(table['apd'][6])
+    onset, duration, thresh = table.ap_duration()
+    assert len(onset) == 4 and len(duration) == 3
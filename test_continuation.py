@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+import numpy as np
+import continuation
+from continuation import columns, follow_branch, multipliers, plot_branch
+
+## Continuation of periodic orbits across PCL ##
+## ------------------------------------------ ##
+
+def test_multipliers_of_linear_map():
+    # F(x) = x0 + A(x - x0) with known eigenvalues, in a rotated basis and with variables of
+    # very different sizes
+    rng = np.random.RandomState(1)
+    Q = np.linalg.qr(rng.randn(4, 4))[0]
+    A = np.dot(Q, np.dot(np.diag([-1.2, 0.7, 0.3, -0.1]), Q.T))
+    x0 = np.array([-85.0, 7.0, 1e-4, 140.0])
+    F = lambda x: x0 + np.dot(A, x - x0)
+    values, vector = multipliers(F, x0)
+    # Past the 4 variables, Arnoldi steps only find rounding error
+    assert np.allclose(values[:4], [-1.2, 0.7, 0.3, -0.1], atol = 1e-6)
+    assert np.all(abs(values[4:]) < 1e-6)
+    assert np.allclose(np.dot(A, vector), -1.2*vector, rtol = 1e-5, atol = 1e-8*np.max(abs(vector)))
+
+def linear_branch(monkeypatch, crossing = 743.0):
+    # Orbits everywhere, with a real multiplier linear in PCL that goes through -1 at crossing
+    def orbit(s, x, pcl, period, max_beats, number_multipliers):
+        mu = -1 - (crossing - pcl)/500.0
+        return(x, 10, True, np.array([mu, 0.1]), np.ones(len(x)))
+    monkeypatch.setattr(continuation, 'orbit', orbit)
+    monkeypatch.setattr(continuation, 'orbit_apd', lambda s, x, pcl, repolarisation: np.array([pcl/4.0, pcl/4.0]))
+
+def test_doubling_interpolated(monkeypatch):
+    crossing = 743.0
+    linear_branch(monkeypatch, crossing)
+    rows, doubling, beats = follow_branch(None, np.zeros(3), 1, 1000, 500, 50, 2, 100, 6, 90)
+    rows = np.asarray(rows)
+    pcl_doubling, pcl, x, vector = doubling
+    # Linear multiplier: interpolation between the PCLs either side is exact
+    assert np.isclose(pcl_doubling, crossing)
+    assert pcl < crossing < rows[list(rows[:, 1]).index(pcl) - 1, 1]
+    # Stable down to the doubling, unstable past it, and beats add up
+    assert np.all(rows[rows[:, 1] > crossing, 2] == 1) and np.all(rows[rows[:, 1] < crossing, 2] == 0)
+    assert np.all(np.diff(rows[:, -1]) == 12)
+
+def test_no_orbits(monkeypatch):
+    # No orbit found at all: an empty table with all the columns
+    monkeypatch.setattr(continuation, 'orbit', lambda s, x, pcl, period, max_beats, number_multipliers: (x, 10, False, None, None))
+    rows, doubling, beats = follow_branch(None, np.zeros(3), 1, 1000, 500, 50, 2, 100, 6, 90)
+    assert rows == [] and doubling is None and beats == 10
+    table = np.asarray(rows, dtype = float).reshape(-1, len(columns))
+    plot_branch(table)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import os
+import myokit
+import numpy as np
+import pytest
+from manual_APD import ap_duration
+from event_run import run_until, after_repolarisation
+from test_manual_APD import synthetic_trace
+import sim_cache
+
+## Runs stopped once the measured AP has repolarised ##
+## ------------------------------------------------ ##
+
+class TraceSimulation(object):
+    # Plays back V(t) on a fixed time step, with the run/time interface run_until uses
+
+    def __init__(self, V, dt = 0.1):
+        self.V = V
+        self.dt = dt
+        self.t = 0.0
+
+    def time(self):
+        return(self.t)
+
+    def run(self, duration, log = None):
+        steps = np.arange(int(round(self.t/self.dt)), int(round((self.t + duration)/self.dt)) + 1)
+        self.t += duration
+        time = steps*self.dt
+        return({'membrane.V' : self.V(time), 'engine.time' : time})
+
+def s1s2_voltage(time):
+    # S1 AP at 20 ms, S2 AP at 420 ms, with an undershoot after the S2 AP lower than anything
+    # before it (so the trace minimum depends on how long the run is)
+    V = synthetic_trace([20, 420], None, apd = 250, time = time)['membrane.V']
+    undershoot = (time > 670) & (time < 1000)
+    V[undershoot] -= 3*np.sin(np.pi*(time[undershoot] - 670)/330.0)
+    return(V)
+
+@pytest.mark.parametrize('chunk', [2, 20])
+def test_stop_at_apd_threshold_matches_full_run(chunk):
+    levels = [50, 90]
+    AP_threshold = -85 + 5
+    full = TraceSimulation(s1s2_voltage).run(1500)
+    start, duration, thresh = ap_duration(full, repolarisation = levels, AP_threshold = AP_threshold, aligned = True)
+
+    d, stopped = run_until(TraceSimulation(s1s2_voltage), 1500, after_repolarisation(2, AP_threshold, levels), chunk = chunk, first = 420)
+    assert stopped
+    # Stopped within a chunk of the APD 90 end (with short chunks, before the AP is back below
+    # AP_threshold)
+    apd_end = start[-1, 1] + duration[-1, 1]
+    assert apd_end <= d['engine.time'][-1] <= apd_end + chunk
+    if chunk == 2:
+        assert d['membrane.V'][-1] > AP_threshold
+
+    stop_start, stop_duration, stop_thresh = ap_duration(d, repolarisation = levels, AP_threshold = AP_threshold, aligned = True, finish_last = True)
+    assert np.allclose(stop_duration[-1], duration[-1])
+    assert np.allclose(stop_thresh[-1], thresh[-1])
+
+def test_stop_without_repolarisation_level():
+    # Back below AP_threshold
+    d, stopped = run_until(TraceSimulation(s1s2_voltage), 1500, after_repolarisation(2, -80))
+    assert stopped
+    assert np.any(d['membrane.V'][d['engine.time'] > 420] < -80)
+
+model_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ohara-cipa-v1-2017.mmt')
+
+def test_s2_apd_matches_full_run():
+    # Forked, stopped S2 run against the whole S1-S2 protocol run and analysed in one go
+    from restitution_protocols import s2_apd
+    m = myokit.load_model(model_file)
+    pcl, number_S1, di, levels = 600, 3, 100, [50, 90]
+    p = myokit.pacing.blocktrain(pcl, 0.5, offset=0, level=1.0, limit=number_S1)
+    try:
+        s = sim_cache.simulation(m, p)
+    except Exception as e:
+        pytest.skip('Cannot compile simulations here: {}'.format(e))
+    d = s.run(number_S1*pcl, log = ['membrane.V','engine.time'])
+    start, duration, thresh = ap_duration(d, repolarisation = 95)
+    end_final_s1 = start[-1] + duration[-1]
+    V_s1 = np.asarray(d['membrane.V'])
+    time_s1 = np.asarray(d['engine.time'])
+    V_s1, time_s1 = V_s1[time_s1 < end_final_s1], time_s1[time_s1 < end_final_s1]
+    s.reset()
+    s.run(end_final_s1, log = myokit.LOG_NONE)
+    apd = s2_apd(s, di, number_S1, pcl, s.state(), end_final_s1, V_s1, time_s1, levels)
+
+    p.schedule(1, end_final_s1 + di, 0.5, pcl, 1)
+    s.set_protocol(p)
+    s.reset()
+    full = s.run((number_S1 + 1)*pcl + di, log = ['membrane.V','engine.time'])
+    start, duration, thresh = ap_duration(full, repolarisation = levels, AP_threshold = V_s1.min() + 5, aligned = True)
+    assert np.allclose(apd, duration[-1], rtol = 1e-3)
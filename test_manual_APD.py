@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pytest
+from manual_APD import ap_duration
+
+## Parity of ap_duration with the original loop ##
+## -------------------------------------------- ##
+
+# baseline_ap_duration is ap_duration as it was before it was vectorised, copied unchanged
+# (sized by paces, zero-filled buffers). It is the reference ap_duration is checked against and
+# should not be edited
+
+def baseline_ap_duration(d, paces, repolarisation = 90):
+
+    # Convert membrane potential and time lists to numpy arrays
+    V = np.asarray(d['membrane.V'])
+    # Depending on model, sometimes environment.time, others engine.time
+    time = np.asarray(d['engine.time'])
+
+    # Blank numpy arrays to contain resting values, max peaks for each AP
+    # Times of peaks, duration of APs and start of AP above some threshold
+    # Assuming no 1:2 (or 1:3 etc.) ratios, so number of paces >= number of APs
+    resting_values = np.zeros(2*paces + 2)
+    peak_values = np.zeros(2*paces + 2)
+    time_of_peak_values = np.zeros(2*paces + 2)
+    onset = np.zeros(2*paces + 2) # Plus 2 in case starts mid AP and ends with incomplete AP
+    duration_ap = np.zeros(2*paces + 2)
+
+    # Segmenting each period using the minimum voltage + 5mV as threshold
+    AP_threshold = min(V) + 5
+    # Boolean whether in AP or outside
+    in_ap = 0
+    # Counter for number of APs
+    responses = 0
+    max_upstroke_velocity = 0.0 # Unsure if needed for this purpose
+    inf = float("inf")
+
+    current_minimum_velocity = inf
+    current_resting_value = inf
+    current_peak = -inf
+    resting_potential_gradient_thresh = 0.01 # Gradient taken from Chaste code
+
+    # Boolean for if section of AP where gradient < 0.01 has been found
+    flat_bit_found = 0
+    apd_end_time = None
+    apd_start_time = None
+
+    # Iterating over time points
+    for i in range(1, len(V)):
+
+        # Gradient calculated using difference in potential over time difference from previous time point
+        voltage_grad = (V[i]-V[i-1])/float((time[i]-time[i-1]))
+        if voltage_grad >= max_upstroke_velocity:
+            max_upstroke_velocity = voltage_grad
+            current_time_upstroke = time[i]
+
+        # Looking for rest section of AP, either flat-ish gradient or minimum voltage
+        if abs(voltage_grad) <= current_minimum_velocity and abs(voltage_grad) <= resting_potential_gradient_thresh and not in_ap:
+            current_minimum_velocity = abs(voltage_grad)
+            current_resting_value = V[i-1]
+            flat_bit_found  = 1
+
+        # Keep storing mimimum voltage if flat bit has not been found for period
+        elif V[i-1] < current_resting_value and flat_bit_found == 0 and not in_ap:
+            current_resting_value = V[i-1]
+
+        ### Crossing threshold. Start of AP ###
+        if V[i] > AP_threshold and V[i-1] <= AP_threshold and not in_ap:
+
+            # Now within AP
+            in_ap = 1
+
+
+            # Set resting value for this AP. Used as minimum
+            resting_values[responses] = current_resting_value
+
+            # Re-initialise these values for next AP
+            current_minimum_velocity = inf
+            current_resting_value = inf
+            flat_bit_found = 0
+
+            # Linear interpolation to store onset time.
+            # y = y0 + (x -x0)*(y1-y0)/(x1 -x0). y: time, x : voltage
+            onset[responses] = time[i-1] + (AP_threshold - V[i-1])*(time[i]-time[i-1])/(V[i]-V[i-1])
+
+            switching_phase = True
+
+        # In AP, record height of the peak and corresponding time. Useful check if printed
+        elif in_ap and V[i] > current_peak:
+            current_peak = V[i]
+            current_peak_time = time[i]
+
+        # Cross threshold again. End of AP. Update variables
+        elif in_ap and V[i] < AP_threshold and V[i-1] >= AP_threshold:
+
+            # No longer in AP
+            in_ap = 0
+
+            # Record peak values
+            peak_values[responses] = current_peak
+            time_of_peak_values[responses] = current_peak_time
+
+            # Updates tally of number of APs
+            responses += 1
+
+            # Re-initialise values for next AP
+            current_peak_time = -inf
+            max_upstroke_velocity = -inf
+            current_peak = AP_threshold
+            current_time_of_upstroke_velocity = 0.0
+
+        # Loop round to next time point
+
+    # Keep only non-zero terms. Matrices containing start and duration of APs at set threshold
+    onset = onset[np.nonzero(onset)]
+    peak_values = peak_values[np.nonzero(peak_values)]
+    time_of_peak_values = time_of_peak_values[np.nonzero(time_of_peak_values)]
+
+    ### Varying thresholds calculated for each AP ###
+    ### ----------------------------------------- ###
+    # Using min and max of each AP, calculating specific percent of AP duration
+
+    # Clone onset matrix, to fill with APD (90/50 etc) starts
+    onset_apd = onset
+    thresh = []
+
+    # Iterating over APs rather than time points
+    for ap_index in range(0, len(peak_values)):
+        # Custom threshold for each AP. Range*(100-repolarisation %) + resting value
+        custom_thresh = resting_values[ap_index] + 0.01*(100-repolarisation)*(peak_values[ap_index]-resting_values[ap_index])
+        thresh.append(custom_thresh)
+        starting_time_index = np.nonzero(time > onset[ap_index])[0][0] - 1
+
+        # The APD 90/50.. threshold is greater than earlier threshold
+        # Look forwards in time
+        if custom_thresh >= AP_threshold:
+            prev_v = V[starting_time_index]
+            prev_t = time[starting_time_index]
+            for t in range(starting_time_index,len(time)):
+                if V[t] > custom_thresh and V[t-1] < custom_thresh:
+                    # Linear interpolation
+                    apd_start_time = prev_t + ((custom_thresh - prev_v) / float(V[t] - prev_v)) * (time[t] - prev_t)
+                    onset_apd[ap_index] = apd_start_time
+                    apd_starting_index = t
+                    break
+                prev_v = V[t]
+                prev_t = time[t]
+
+        # Look backwards to find custom threshold, i.e. threshold is lower than previous threshold used
+        else:
+            prev_v = V[starting_time_index + 1]
+            prev_t = time[starting_time_index + 1]
+            for t in range(starting_time_index, 0, -1):
+                if V[t] < custom_thresh:
+                    # Linear interpolation
+                    apd_start_time = prev_t + ((custom_thresh - prev_v) / float((V[t] - prev_v))) * (time[t] - prev_t)
+                    onset_apd[ap_index] = apd_start_time
+                    apd_starting_index = (t + 1);
+                    break;
+                prev_v = V[t]
+                prev_t = time[t]
+
+        if apd_end_time != None and apd_start_time != None and apd_start_time < apd_end_time:
+            # Skip to next AP if start of this AP is reached before last AP is finished
+            continue
+
+        # If apd_start_index has a value then look forwards in time for repolarisation
+        if apd_starting_index != None:
+            prev_t = time[apd_starting_index - 1]
+            prev_v = V[apd_starting_index -1]
+            for t in range(apd_starting_index, len(time)):
+                if V[t] < custom_thresh:
+                    # Linear interpolation
+                    apd_end_time = time[t - 1] + ((custom_thresh - prev_v) / (V[t] - prev_v)) * (time[t] - time[t - 1])
+                    duration_ap[ap_index] = apd_end_time - apd_start_time
+                    #print apd_end_time, apd_start_time
+                    break
+                prev_t = time[t]
+                prev_v = V[t]
+
+        # Re-initialise for next AP.
+        apd_starting_index = None
+        apd_end_time = None
+        apd_start_time = None
+        # Loop to next AP
+
+    duration_ap = duration_ap[np.nonzero(duration_ap)]
+    return[onset_apd, duration_ap, thresh]
+
+def synthetic_trace(onsets, end, apd = 200, dt = 0.1, rest = -85.0, peak = 40.0, time = None):
+    # APs starting at each onset (ms): 2.3 ms linear upstroke, then a cubic fall back to rest
+    # apd ms after the onset. Flat at rest in between
+    if time is None:
+        time = np.arange(0, end, dt)
+    V = np.full(len(time), rest)
+    for onset in onsets:
+        u = time - onset
+        rise = (u >= 0) & (u < 2.3)
+        fall = (u >= 2.3) & (u < apd)
+        V[rise] = np.maximum(V[rise], rest + (peak - rest)*u[rise]/2.3)
+        V[fall] = np.maximum(V[fall], peak - (peak - rest)*((u[fall] - 2.3)/(apd - 2.3))**3)
+    return({'membrane.V' : V, 'engine.time' : time})
+
+traces = {
+    'train' : synthetic_trace([10, 510, 1010, 1510], 2000),
+    'truncated final AP' : synthetic_trace([10, 510, 1010], 1100),
+    'no APs' : {'membrane.V' : -85.0 + 0.001*np.sin(np.arange(0, 1000, 0.1)), 'engine.time' : np.arange(0, 1000, 0.1)},
+    'AP at t=0' : synthetic_trace([0, 400, 800], 1200, apd = 250),
+    'starts mid AP' : synthetic_trace([-100, 300, 700], 1000),
+    'variable steps' : synthetic_trace([10, 510, 1010], 1500, time = np.cumsum(np.tile([0.05, 0.3, 0.1, 0.7], 3000))),
+    }
+
+@pytest.mark.parametrize('name', sorted(traces))
+@pytest.mark.parametrize('repolarisation', [30, 50, 70, 90])
+def test_ap_duration_matches_baseline(name, repolarisation):
+    d = traces[name]
+    start, duration, thresh = ap_duration(d, repolarisation = repolarisation)
+    base_start, base_duration, base_thresh = baseline_ap_duration(d, paces = 10, repolarisation = repolarisation)
+    assert len(start) == len(base_start)
+    assert len(duration) == len(base_duration)
+    assert len(thresh) == len(base_thresh)
+    assert np.allclose(start, base_start)
+    assert np.allclose(duration, base_duration)
+    assert np.allclose(thresh, base_thresh)
+
+def test_truncated_final_ap():
+    # Onset of the unfinished AP is kept, no duration or threshold for it
+    start, duration, thresh = ap_duration(traces['truncated final AP'])
+    assert len(start) == 3
+    assert len(duration) == 2
+    assert len(thresh) == 2
+
+def test_no_aps():
+    start, duration, thresh = ap_duration(traces['no APs'])
+    assert len(start) == 0
+    assert len(duration) == 0
+    assert len(thresh) == 0
+
+## Several levels from one segmentation ##
+## ------------------------------------ ##
+
+# APD 98 is below the segmentation threshold, so its start is searched backwards
+levels = [30, 50, 70, 90, 98]
+
+@pytest.mark.parametrize('name', sorted(traces))
+def test_levels_match_single_level(name):
+    # Each column is what that level gives on its own, NaN where not repolarised
+    d = traces[name]
+    start, duration, thresh = ap_duration(d, repolarisation = levels, aligned = True)
+    for k, repolarisation in enumerate(levels):
+        level_start, level_duration, level_thresh = ap_duration(d, repolarisation = repolarisation, aligned = True)
+        assert np.allclose(start[:, k], level_start)
+        assert np.allclose(duration[:, k], level_duration, equal_nan = True)
+        assert np.allclose(thresh[:, k], level_thresh)
+
+def test_levels_drop_unrepolarised():
+    # Trace ends after the final AP is back below the segmentation threshold but before it is
+    # below the APD 98 threshold: dropped by default, NaN with aligned = True
+    d = synthetic_trace([10, 510, 1010], 1208)
+    start, duration, thresh = ap_duration(d, repolarisation = [30, 98], aligned = True)
+    assert len(duration) == 3
+    assert np.isnan(duration[-1, 1]) and not np.isnan(duration[-1, 0])
+    start, duration, thresh = ap_duration(d, repolarisation = [30, 98])
+    assert len(duration) == 2
+    start, duration, thresh = ap_duration(d, repolarisation = 98)
+    assert len(duration) == 2
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+import myokit
+import numpy as np
+from pacing_protocol import from_stages
+
+## Pacing protocols from an array of cycle lengths ##
+## ----------------------------------------------- ##
+
+def events(p):
+    return(sorted((e.start(), e.duration(), e.period(), e.multiplier()) for e in p.events()))
+
+def test_coupling_matches_scheduled_s1cis2():
+    # Stages CI apart (s1cis2), as they were scheduled by hand
+    pacing_list, time_per_stage, ci = [1000, 700, 400], 3000, 150
+    p = myokit.Protocol()
+    offset_list = []
+    offset = 0
+    for pacing in pacing_list:
+        beats_per_pace = time_per_stage//pacing
+        p.schedule(1, start = offset, duration = 0.5, period = pacing, multiplier = beats_per_pace)
+        offset_list.append(offset)
+        offset += (beats_per_pace - 1)*pacing + ci
+
+    pacing = from_stages(pacing_list, [time_per_stage//pcl for pcl in pacing_list], coupling = ci)
+    assert events(pacing.protocol()) == events(p)
+    assert np.allclose(pacing.stage_start, offset_list)
+    assert pacing.end == offset
+    assert np.allclose(pacing.stage_pcl, pacing_list)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import numpy as np
+from manual_APD import state_change, steady_pre
+from periodic_orbit import periodic_orbit
+
+## Periodic orbit detection ##
+## ------------------------ ##
+
+class MapSimulation(object):
+
+    # Stands in for a myokit.Simulation in steady_pre: s.pre(pcl) applies one beat of a map to
+    # the state. The map decays towards an alternating pair of states (period 2 orbit)
+
+    def __init__(self, decay = 0.5):
+        self.decay = decay
+        self.x = np.array([1.0, -3.0])
+        self.beat = 0
+
+    def pre(self, duration):
+        self.beat += 1
+        orbit = np.array([-80.0, 10.0]) if self.beat % 2 else np.array([-85.0, 12.0])
+        self.x = orbit + self.decay*(self.x - orbit)
+
+    def state(self):
+        return(list(self.x))
+
+def test_steady_pre_matches_periodic_orbit():
+    # One test: pacing beat by beat stops at the beat periodic_orbit finds on all the states
+    s = MapSimulation()
+    states = [s.state()]
+    for beat in range(60):
+        s.pre(1)
+        states.append(s.state())
+    beat, period, change = periodic_orbit(states, max_period = 2, confirm = 1)
+
+    s = MapSimulation()
+    beats, period_pre, change_pre = steady_pre(s, 1, max_beats = 60)
+    assert (beats, period_pre) == (beat, period) == (beats, 2)
+    assert np.isclose(change_pre, change) and change <= 1
+
+def test_steady_pre_not_steady():
+    # Too few beats: the closest period and its change are returned, as state_change gives them
+    s = MapSimulation(decay = 0.9)
+    beats, period, change = steady_pre(s, 1, max_beats = 10)
+    last = MapSimulation(decay = 0.9)
+    states = [last.state()]
+    for beat in range(10):
+        last.pre(1)
+        states.append(last.state())
+    assert beats == 10 and 1 < change < np.inf
+    assert (change, period) == state_change(states[-3:], 2)
+
+def test_state_change():
+    x = np.array([1.0, 2.0])
+    change, period = state_change([x, x + 1, x], 2)
+    assert period == 2 and change == 0
+    assert state_change([x], 2) == (np.inf, 0)
+    change, period = state_change([x, x + 1e-5], 1)
+    assert period == 1 and np.isclose(change, 1e-5/(1e-4*(1 + 1e-5) + 1e-6))
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+import pytest
+from restitution_protocols import dynamic_mode
+
+## Dynamic protocol run modes ##
+## -------------------------- ##
+
+def test_one_mode():
+    assert dynamic_mode() == 'full'
+    assert dynamic_mode(voltage_plot = True) == 'full'
+    assert dynamic_mode(stream = True) == 'stream'
+    assert dynamic_mode(log_beats = 6) == 'log_beats'
+    assert dynamic_mode(warm_start = True) == 'warm_start'
+    assert dynamic_mode(onset_tolerance = 5) == 'adaptive'
+
+@pytest.mark.parametrize('modes', [dict(stream = True, log_beats = 6), dict(stream = True, warm_start = True), dict(log_beats = 6, warm_start = True), dict(warm_start = True, onset_tolerance = 5), dict(stream = True, onset_tolerance = 5)])
+def test_modes_rejected_together(modes):
+    with pytest.raises(ValueError):
+        dynamic_mode(**modes)
+
+@pytest.mark.parametrize('mode', [dict(stream = True), dict(log_beats = 6), dict(warm_start = True), dict(onset_tolerance = 5)])
+def test_voltage_plot_needs_full_trace(mode):
+    with pytest.raises(ValueError):
+        dynamic_mode(voltage_plot = True, **mode)
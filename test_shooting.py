@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import numpy as np
+import shooting
+from shooting import shooting_pre, cycle_map
+
+## Steady state by shooting ##
+## ------------------------ ##
+
+class LogisticSimulation(object):
+
+    # Stands in for a myokit.Simulation: each beat of pcl ms applies the logistic map to the
+    # first variable (r = 3.4, unstable period 1 orbit, stable period 2 orbit) and decays the
+    # second towards 1. Counts the beats simulated
+    def __init__(self, pcl, x = (0.3, 3.0), r = 3.4):
+        self.pcl = pcl
+        self.r = r
+        self.x = np.array(x, dtype = float)
+        self.t = 0
+        self.beats = 0
+
+    def beat(self, duration):
+        for i in range(int(round(duration/self.pcl))):
+            self.x = np.array([self.r*self.x[0]*(1 - self.x[0]), 1 + 0.5*(self.x[1] - 1)])
+            self.beats += 1
+
+    def run(self, duration, log = None):
+        self.beat(duration)
+        self.t += duration
+
+    def pre(self, duration):
+        self.beat(duration)
+
+    def state(self):
+        return(list(self.x))
+
+    def set_state(self, x):
+        self.x = np.array(x, dtype = float)
+
+    def set_default_state(self, x):
+        pass
+
+    def time(self):
+        return(self.t)
+
+    def set_time(self, t):
+        self.t = t
+
+def period_2_orbit(r = 3.4):
+    # Exact period 2 orbit of the logistic map
+    root = np.sqrt((r + 1)*(r - 3))
+    return(sorted([(r + 1 + root)/(2*r), (r + 1 - root)/(2*r)]))
+
+def test_period_2_by_shooting(monkeypatch):
+    # The period 1 orbit is unstable, the period 2 orbit is found by Anderson acceleration
+    # without falling back to pacing
+    def no_pacing(*args, **kwargs):
+        raise AssertionError('paced to the period 2 orbit')
+    monkeypatch.setattr(shooting, 'steady_pre', no_pacing)
+    pcl = 100
+    s = LogisticSimulation(pcl)
+    beats, period, change = shooting_pre(s, pcl, max_beats = 1000)
+    assert period == 2 and change <= 1
+    assert beats == s.beats
+    x = np.asarray(s.state())
+    pair = sorted([x[0], cycle_map(s, pcl, 1)(x)[0]])
+    assert np.allclose(pair, period_2_orbit(), rtol = 1e-3)
+
+def test_period_1_stable():
+    # Below the period doubling (r < 3) the period 1 orbit is returned
+    pcl = 100
+    s = LogisticSimulation(pcl, r = 2.8)
+    beats, period, change = shooting_pre(s, pcl)
+    assert period == 1 and change <= 1 and beats == s.beats
+    assert np.isclose(s.state()[0], 1 - 1/2.8, rtol = 1e-3)
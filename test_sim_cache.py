@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import myokit
+import numpy as np
+import pytest
+import sim_cache
+
+## Cache of compiled simulations ##
+## ----------------------------- ##
+
+model_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ohara-cipa-v1-2017.mmt')
+
+def cached_simulations(number):
+    # Simulations sharing one compiled module, skipped where myokit cannot compile (no SUNDIALS)
+    m = myokit.load_model(model_file)
+    p = myokit.pacing.blocktrain(1000, 0.5, offset=0, level=1.0, limit=0)
+    try:
+        return([sim_cache.simulation(m, p) for i in range(number)])
+    except Exception as e:
+        pytest.skip('Cannot compile simulations here: {}'.format(e))
+
+def test_shared_module_keeps_constants():
+    # Epicardial and endocardial simulations on one module, run in turns
+    epi, endo, fresh = cached_simulations(3)
+    assert epi.cache_key == endo.cache_key == fresh.cache_key
+    epi.set_constant('cell.celltype', 1)
+    d_epi = epi.run(1000, log = ['membrane.V'])
+    d_endo = endo.run(1000, log = ['membrane.V'])
+    assert not np.allclose(d_epi['membrane.V'], d_endo['membrane.V'])
+
+    # The endocardial run is the same as a simulation whose constants were never changed
+    fresh.reset()
+    endo.reset()
+    epi.run(1000, log = myokit.LOG_NONE)
+    assert np.allclose(endo.run(1000, log = ['membrane.V'])['membrane.V'], fresh.run(1000, log = ['membrane.V'])['membrane.V'])
+
+@pytest.mark.skipif(sys.hexversion < 0x03050000, reason = 'Python 3.5+ loading path')
+def test_load_module_is_initialised(tmpdir):
+    # The module's code has run: its names are there
+    tmpdir.join('cached_module_test.py').write('value = 3\n')
+    module = sim_cache.load_module('cached_module_test', str(tmpdir))
+    assert module.value == 3
+
+def test_myokit_version_checked():
+    assert myokit.version(raw = True) in sim_cache.myokit_versions
+    assert sim_cache.check_myokit() is None
+
+def test_other_myokit_falls_back(monkeypatch, capsys):
+    # Any other myokit gives a plain Simulation with a warning, instead of failing
+    monkeypatch.setattr(myokit, 'version', lambda raw = False: '0.0.1')
+    reason = sim_cache.check_myokit()
+    assert reason is not None and '0.0.1' in reason
+    monkeypatch.setattr(sim_cache, 'unsupported', reason)
+    monkeypatch.setattr(sim_cache, 'warned', [])
+    created = []
+    monkeypatch.setattr(myokit, 'Simulation', lambda *args: created.append(args) or 'plain')
+    assert sim_cache.simulation('model', 'protocol') == 'plain'
+    assert created == [('model', 'protocol', None)]
+    assert 'not cached' in capsys.readouterr()[0]
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+import numpy as np
+from steady_grid import lookup
+
+## Grid of steady states over PCL ##
+## ------------------------------ ##
+
+pcls = np.array([1000.0, 500.0, 200.0])
+states = np.array([[1.0, 10.0], [2.0, 20.0], [3.0, 30.0]])
+
+def test_lookup_inside_grid(capsys):
+    assert np.allclose(lookup(pcls, states, 500), [2, 20])
+    assert np.allclose(lookup(pcls, states, 350), [2.5, 25])
+    assert np.allclose(lookup(pcls, states, 400, interpolate = False), [2, 20])
+    assert 'Warning' not in capsys.readouterr()[0]
+
+def test_lookup_outside_grid_warns(capsys):
+    # Nearest grid state, with a warning
+    assert np.allclose(lookup(pcls, states, 50), [3, 30])
+    assert 'PCL 50 ms outside the grid' in capsys.readouterr()[0]
+    assert np.allclose(lookup(pcls, states, 2000), [1, 10])
+    assert 'PCL 2000 ms outside the grid' in capsys.readouterr()[0]
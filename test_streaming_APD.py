@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import numpy as np
+from manual_APD import ap_duration
+from streaming_APD import StreamingAPD
+from test_manual_APD import synthetic_trace
+
+## Streaming APD calculation ##
+## ------------------------- ##
+
+def stream(d, window = 3000, **kwargs):
+    # StreamingAPD fed d in windows of window time points, sharing the boundary point as
+    # consecutive s.run logs do. Also returns the most samples it held at once
+    analyser = StreamingAPD(**kwargs)
+    held = 0
+    for i in range(0, len(d['engine.time']), window):
+        analyser.add({'membrane.V' : d['membrane.V'][i:i + window + 1], 'engine.time' : d['engine.time'][i:i + window + 1]})
+        held = max(held, len(analyser.V))
+    return(analyser.finish(), held)
+
+def test_stream_matches_full_trace():
+    d = synthetic_trace(np.arange(10, 5000, 500), 5000)
+    for repolarisation in [90, [50, 90]]:
+        result, held = stream(d, repolarisation = repolarisation)
+        for streamed, full in zip(result, ap_duration(d, repolarisation = repolarisation)):
+            assert np.allclose(streamed, full)
+
+def test_flat_trace_buffer_bounded():
+    # No AP at all for 200 s: the samples held stay within max_buffer
+    time = np.arange(0, 200000, 0.5)
+    d = {'membrane.V' : -85.0 + 0.001*np.sin(time), 'engine.time' : time}
+    (onset, duration, thresh), held = stream(d, AP_threshold = -80, max_buffer = 5000)
+    assert len(onset) == 0 and len(duration) == 0
+    assert held <= 5000/0.5 + 3000 + 2
+
+def test_depolarised_trace_buffer_bounded():
+    # Two APs, then depolarised arrest for 200 s (never repolarises), then two more APs
+    arrest = synthetic_trace([10, 510], 201600)
+    V = arrest['membrane.V']
+    time = arrest['engine.time']
+    V[(time > 1010) & (time < 200500)] = -20.0
+    V[(time >= 200500) & (time < 200600)] = -85.0
+    recovery = synthetic_trace([200600, 201100], 201600, time = time)
+    V = np.where(time >= 200600, recovery['membrane.V'], V)
+    d = {'membrane.V' : V, 'engine.time' : time}
+
+    (onset, duration, thresh), held = stream(d, AP_threshold = -80, max_buffer = 5000)
+    assert held <= 5000/0.1 + 3000 + 2
+    # APs before and after the arrest are as in the full trace, the arrest is given up on
+    full_onset, full_duration, full_thresh = ap_duration(d, repolarisation = 90, AP_threshold = -80)
+    assert len(full_duration) == 5
+    assert np.allclose(duration, full_duration[[0, 1, 3, 4]])